@@ -0,0 +1,84 @@
+"""Time and peak memory of the two docx export engines on a long synthetic document
+
+Each engine runs in its own child process so the peak resident set size of one run
+does not hide the other. Text mimics converted pages: headings, prose and tables.
+
+    python benchmarks/docx_export.py --pages 800
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+def build_text(pages, seed=1):
+    rng = random.Random(seed)
+    parts = []
+    for page in range(1, pages + 1):
+        parts.append(f"## Trang {page}\n")
+        for _ in range(rng.randint(6, 12)):
+            words = ' '.join(rng.choice(['hàm', 'số', 'đồ', 'thị', 'giá', 'trị', 'x', 'y', 'tính', 'biết'])
+                             for _ in range(rng.randint(12, 40)))
+            parts.append(f"{words.capitalize()} $x^{{2}} + 1$.\n\n")
+        if page % 3 == 0:
+            parts.append("| STT | Họ tên | Điểm | Ghi chú |\n|---|---|---|---|\n")
+            for row in range(rng.randint(5, 20)):
+                parts.append(f"| {row + 1} | Học sinh {row + 1} | {rng.randint(0, 10)} | |\n")
+            parts.append("\n")
+    return ''.join(parts)
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def run_child(engine, pages):
+    import converter
+
+    text = build_text(pages)
+    baseline = peak_rss_mb()
+    fd, output_path = tempfile.mkstemp(suffix='.docx')
+    os.close(fd)
+    try:
+        started = time.perf_counter()
+        converter.export_docx(text, output_path, engine=engine)
+        seconds = time.perf_counter() - started
+        size = os.path.getsize(output_path)
+    finally:
+        os.unlink(output_path)
+    peak = peak_rss_mb()
+    print(json.dumps({'seconds': seconds, 'baseline_mb': baseline, 'peak_mb': peak,
+                      'text_mb': len(text.encode('utf-8')) / (1024 * 1024), 'docx_mb': size / (1024 * 1024)}))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', type=int, default=800)
+    parser.add_argument('--child', choices=['python-docx', 'streaming'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.pages)
+        return
+
+    for engine in ('python-docx', 'streaming'):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--pages', str(args.pages),
+                                 '--child', engine], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        if engine == 'python-docx':
+            print(f"input: {args.pages} pages, {result['text_mb']:.1f} MB of text")
+        growth = '' if result['peak_mb'] is None else \
+            f"   peak RSS {result['peak_mb']:7.1f} MB (+{result['peak_mb'] - result['baseline_mb']:.1f} MB)"
+        print(f"{engine:12} {result['seconds'] * 1000:9.1f} ms{growth}   docx {result['docx_mb']:.1f} MB")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Throughput of process_formulas on multi-megabyte model output
+
+Compares the table-driven normalizer in converter.py with the previous regex-per-span
+implementation, which is kept here for reference. The normalizer handles far more
+symbols, $$display$$ spans and escaped dollars at about the same cost per megabyte.
+
+    python benchmarks/formulas.py --megabytes 4
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from converter import process_formulas
+
+def legacy_process_formulas(text):
+    def process_math_content(match):
+        content = match.group(1)
+        content = content.replace('π', '\\pi')
+        content = re.sub(r'√(\d+)', r'\\sqrt{\1}', content)
+        content = re.sub(r'√\{([^}]+)\}', r'\\sqrt{\1}', content)
+        content = content.replace('≠', '\\neq')
+        content = content.replace('*', '')
+        return f'${content}$'
+
+    return re.sub(r'\$(.+?)\$', process_math_content, text, flags=re.DOTALL)
+
+SNIPPETS = [
+    "Cho hàm số $y = x² - 2x + 1$ có đồ thị $(C)$. ",
+    "Tính diện tích hình tròn $S = πr²$ với $r ≠ 0$. ",
+    "Biết rằng $√16 = 4$ và $√{x+1} ≥ 2$ khi $x ≥ 3$. ",
+    "$$∑_{i=1}^{n} i = \\frac{n(n+1)}{2}$$\n",
+    "Giá trị $α + β = π$, $sin α·cos β ≤ 1$. ",
+    "Plain sentence with no math at all, repeated to mimic prose. ",
+    "| $x$ | $f(x) = 2*x$ |\n",
+    "Giá sản phẩm là \\$20. ",
+]
+
+def build_text(megabytes, seed=1):
+    rng = random.Random(seed)
+    parts = []
+    size = 0
+    target = megabytes * 1024 * 1024
+    while size < target:
+        snippet = rng.choice(SNIPPETS)
+        parts.append(snippet)
+        size += len(snippet.encode('utf-8'))
+    return ''.join(parts)
+
+def measure(function, text, runs):
+    best = float('inf')
+    for _ in range(runs):
+        started = time.perf_counter()
+        function(text)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--megabytes', type=float, default=4)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    text = build_text(args.megabytes)
+    size_mb = len(text.encode('utf-8')) / (1024 * 1024)
+    spans = text.count('$') // 2
+    print(f"input: {size_mb:.1f} MB, about {spans} math delimiters pairs")
+
+    for label, function in (('table-driven', process_formulas), ('legacy regex', legacy_process_formulas)):
+        seconds = measure(function, text, args.runs)
+        print(f"{label:13} {seconds * 1000:9.1f} ms   {size_mb / seconds:7.1f} MB/s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Throughput of the Markdown block tokenizer and the streaming docx export
+
+Compares iter_markdown_blocks in converter.py with the previous split-and-rescan line walker,
+which is kept here for reference, and reports end-to-end export speed of the streaming
+engine on the same text.
+
+    python benchmarks/markdown.py --megabytes 8
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from converter import export_docx, iter_markdown_blocks, parse_inline
+
+def legacy_blocks(text):
+    lines = text.split('\n')
+    i = 0
+    while i < len(lines):
+        line = lines[i].strip()
+        if not line:
+            i += 1
+            continue
+        if '|' in line and len(line.split('|')) > 2:
+            table_lines = []
+            j = i
+            while j < len(lines):
+                current_line = lines[j].strip()
+                if '|' in current_line and len(current_line.split('|')) > 2:
+                    separator_pattern = r'^\s*\|[\s\-\:]*\|\s*$'
+                    if not re.match(separator_pattern, current_line):
+                        table_lines.append(current_line)
+                    j += 1
+                else:
+                    break
+            if table_lines:
+                yield 'table', table_lines
+                i = j
+            else:
+                yield 'paragraph', line
+                i += 1
+        else:
+            yield 'paragraph', line
+            i += 1
+
+SNIPPETS = [
+    "## Câu {n}\n",
+    "Cho hàm số $y = x^{{2}} - 2x + 1$ có đồ thị $(C)$. Tìm **giá trị lớn nhất** của hàm số.\n",
+    "- Điều kiện: $x \\neq 0$ và *x* là số thực\n",
+    "1. Tính đạo hàm `f'(x)`\n2. Lập bảng biến thiên\n",
+    "> Lưu ý: kết quả làm tròn đến hàng phần trăm.\n",
+    "| $x$ | $-\\infty$ | 0 | $+\\infty$ |\n|---|---|---|---|\n| $y'$ | + | 0 | - |\n",
+    "```\nprint(sum(range(10)))\n```\n",
+    "Plain prose without any markup, standing in for the bulk of a converted page.\n",
+    "\n",
+]
+
+def build_text(megabytes, seed=1):
+    rng = random.Random(seed)
+    parts = []
+    size = 0
+    target = megabytes * 1024 * 1024
+    n = 0
+    while size < target:
+        n += 1
+        snippet = rng.choice(SNIPPETS).format(n=n)
+        parts.append(snippet)
+        size += len(snippet.encode('utf-8'))
+    return ''.join(parts)
+
+def tokenize_with_inline(text):
+    for block in iter_markdown_blocks(text):
+        if block[0] == 'paragraph':
+            parse_inline(block[2])
+
+def measure(function, runs):
+    best = float('inf')
+    for _ in range(runs):
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--megabytes', type=float, default=8)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    text = build_text(args.megabytes)
+    megabytes = len(text.encode('utf-8')) / (1024 * 1024)
+    print(f"input: {megabytes:.1f} MB, {text.count(chr(10))} lines")
+
+    fd, output_path = tempfile.mkstemp(suffix='.docx')
+    os.close(fd)
+    try:
+        results = [
+            ('block tokenizer', measure(lambda: sum(1 for _ in iter_markdown_blocks(text)), args.runs)),
+            ('  + inline runs', measure(lambda: tokenize_with_inline(text), args.runs)),
+            ('legacy walker', measure(lambda: sum(1 for _ in legacy_blocks(text)), args.runs)),
+            ('streaming export', measure(lambda: export_docx(text, output_path, engine='streaming'), 1)),
+        ]
+    finally:
+        os.unlink(output_path)
+
+    for label, seconds in results:
+        print(f"{label:18} {seconds * 1000:9.1f} ms   {megabytes / seconds:7.1f} MB/s")
+
+if __name__ == '__main__':
+    main()
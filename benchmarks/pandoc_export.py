@@ -0,0 +1,64 @@
+"""Batch pandoc export: one cold process per document against the shared pandoc server
+
+Exports the same set of synthetic documents twice through converter.PandocBackend, once with
+the server disabled (a piped pandoc process per document) and once through a long-lived
+`pandoc server`. Needs pandoc on PATH; the server run needs pandoc 3 or newer.
+
+    python benchmarks/pandoc_export.py --documents 40 --workers 4
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from docx_export import build_text
+
+def run(backend, documents, workers):
+    started = time.perf_counter()
+    errors = backend.export_many(documents, max_workers=workers)
+    seconds = time.perf_counter() - started
+    failed = [error for error in errors if error is not None]
+    if failed:
+        raise SystemExit(f"{len(failed)} exports failed, first error: {failed[0]}")
+    return seconds
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--documents', type=int, default=40)
+    parser.add_argument('--pages', type=int, default=3, help='synthetic pages per document')
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    if shutil.which('pandoc') is None:
+        raise SystemExit("pandoc not found in PATH")
+
+    import converter as app
+
+    text = build_text(args.pages)
+    with tempfile.TemporaryDirectory() as output_dir:
+        documents = [(text, os.path.join(output_dir, f"doc{i}.docx")) for i in range(args.documents)]
+
+        per_process = app.PandocBackend(max_workers=args.workers, use_server=False)
+        process_seconds = run(per_process, documents, args.workers)
+        print(f"process per document  {process_seconds:7.2f} s   "
+              f"{process_seconds / args.documents * 1000:7.1f} ms/doc")
+
+        shared = app.PandocBackend(max_workers=args.workers)
+        try:
+            if shared.ensure_server() is None:
+                print("pandoc server      unavailable (needs pandoc 3+)")
+                return
+            server_seconds = run(shared, documents, args.workers)
+        finally:
+            shared.close()
+        print(f"pandoc server         {server_seconds:7.2f} s   "
+              f"{server_seconds / args.documents * 1000:7.1f} ms/doc   "
+              f"({process_seconds / server_seconds:.1f}x)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""Cost of the local model router and the tier split it picks for a document
+
+Scores every page of each PDF (or each image) the way model 'auto' does, and reports
+the scoring time per page and how many pages would go to each model. Pass your own
+mixed documents; nothing is sent to the API.
+
+    python benchmarks/router.py book.pdf scans/*.png --pages-per-chunk 10
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import converter
+
+def describe_split(models):
+    counts = {}
+    for model in models:
+        counts[model] = counts.get(model, 0) + 1
+    return ', '.join(f"{model} x{count}" for model, count in sorted(counts.items()))
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('inputs', nargs='+', help='PDF or image files')
+    parser.add_argument('--pages-per-chunk', type=int, default=converter.DEFAULT_CHUNK_SETTINGS['pages_per_chunk'])
+    args = parser.parse_args()
+
+    for path in args.inputs:
+        started = time.perf_counter()
+        if path.lower().endswith('.pdf'):
+            scores = converter.score_pdf_pages(path)
+            seconds = time.perf_counter() - started
+            ranges = [scores[start:start + args.pages_per_chunk]
+                      for start in range(0, len(scores), args.pages_per_chunk)]
+            pages = describe_split(converter.route_model(converter.AUTO_MODEL, [score])[0] for score in scores)
+            chunks = describe_split(converter.route_model(converter.AUTO_MODEL, chunk)[0] for chunk in ranges)
+            print(f"{os.path.basename(path)}: {len(scores)} pages, "
+                  f"{seconds / max(1, len(scores)) * 1000:.1f} ms/page, "
+                  f"median score {statistics.median(scores) if scores else 0:.2f}")
+            print(f"  per page:  {pages}")
+            print(f"  per range: {chunks}")
+        else:
+            score = converter.score_image(path)
+            seconds = time.perf_counter() - started
+            print(f"{os.path.basename(path)}: score {score:.2f} in {seconds * 1000:.1f} ms -> "
+                  f"{converter.route_model(converter.AUTO_MODEL, [score])[0]}")
+
+if __name__ == '__main__':
+    main_cli()
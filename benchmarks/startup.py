@@ -0,0 +1,81 @@
+"""Cold-start benchmark for the source run and the cx_Freeze build
+
+Reports the time to import main.py and the time until the main window has painted
+for the first time. The app writes its own timings to the file named by
+PDF2WORD_STARTUP_PROBE and quits, so no API key or network is needed.
+
+    python benchmarks/startup.py --runs 5
+    python benchmarks/startup.py --exe build/exe.win-amd64-3.11/pdf2word.exe
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def measure_import(runs):
+    code = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', code], cwd=REPO_DIR, capture_output=True,
+                                text=True, check=True).stdout
+        samples.append(float(output.strip().splitlines()[-1]))
+    return samples
+
+def measure_first_window(command, runs):
+    """Run the app with the startup probe; returns (probe results, wall-clock seconds)"""
+    probes = []
+    wall = []
+    for _ in range(runs):
+        fd, probe_path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        env = dict(os.environ, PDF2WORD_STARTUP_PROBE=probe_path)
+        try:
+            started = time.perf_counter()
+            subprocess.run(command, cwd=REPO_DIR, env=env, capture_output=True, timeout=120)
+            wall.append(time.perf_counter() - started)
+            with open(probe_path, 'r', encoding='utf-8') as f:
+                probes.append(json.load(f))
+        finally:
+            os.unlink(probe_path)
+    return probes, wall
+
+def find_frozen_build():
+    for pattern in ('build/exe.*/pdf2word.exe', 'build/exe.*/pdf2word'):
+        matches = sorted(glob.glob(os.path.join(REPO_DIR, pattern)))
+        if matches:
+            return matches[-1]
+    return None
+
+def describe(samples):
+    return f"median {statistics.median(samples) * 1000:8.1f} ms   min {min(samples) * 1000:8.1f} ms"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--exe', help='frozen pdf2word executable (default: newest build/exe.*)')
+    args = parser.parse_args()
+
+    print(f"import main.py               {describe(measure_import(args.runs))}")
+
+    targets = [('source', [sys.executable, 'main.py'])]
+    exe = args.exe or find_frozen_build()
+    if exe:
+        targets.append(('cx_Freeze', [exe]))
+    else:
+        print("(no cx_Freeze build found; run 'python setup.py build' to include it)")
+
+    for label, command in targets:
+        probes, wall = measure_first_window(command, args.runs)
+        print(f"{label:10} in-process import {describe([p['import_seconds'] for p in probes])}")
+        print(f"{label:10} first window      {describe([p['first_window_seconds'] for p in probes])}")
+        print(f"{label:10} spawn to window   {describe(wall)}")
+
+if __name__ == '__main__':
+    main()
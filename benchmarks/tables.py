@@ -0,0 +1,78 @@
+"""Export time of large Markdown tables through create_word_table
+
+Compares the single-fragment table builder in converter.py with the previous cell-by-cell
+implementation, which is kept here for reference. Its print output goes to /dev/null
+so the comparison is not dominated by the terminal.
+
+    python benchmarks/tables.py --rows 500 --cols 12
+"""
+import argparse
+import contextlib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from converter import create_word_table, parse_table_lines
+
+def legacy_create_word_table(doc, table_lines):
+    table_data = parse_table_lines(table_lines)
+    for row_num, cells in enumerate(table_data, 1):
+        print(f"  Parsed row {row_num}: {cells}")
+
+    rows = len(table_data)
+    cols = max(len(row) for row in table_data)
+    print(f"Creating {rows}x{cols} table")
+    table = doc.add_table(rows=rows, cols=cols)
+    table.style = 'Table Grid'
+    for i, row_data in enumerate(table_data):
+        row = table.rows[i]
+        for j, cell_data in enumerate(row_data):
+            clean_data = str(cell_data).replace('\n', ' ').replace('\r', '')
+            row.cells[j].text = clean_data
+            print(f"  Cell [{i}][{j}]: {repr(clean_data)}")
+    doc.add_paragraph("")
+
+def build_table(rows, cols, seed=1):
+    rng = random.Random(seed)
+    lines = ['| ' + ' | '.join(f"Cột {j + 1}" for j in range(cols)) + ' |']
+    for i in range(rows):
+        lines.append('| ' + ' | '.join(f"{rng.uniform(0, 100):.2f}" for _ in range(cols)) + ' |')
+    return lines
+
+def measure(function, table_lines, runs):
+    from docx import Document
+
+    best = float('inf')
+    doc = None
+    for _ in range(runs):
+        doc = Document()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            started = time.perf_counter()
+            function(doc, table_lines)
+            best = min(best, time.perf_counter() - started)
+    return best, doc
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=500)
+    parser.add_argument('--cols', type=int, default=12)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    table_lines = build_table(args.rows, args.cols)
+    print(f"table: {args.rows + 1}x{args.cols}")
+
+    bulk_seconds, bulk_doc = measure(create_word_table, table_lines, args.runs)
+    legacy_seconds, legacy_doc = measure(legacy_create_word_table, table_lines, args.runs)
+
+    if bulk_doc.element.body.xml != legacy_doc.element.body.xml:
+        print("warning: the two builders produced different document XML")
+
+    print(f"bulk fragment   {bulk_seconds * 1000:9.1f} ms")
+    print(f"per cell        {legacy_seconds * 1000:9.1f} ms   ({legacy_seconds / bulk_seconds:.0f}x slower)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Cost of the local text-layer pre-pass and the requests it saves against the normal plan
+
+Classifies every page of each PDF the way the conversion does, and reports the time per
+page, which pages would still be sent to the model, and the number of requests with and
+without the text layer. The baseline is what the conversion would otherwise send: one
+whole-document request, or page ranges for chunked and long documents. Pass your own
+mixed corpora; nothing is sent to the API.
+
+    python benchmarks/text_layer.py papers/*.pdf
+    python benchmarks/text_layer.py papers/*.pdf --pages-per-chunk 10
+"""
+import argparse
+import os
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import converter
+
+def describe_runs(runs):
+    return ', '.join(str(first) if first == last else f"{first}-{last}" for first, last in runs) or '-'
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('inputs', nargs='+', help='PDF files')
+    parser.add_argument('--pages-per-chunk', type=int, default=0,
+                        help='plan page ranges of this size (default: one request per document, '
+                             f"ranges of {converter.DEFAULT_CHUNK_SETTINGS['pages_per_chunk']} from "
+                             f"{converter.LONG_DOCUMENT_PAGES} pages on, as the app does)")
+    args = parser.parse_args()
+
+    total_pages = 0
+    total_local = 0
+    total_requests = 0
+    total_baseline = 0
+    for path in args.inputs:
+        pages = converter.pdf_page_count(path)
+        pages_per_chunk = args.pages_per_chunk or None
+        if pages_per_chunk is None and pages >= converter.LONG_DOCUMENT_PAGES:
+            pages_per_chunk = converter.DEFAULT_CHUNK_SETTINGS['pages_per_chunk']
+        started = time.perf_counter()
+        local_pages = converter.extract_text_layer_pages(path)
+        seconds = time.perf_counter() - started
+        requests, baseline = converter.text_layer_requests(pages, local_pages, pages_per_chunk)
+        used = requests <= baseline
+        if not used:
+            # The conversion falls back to sending every page
+            requests = baseline
+        model_pages = [page for page in range(1, pages + 1) if not used or page not in local_pages]
+        total_pages += pages
+        total_local += len(local_pages) if used else 0
+        total_requests += requests
+        total_baseline += baseline
+        print(f"{os.path.basename(path)}: {pages} pages, {seconds / max(1, pages) * 1000:.1f} ms/page, "
+              f"{len(local_pages)} clean, {requests} requests (baseline {baseline})"
+              + ("" if used else " - text layer not used, it would split the requests"))
+        print(f"  model pages: {describe_runs(converter.page_runs(model_pages))}")
+
+    if len(args.inputs) > 1:
+        print(f"total: {total_local} of {total_pages} pages local "
+              f"({total_local * 100 / max(1, total_pages):.0f}%), {total_requests} requests "
+              f"(baseline {total_baseline})")
+
+if __name__ == '__main__':
+    main_cli()
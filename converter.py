@@ -0,0 +1,3206 @@
+"""Conversion core: Gemini requests, caches, post-processing, export and the headless CLI
+
+Nothing here imports Qt; main.py builds the window and its worker threads on top of
+this module.
+"""
+import time
+import sys
+import os
+import re
+import tempfile
+import shutil
+import json
+import hashlib
+import threading
+import random
+import argparse
+import glob
+import multiprocessing
+import mimetypes
+import logging
+import contextlib
+import functools
+import uuid
+import atexit
+import unicodedata
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import io
+
+# google.genai, docx, PIL, pypdf and subprocess are imported where they are first
+# used: together they cost more start-up time than the whole Qt window.
+
+DEFAULT_MODEL = "gemini-2.5-flash"
+# 'auto' lets the router pick a model per page range or image set
+AUTO_MODEL = "auto"
+MODEL_CHOICES = [AUTO_MODEL, DEFAULT_MODEL, "gemini-2.5-flash-lite", "gemini-2.5-pro"]
+# Router tiers: plain text pages go to the fast model, formula-heavy or unreadable ones to the strong one
+ROUTER_FAST_MODEL = "gemini-2.5-flash-lite"
+ROUTER_STRONG_MODEL = DEFAULT_MODEL
+
+# Diagnostics that are too chatty for stdout; PDF2WORD_DEBUG=1 turns them on
+logger = logging.getLogger('pdf2word')
+
+def setup_logging():
+    if os.environ.get('PDF2WORD_DEBUG'):
+        logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+class ConversionCancelled(Exception):
+    """Raised inside worker code when the user stopped the conversion"""
+
+class CancelToken:
+    """Cooperative cancellation for one job
+
+    The token is callable and returns True once cancelled, so it can be passed anywhere a
+    should_stop callable is accepted. Given a token, ApiScheduler wakes from backoff waits
+    at once and runs each request on a helper thread, so a request blocked on the network
+    is abandoned on cancel instead of holding the worker until the server answers.
+    A token with a parent (another token or any should_stop callable) is cancelled with it.
+    """
+
+    # How often a plain should_stop parent, which cannot wake waiters, is polled
+    POLL_SECONDS = 0.2
+
+    def __init__(self, parent=None):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.parent = parent
+        self.poll_seconds = None
+        if isinstance(parent, CancelToken):
+            parent.add_callback(self.cancel)
+        elif parent is not None:
+            self.poll_seconds = self.POLL_SECONDS
+
+    def __call__(self):
+        if not self.event.is_set() and self.parent is not None and self.parent():
+            self.cancel()
+        return self.event.is_set()
+
+    def cancel(self):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback):
+        """Run callback() on cancel, right away if the token is already cancelled"""
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    def wait(self, seconds):
+        """Sleep up to seconds; returns True as soon as the token is cancelled"""
+        deadline = time.monotonic() + seconds
+        while not self():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self.event.wait(remaining if self.poll_seconds is None else min(remaining, self.poll_seconds))
+        return True
+
+    def run(self, fn):
+        """Return fn() computed on a helper thread; raises ConversionCancelled as soon as the
+        token is cancelled, leaving the abandoned call to end on its own"""
+        wake = threading.Event()
+        outcome = {}
+
+        def target():
+            try:
+                outcome['result'] = fn()
+            except BaseException as e:
+                outcome['error'] = e
+            wake.set()
+
+        self.add_callback(wake.set)
+        try:
+            threading.Thread(target=target, daemon=True, name='pdf2word-request').start()
+            while not wake.wait(self.poll_seconds) and not self():
+                pass
+        finally:
+            self.remove_callback(wake.set)
+        if 'error' in outcome:
+            raise outcome['error']
+        if 'result' in outcome:
+            return outcome['result']
+        raise ConversionCancelled()
+
+class ApiScheduler:
+    """Process-wide gate for Gemini calls
+
+    Every call waits for a token-bucket slot and a concurrency slot, and retryable
+    failures are retried with exponential backoff plus jitter. A 429 halves the
+    request rate and pauses all callers for the server's retry hint; successful
+    calls slowly restore the rate.
+    """
+
+    RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+    RETRY_HINT_PATTERN = re.compile(r"(?:retryDelay['\"]?\s*:\s*['\"]|retry in\s+)(\d+(?:\.\d+)?)s", re.IGNORECASE)
+
+    def __init__(self, rate_per_minute=60, min_rate_per_minute=4, burst=5, max_concurrent=4,
+                 max_retries=6, base_delay=2.0, max_delay=120.0):
+        self.max_rate = rate_per_minute / 60.0
+        self.min_rate = min(min_rate_per_minute, rate_per_minute) / 60.0
+        self.rate = self.max_rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.max_concurrent = max_concurrent
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.counters = {'succeeded': 0, 'throttled': 0, 'retried': 0, 'failed': 0}
+
+    def configure(self, rate_per_minute=None, burst=None, max_concurrent=None):
+        """Change the limits; calls already holding a concurrency slot finish under the old cap"""
+        with self.lock:
+            if rate_per_minute:
+                self.max_rate = rate_per_minute / 60.0
+                self.min_rate = min(self.min_rate, self.max_rate)
+                self.rate = self.max_rate
+            if burst:
+                self.burst = burst
+                self.tokens = min(self.tokens, float(burst))
+            if max_concurrent and max_concurrent != self.max_concurrent:
+                self.max_concurrent = max_concurrent
+                # A call releases the semaphore it acquired, so swapping it is safe mid-flight
+                self.slots = threading.BoundedSemaphore(max_concurrent)
+
+    def limits(self):
+        with self.lock:
+            return {'rate_per_minute': round(self.max_rate * 60), 'burst': self.burst,
+                    'max_concurrent': self.max_concurrent}
+
+    def acquire_token(self, should_stop=None):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            self.sleep(wait, should_stop)
+
+    def sleep(self, seconds, should_stop=None):
+        if isinstance(should_stop, CancelToken):
+            if should_stop.wait(seconds):
+                raise ConversionCancelled()
+            return
+        # Sleep in short slices so a stopped conversion does not wait out the full delay
+        deadline = time.monotonic() + seconds
+        while True:
+            if should_stop and should_stop():
+                raise ConversionCancelled()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 0.2))
+
+    def classify(self, error):
+        """Return (retryable, throttled, server retry hint in seconds or None)"""
+        from google.genai import errors
+        import httpx
+
+        status = error.code if isinstance(error, errors.APIError) else None
+        message = str(error)
+        throttled = status == 429 or (status is None and ("429" in message or "RESOURCE_EXHAUSTED" in message))
+        retryable = throttled or status in self.RETRYABLE_STATUS or \
+            isinstance(error, (ConnectionError, TimeoutError, httpx.TransportError))
+
+        hint = None
+        match = self.RETRY_HINT_PATTERN.search(message)
+        if match:
+            hint = float(match.group(1))
+        else:
+            response = getattr(error, 'response', None)
+            retry_after = getattr(response, 'headers', {}).get('retry-after') if response is not None else None
+            if retry_after and retry_after.isdigit():
+                hint = float(retry_after)
+        return retryable, throttled, hint
+
+    def call(self, fn, on_retry=None, should_stop=None, max_retries=None, rate_limited=True, metrics=None):
+        """Run fn() under the rate limit, retrying transient failures; returns its result
+
+        File uploads pass rate_limited=False: they count against the concurrency cap
+        but not against the generation request quota. Retries and 429s are also counted
+        on metrics, the JobMetrics of the calling job, when given.
+        """
+        max_retries = self.max_retries if max_retries is None else max_retries
+        for attempt in range(max_retries + 1):
+            if rate_limited:
+                self.acquire_token(should_stop)
+            with self.slots:
+                if should_stop and should_stop():
+                    raise ConversionCancelled()
+                try:
+                    result = should_stop.run(fn) if isinstance(should_stop, CancelToken) else fn()
+                except ConversionCancelled:
+                    raise
+                except Exception as e:
+                    last_error = e
+                    retryable, throttled, hint = self.classify(e)
+                    if metrics:
+                        if throttled:
+                            metrics.add('rate_limited')
+                        if retryable and attempt < max_retries:
+                            metrics.add('retries')
+                    with self.lock:
+                        if throttled:
+                            self.counters['throttled'] += 1
+                            self.rate = max(self.min_rate, self.rate / 2)
+                        if not retryable or attempt == max_retries:
+                            self.counters['failed'] += 1
+                            raise
+                        self.counters['retried'] += 1
+                        # Full jitter, but never sooner than the server asked for
+                        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                        if hint is not None:
+                            delay = max(delay, hint)
+                            if throttled:
+                                self.paused_until = max(self.paused_until, time.monotonic() + hint)
+                else:
+                    with self.lock:
+                        self.counters['succeeded'] += 1
+                        self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+                    return result
+
+            if on_retry:
+                on_retry(last_error, delay, throttled)
+            self.sleep(delay, should_stop)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, rate_per_minute=round(self.rate * 60, 1))
+
+api_scheduler = ApiScheduler()
+
+# Seconds a Gemini HTTP request may wait on the network (connect, send or each read)
+# before it fails; a timeout counts as a transient error and is retried
+REQUEST_TIMEOUT_SECONDS = 300
+
+def make_client(api_key, timeout=REQUEST_TIMEOUT_SECONDS):
+    """Gemini client whose requests give up after timeout seconds without progress"""
+    from google import genai
+    from google.genai import types
+
+    return genai.Client(api_key=api_key, http_options=types.HttpOptions(timeout=int(timeout * 1000)))
+
+# Rough size of the model output for one PDF page or image, used to scale streaming progress
+EXPECTED_BYTES_PER_PAGE = 3000
+
+# Markdown and LaTeX output for one dense page, in tokens; sizes requests before they are sent
+OUTPUT_TOKENS_PER_PAGE = 1200
+# Share of a model's output limit one planned request may use, leaving room for denser pages
+OUTPUT_BUDGET_SHARE = 0.8
+# (input, output) token limits used when the API does not report a model's own
+DEFAULT_TOKEN_LIMITS = (1_048_576, 65_536)
+# Follow-up requests allowed after a response stops at the output token limit
+MAX_CONTINUATIONS = 4
+CONTINUE_PROMPT = ("Your previous answer was cut off by the output length limit. Continue exactly where it "
+                   "stopped, in the same format. Do not repeat anything already written and do not add an "
+                   "introduction.")
+
+def finish_reason_name(response):
+    """Finish reason of a response or stream chunk, e.g. 'STOP' or 'MAX_TOKENS'; None if absent"""
+    candidates = getattr(response, 'candidates', None)
+    if not candidates or candidates[0].finish_reason is None:
+        return None
+    reason = candidates[0].finish_reason
+    return getattr(reason, 'name', None) or str(reason)
+
+def generate_streaming(client, contents, on_chunk=None, should_stop=None, model=DEFAULT_MODEL, config=None):
+    """Stream one generation, calling on_chunk(text, received_bytes) as chunks arrive
+
+    Returns (text, finish reason name, usage metadata of the response).
+    """
+    parts = []
+    received_bytes = 0
+    finish_reason = None
+    usage = None
+    for chunk in client.models.generate_content_stream(
+        model=model,
+        contents=contents,
+        config=config,
+    ):
+        if should_stop and should_stop():
+            raise ConversionCancelled()
+        finish_reason = finish_reason_name(chunk) or finish_reason
+        # Every chunk carries the running totals; the last one has the final counts
+        usage = getattr(chunk, 'usage_metadata', None) or usage
+        text = chunk.text
+        if not text:
+            continue
+        parts.append(text)
+        received_bytes += len(text.encode('utf-8'))
+        if on_chunk:
+            on_chunk(text, received_bytes)
+    return "".join(parts), finish_reason, usage
+
+def generate_once(client, contents, model=DEFAULT_MODEL, config=None):
+    """One non-streamed generation; returns (text, finish reason name, usage metadata)"""
+    response = client.models.generate_content(model=model, contents=contents, config=config)
+    return response.text or "", finish_reason_name(response), getattr(response, 'usage_metadata', None)
+
+def continuation_contents(contents, text):
+    """The original request, the truncated answer as the model's turn, and a request to go on"""
+    from google.genai import types
+
+    parts = []
+    for item in contents:
+        if isinstance(item, str):
+            parts.append(types.Part(text=item))
+        elif isinstance(item, types.Part):
+            parts.append(item)
+        else:
+            parts.append(types.Part.from_uri(file_uri=item.uri, mime_type=item.mime_type))
+    return [types.Content(role='user', parts=parts),
+            types.Content(role='model', parts=[types.Part(text=text)]),
+            types.Content(role='user', parts=[types.Part(text=CONTINUE_PROMPT)])]
+
+def stitch_continuation(text, continuation, max_overlap=500, min_overlap=20):
+    """Append a continuation, dropping any repeat of the text's tail at its start"""
+    for size in range(min(max_overlap, len(text), len(continuation)), min_overlap - 1, -1):
+        if text.endswith(continuation[:size]):
+            return text + continuation[size:]
+    return text + continuation
+
+def record_token_usage(metrics, usage):
+    if metrics is None or usage is None:
+        return
+    metrics.add('input_tokens', usage.prompt_token_count or 0)
+    metrics.add('output_tokens', usage.candidates_token_count or 0)
+    metrics.add('thinking_tokens', getattr(usage, 'thoughts_token_count', None) or 0)
+    metrics.add('cached_tokens', getattr(usage, 'cached_content_token_count', None) or 0)
+
+def generate_text(client, contents, model=DEFAULT_MODEL, stream=True, on_chunk=None, on_notice=None,
+                  should_stop=None, metrics=None, where="", config=None, on_reset=None):
+    """Generate through the scheduler; while the output stops at the token limit, ask the
+    model to continue and stitch the pieces together. Returns the full text.
+
+    A streamed attempt that fails part-way is retried from the start; on_reset(partial)
+    is called first with the text it had already passed to on_chunk.
+    """
+    location = f" for {where}" if where else ""
+    text = ""
+    received_offset = 0
+    request = contents
+    for continuation in range(MAX_CONTINUATIONS + 1):
+        attempt = []
+
+        def on_stream_chunk(piece, received_bytes):
+            attempt.append(piece)
+            # Progress keeps counting across continuations
+            on_chunk(piece, received_offset + received_bytes)
+
+        def on_retry(error, delay, throttled):
+            if attempt and on_reset:
+                on_reset("".join(attempt))
+            attempt.clear()
+            if on_notice:
+                on_notice(retry_notice(error, delay, throttled, where))
+
+        if stream:
+            generate = lambda: generate_streaming(client, request, on_chunk=on_stream_chunk if on_chunk else None,
+                                                  should_stop=should_stop, model=model, config=config)
+        else:
+            generate = lambda: generate_once(client, request, model=model, config=config)
+        with metrics_stage(metrics, 'generate'):
+            piece, finish_reason, usage = api_scheduler.call(generate, on_retry=on_retry, should_stop=should_stop,
+                                                             metrics=metrics)
+        record_token_usage(metrics, usage)
+        received_offset += len(piece.encode('utf-8'))
+        text = stitch_continuation(text, piece)
+        if finish_reason != 'MAX_TOKENS':
+            return text
+        if continuation == MAX_CONTINUATIONS:
+            break
+        if metrics:
+            metrics.add('continuations')
+        if on_notice:
+            on_notice(f"Output{location} reached the token limit, requesting the rest "
+                      f"({continuation + 1}/{MAX_CONTINUATIONS})...")
+        request = continuation_contents(contents, text)
+
+    message = f"Output{location} was still cut off after {MAX_CONTINUATIONS} continuations; the end may be missing."
+    print(message, file=sys.stderr)
+    if on_notice:
+        on_notice(message)
+    return text
+
+token_limits = {}
+token_limits_lock = threading.Lock()
+
+def model_token_limits(client, model):
+    """(input, output) token limits of a model, asked from the API once per model"""
+    with token_limits_lock:
+        if model in token_limits:
+            return token_limits[model]
+    try:
+        info = client.models.get(model=model)
+        limits = (info.input_token_limit or DEFAULT_TOKEN_LIMITS[0],
+                  info.output_token_limit or DEFAULT_TOKEN_LIMITS[1])
+    except Exception as e:
+        logger.debug("Could not read the token limits of %s: %s", model, e)
+        limits = DEFAULT_TOKEN_LIMITS
+    with token_limits_lock:
+        token_limits[model] = limits
+    return limits
+
+def preflight(client, contents, model, pages, should_stop=None):
+    """How many of the request's pages (or images) fit in one request to model
+
+    The input side is measured with count_tokens; the output side is estimated at
+    OUTPUT_TOKENS_PER_PAGE. Returns at least `pages` when the whole request fits.
+    """
+    input_limit, output_limit = model_token_limits(client, model)
+    fit = max(1, int(output_limit * OUTPUT_BUDGET_SHARE) // OUTPUT_TOKENS_PER_PAGE)
+    try:
+        input_tokens = api_scheduler.call(
+            lambda: client.models.count_tokens(model=model, contents=contents).total_tokens,
+            should_stop=should_stop, max_retries=1, rate_limited=False)
+    except ConversionCancelled:
+        raise
+    except Exception as e:
+        # Advisory only: continuations still catch what the estimate misses
+        logger.debug("Token preflight failed for %s: %s", model, e)
+        input_tokens = None
+    if input_tokens and input_tokens > input_limit * OUTPUT_BUDGET_SHARE:
+        fit = min(fit, max(1, int(pages * input_limit * OUTPUT_BUDGET_SHARE / input_tokens)))
+    logger.debug("Preflight %s: %s input tokens, %d of %d pages fit", model, input_tokens, fit, pages)
+    return fit
+
+# Per-user directory for caches and indexes that outlive a session
+APP_DATA_DIR = os.path.join(os.path.expanduser('~'), '.pdf2word')
+
+def file_sha256(file_path):
+    """Hex SHA-256 of a file's bytes"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def write_json_atomic(path, data):
+    """Write JSON to path via a temp file so a crash never leaves a truncated index"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+    os.replace(temp_path, path)
+
+API_LIMITS_PATH = os.path.join(APP_DATA_DIR, 'api_limits.json')
+
+def load_api_limits(path=API_LIMITS_PATH):
+    """Apply the saved request rate, burst and concurrency limits to api_scheduler"""
+    try:
+        if not os.path.exists(path):
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        api_scheduler.configure(**{key: int(data[key]) for key in ('rate_per_minute', 'burst', 'max_concurrent')
+                                   if isinstance(data.get(key), int) and data[key] > 0})
+    except Exception as e:
+        print(f"Error loading API limits: {e}", file=sys.stderr)
+
+def save_api_limits(path=API_LIMITS_PATH):
+    try:
+        write_json_atomic(path, api_scheduler.limits())
+    except Exception as e:
+        print(f"Error saving API limits: {e}", file=sys.stderr)
+
+class UploadCache:
+    """On-disk index of Gemini file handles keyed by a hash of the uploaded bytes
+
+    Handles are reused until shortly before their server-side expiry. Entries evicted
+    from the index are remembered as orphans so cleanup() can delete the remote files.
+    Cache hits only touch last_used in memory; the index is written on the next miss,
+    cleanup() or flush().
+    """
+
+    def __init__(self, account='', index_path=None, max_entries=200, expiry_margin=600):
+        self.index_path = index_path or os.path.join(APP_DATA_DIR, 'upload_cache.json')
+        # Files belong to the project of the API key that uploaded them
+        self.account = hashlib.sha256(account.encode('utf-8')).hexdigest()[:16]
+        self.max_entries = max_entries
+        self.expiry_margin = expiry_margin
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.orphans = []
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            if os.path.exists(self.index_path):
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.entries = data.get('entries', {})
+                self.orphans = data.get('orphans', [])
+        except Exception as e:
+            print(f"Error loading upload cache: {e}", file=sys.stderr)
+            self.entries = {}
+            self.orphans = []
+
+    def save(self):
+        try:
+            write_json_atomic(self.index_path, {'entries': self.entries, 'orphans': self.orphans})
+            self.dirty = False
+        except Exception as e:
+            print(f"Error saving upload cache: {e}", file=sys.stderr)
+
+    def flush(self):
+        """Write the index if cache hits have changed it since the last save"""
+        with self.lock:
+            if self.dirty:
+                self.save()
+
+    def upload(self, client, file, mime_type=None, display_name=None, digest=None, metrics=None):
+        """Return a file handle for a path or bytes, uploading only if no live handle is cached"""
+        if digest is None:
+            if isinstance(file, (bytes, bytearray)):
+                digest = hashlib.sha256(file).hexdigest()
+            else:
+                digest = file_sha256(file)
+        key = f"{self.account}:{digest}"
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry['expiration_time'] - self.expiry_margin > time.time():
+                # Rewriting the whole index on every hit serialises parallel jobs on the lock
+                entry['last_used'] = time.time()
+                self.dirty = True
+                if metrics:
+                    metrics.add('cached_uploads')
+                from google.genai import types
+                return types.File(name=entry['name'], uri=entry['uri'], mime_type=entry['mime_type'])
+
+        config = {}
+        if mime_type:
+            config['mime_type'] = mime_type
+        if display_name:
+            config['display_name'] = display_name
+        if isinstance(file, (bytes, bytearray)):
+            uploaded_file = client.files.upload(file=io.BytesIO(file), config=config or None)
+        else:
+            uploaded_file = client.files.upload(file=file, config=config or None)
+        if metrics:
+            metrics.add('uploads')
+            metrics.add('uploaded_bytes', len(file) if isinstance(file, (bytes, bytearray)) else os.path.getsize(file))
+
+        if isinstance(uploaded_file.expiration_time, datetime):
+            expiration_time = uploaded_file.expiration_time.timestamp()
+        else:
+            # Files API keeps uploads for 48 hours
+            expiration_time = time.time() + 48 * 3600
+
+        with self.lock:
+            previous = self.entries.get(key)
+            if previous and previous['name'] != uploaded_file.name:
+                self.orphans.append(previous['name'])
+            self.entries[key] = {
+                'name': uploaded_file.name,
+                'uri': uploaded_file.uri,
+                'mime_type': uploaded_file.mime_type,
+                'expiration_time': expiration_time,
+                'last_used': time.time()
+            }
+            self.evict()
+            self.save()
+        return uploaded_file
+
+    def evict(self):
+        # Drop expired entries, then the least recently used ones above the limit
+        now = time.time()
+        for key in [k for k, e in self.entries.items() if e['expiration_time'] <= now]:
+            del self.entries[key]
+        if len(self.entries) > self.max_entries:
+            by_age = sorted(self.entries, key=lambda k: self.entries[k]['last_used'])
+            for key in by_age[:len(self.entries) - self.max_entries]:
+                self.orphans.append(self.entries.pop(key)['name'])
+
+    def cleanup(self, client):
+        """Delete remote files that are no longer referenced by the index"""
+        with self.lock:
+            self.evict()
+            orphans = list(self.orphans)
+            self.save()
+
+        deleted = []
+        for name in orphans:
+            try:
+                client.files.delete(name=name)
+                deleted.append(name)
+            except Exception as e:
+                # Already expired or deleted on the server side
+                if "404" in str(e) or "403" in str(e):
+                    deleted.append(name)
+                else:
+                    print(f"Error deleting remote file {name}: {e}", file=sys.stderr)
+
+        with self.lock:
+            self.orphans = [name for name in self.orphans if name not in deleted]
+            self.save()
+        return len(deleted)
+
+class ResultCache:
+    """Disk-backed LRU cache of raw model output keyed by input hash, prompt and model"""
+
+    def __init__(self, cache_dir=None, max_bytes=200 * 1024 * 1024):
+        self.cache_dir = cache_dir or os.path.join(APP_DATA_DIR, 'results')
+        self.index_path = os.path.join(self.cache_dir, 'index.json')
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.index = {}
+        try:
+            if os.path.exists(self.index_path):
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    self.index = json.load(f)
+        except Exception as e:
+            print(f"Error loading result cache index: {e}", file=sys.stderr)
+            self.index = {}
+
+    @staticmethod
+    def make_key(content_hash, prompt, model, variant=""):
+        # variant separates results produced a different way, e.g. with text-layer pages
+        parts = [content_hash, prompt, model] + ([variant] if variant else [])
+        return hashlib.sha256("\0".join(parts).encode('utf-8')).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.txt")
+
+    def get(self, key):
+        """Return the cached raw text for key, or None on a miss"""
+        with self.lock:
+            if key not in self.index:
+                return None
+            try:
+                with open(self.entry_path(key), 'r', encoding='utf-8') as f:
+                    text = f.read()
+            except OSError:
+                del self.index[key]
+                self.save()
+                return None
+            self.index[key]['last_used'] = time.time()
+            self.save()
+            return text
+
+    def put(self, key, text):
+        with self.lock:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with open(self.entry_path(key), 'w', encoding='utf-8') as f:
+                    f.write(text)
+            except OSError as e:
+                print(f"Error writing result cache entry: {e}", file=sys.stderr)
+                return
+            self.index[key] = {'size': len(text.encode('utf-8')), 'last_used': time.time()}
+            self.evict()
+            self.save()
+
+    def evict(self):
+        # Remove least recently used entries until the cache fits in max_bytes
+        total = sum(entry['size'] for entry in self.index.values())
+        for key in sorted(self.index, key=lambda k: self.index[k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            total -= self.index.pop(key)['size']
+            try:
+                os.unlink(self.entry_path(key))
+            except OSError:
+                pass
+
+    def save(self):
+        try:
+            write_json_atomic(self.index_path, self.index)
+        except Exception as e:
+            print(f"Error saving result cache index: {e}", file=sys.stderr)
+
+# Lifetime of a server-side cached context; passes started within it reuse the document's tokens
+CONTEXT_CACHE_TTL_SECONDS = 900
+# How long closing the app waits for cached contexts to be deleted
+CONTEXT_CACHE_CLEAR_SECONDS = 3
+CONTEXT_SYSTEM_INSTRUCTION = """
+        Bạn gõ lại [CHÍNH XÁC] nội dung của tài liệu đính kèm thành văn bản.
+        - CHỈ gõ lại nội dung có trong tài liệu, KHÔNG thêm bất kỳ nội dung nào khác
+        - [Bắt buộc] tất cả công thức toán học viết dưới dạng LaTeX được bọc trong dấu $
+        """
+
+class ContextCache:
+    """Server-side cached contexts holding an uploaded file and the system instruction
+
+    Generations against a cached context send only the prompt, so retries and repeat
+    passes over the same document do not have it processed and billed in full again.
+    Contexts are kept per file and model, reused until shortly before their TTL runs
+    out, and deleted with clear() once the document is done with.
+    """
+
+    def __init__(self, ttl=CONTEXT_CACHE_TTL_SECONDS, expiry_margin=120):
+        self.ttl = ttl
+        self.expiry_margin = expiry_margin
+        self.lock = threading.Lock()
+        # (file uri, model) -> {'name', 'expire_time'}
+        self.entries = {}
+        # Files or models the API refused to cache, e.g. documents below the minimum token count
+        self.unsupported = set()
+
+    def get(self, client, uploaded_file, model, on_notice=None, should_stop=None, metrics=None):
+        """Name of a live cached context for uploaded_file on model, creating one if needed;
+        None when this file cannot be cached for the model"""
+        key = (uploaded_file.uri, model)
+        with self.lock:
+            if key in self.unsupported:
+                return None
+            entry = self.entries.get(key)
+            if entry and entry['expire_time'] - self.expiry_margin > time.time():
+                return entry['name']
+
+        from google.genai import types
+        config = types.CreateCachedContentConfig(
+            contents=[uploaded_file],
+            system_instruction=CONTEXT_SYSTEM_INSTRUCTION,
+            display_name=f"pdf2word {uploaded_file.name}"[:128],
+            ttl=f"{self.ttl}s"
+        )
+        try:
+            with metrics_stage(metrics, 'upload'):
+                cached = api_scheduler.call(lambda: client.caches.create(model=model, config=config),
+                                            should_stop=should_stop, max_retries=1, rate_limited=False,
+                                            metrics=metrics)
+        except ConversionCancelled:
+            raise
+        except Exception as e:
+            print(f"Could not create a context cache for {model}: {e}", file=sys.stderr)
+            with self.lock:
+                # Page ranges of one document are refused alike; say so once per model
+                notify = not any(refused_model == model for _, refused_model in self.unsupported)
+                self.unsupported.add(key)
+            if on_notice and notify:
+                on_notice(f"Context caching is not available for this document on {model}; "
+                          f"sending the document with each request.")
+            return None
+        if metrics:
+            metrics.add('context_caches')
+
+        if isinstance(cached.expire_time, datetime):
+            expire_time = cached.expire_time.timestamp()
+        else:
+            expire_time = time.time() + self.ttl
+        with self.lock:
+            # An entry replaced here has expired on the server already
+            self.entries[key] = {'name': cached.name, 'expire_time': expire_time}
+        return cached.name
+
+    def request(self, client, uploaded_file, prompt, model, on_notice=None, should_stop=None, metrics=None):
+        """(contents, config) for a generation over uploaded_file: the prompt against a cached
+        context when one can be had, otherwise the file and the prompt"""
+        cache_name = self.get(client, uploaded_file, model, on_notice=on_notice, should_stop=should_stop,
+                              metrics=metrics)
+        if not cache_name:
+            return [uploaded_file, prompt], None
+        from google.genai import types
+        return [prompt], types.GenerateContentConfig(cached_content=cache_name)
+
+    def clear(self, client):
+        """Delete every cached context created through this instance"""
+        with self.lock:
+            names = [entry['name'] for entry in self.entries.values() if entry['expire_time'] > time.time()]
+            self.entries = {}
+            self.unsupported = set()
+
+        for name in names:
+            try:
+                client.caches.delete(name=name)
+            except Exception as e:
+                # Already expired or deleted on the server side
+                if "404" not in str(e) and "403" not in str(e):
+                    print(f"Error deleting context cache {name}: {e}", file=sys.stderr)
+        return len(names)
+
+class JobMetrics:
+    """Stage timings and counters for one conversion job
+
+    Stages run in worker threads, so durations are summed: parallel chunk uploads can
+    add up to more than the wall-clock time of the job.
+    """
+    STAGE_LABELS = {'preprocess': 'preprocess', 'upload': 'upload', 'generate': 'generate',
+                    'postprocess': 'post-process', 'export': 'export'}
+
+    def __init__(self, kind, source, model=DEFAULT_MODEL):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.source = source
+        self.model = model
+        # Which model produced each part of the text: [{'section', 'model', 'score'}, ...]
+        self.sections = []
+        self.started_at = datetime.now().isoformat(timespec='seconds')
+        self.started = time.monotonic()
+        self.status = None
+        self.from_cache = False
+        self.lock = threading.Lock()
+        self.durations = {}
+        self.counters = {'uploads': 0, 'cached_uploads': 0, 'uploaded_bytes': 0, 'retries': 0,
+                         'rate_limited': 0, 'text_bytes': 0, 'output_bytes': 0, 'input_tokens': 0,
+                         'output_tokens': 0, 'thinking_tokens': 0, 'continuations': 0, 'cached_tokens': 0,
+                         'context_caches': 0, 'local_pages': 0}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_duration(name, time.perf_counter() - started)
+
+    def add_duration(self, name, seconds):
+        with self.lock:
+            self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def add(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def add_section(self, section, model, score=None):
+        with self.lock:
+            self.sections.append({'section': section, 'model': model,
+                                  'score': None if score is None else round(score, 3)})
+
+    def to_record(self):
+        with self.lock:
+            return {
+                'job_id': self.job_id,
+                'kind': self.kind,
+                'source': self.source,
+                'model': self.model,
+                'sections': list(self.sections),
+                'started_at': self.started_at,
+                'status': self.status,
+                'from_cache': self.from_cache,
+                'wall_seconds': round(time.monotonic() - self.started, 3),
+                'stages': {name: round(seconds, 4) for name, seconds in self.durations.items()},
+                'counters': dict(self.counters)
+            }
+
+    def summary(self):
+        """One line for the status label, e.g. 'upload 1.2s, generate 31.0s | 2.1 MB uploaded'"""
+        with self.lock:
+            stages = [f"{label} {self.durations[name]:.1f}s" if self.durations[name] >= 0.1
+                      else f"{label} {self.durations[name] * 1000:.0f}ms"
+                      for name, label in self.STAGE_LABELS.items() if name in self.durations]
+            counters = dict(self.counters)
+            models = {}
+            for section in self.sections:
+                models[section['model']] = models.get(section['model'], 0) + 1
+        parts = [', '.join(stages)] if stages else []
+        if len(models) > 1:
+            parts.append(', '.join(f"{model} x{count}" for model, count in models.items()))
+        elif models:
+            parts.append(next(iter(models)))
+        if counters['local_pages']:
+            parts.append(f"{counters['local_pages']} pages from the text layer")
+        if counters['uploaded_bytes']:
+            parts.append(f"{counters['uploaded_bytes'] / 1024:.0f} KB uploaded")
+        if counters['input_tokens'] or counters['output_tokens']:
+            tokens = (f"{counters['input_tokens'] / 1000:.1f}k tokens in, "
+                      f"{(counters['output_tokens'] + counters['thinking_tokens']) / 1000:.1f}k out")
+            if counters['cached_tokens']:
+                tokens += f" ({counters['cached_tokens'] / 1000:.1f}k of the input from the context cache)"
+            if counters['continuations']:
+                tokens += f" ({counters['continuations']} continuations)"
+            parts.append(tokens)
+        if counters['retries'] or counters['rate_limited']:
+            parts.append(f"{counters['retries']} retries, {counters['rate_limited']} rate-limited")
+        if counters['output_bytes']:
+            parts.append(f"{counters['output_bytes'] / 1024:.0f} KB written")
+        return ' | '.join(parts)
+
+def metrics_stage(metrics, name):
+    """metrics.stage(name), or a no-op when the caller does not collect metrics"""
+    return metrics.stage(name) if metrics else contextlib.nullcontext()
+
+class MetricsRecorder:
+    """Appends job records to metrics.jsonl and keeps a Prometheus text file of totals
+
+    A job may be recorded more than once (the GUI records it again after each export).
+    Every JSON line is a full snapshot; the totals only add what changed since the
+    previous snapshot of the same job. metrics.prom can be read by node_exporter's
+    textfile collector.
+    """
+
+    def __init__(self, metrics_dir=None):
+        self.metrics_dir = metrics_dir or APP_DATA_DIR
+        self.jsonl_path = os.path.join(self.metrics_dir, 'metrics.jsonl')
+        self.prom_path = os.path.join(self.metrics_dir, 'metrics.prom')
+        self.totals_path = os.path.join(self.metrics_dir, 'metrics_totals.json')
+        self.lock = threading.Lock()
+        self.totals = None
+        self.reported = {}
+
+    def load_totals(self):
+        try:
+            if os.path.exists(self.totals_path):
+                with open(self.totals_path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+        except Exception as e:
+            print(f"Error loading metrics totals: {e}", file=sys.stderr)
+        return {'jobs': {}, 'stage_seconds': {}, 'counters': {}}
+
+    def record(self, job):
+        record = job.to_record()
+        with self.lock:
+            try:
+                os.makedirs(self.metrics_dir, exist_ok=True)
+                with open(self.jsonl_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+                if self.totals is None:
+                    self.totals = self.load_totals()
+                previous = self.reported.get(job.job_id, {'stages': {}, 'counters': {}})
+                if job.job_id not in self.reported:
+                    jobs = self.totals['jobs']
+                    jobs[job.kind] = jobs.get(job.kind, 0) + 1
+                for section, totals in (('stages', self.totals['stage_seconds']),
+                                        ('counters', self.totals['counters'])):
+                    for name, value in record[section].items():
+                        totals[name] = totals.get(name, 0) + value - previous[section].get(name, 0)
+                self.reported[job.job_id] = record
+
+                write_json_atomic(self.totals_path, self.totals)
+                temp_path = f"{self.prom_path}.tmp"
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    f.write(self.prometheus_text(record))
+                os.replace(temp_path, self.prom_path)
+            except Exception as e:
+                print(f"Error recording metrics: {e}", file=sys.stderr)
+
+    def prometheus_text(self, last_record):
+        lines = ['# HELP pdf2word_jobs_total Conversion jobs recorded.',
+                 '# TYPE pdf2word_jobs_total counter']
+        lines += [f'pdf2word_jobs_total{{kind="{kind}"}} {count}' for kind, count in sorted(self.totals['jobs'].items())]
+
+        lines += ['# HELP pdf2word_stage_seconds_total Time spent per pipeline stage, summed over workers.',
+                  '# TYPE pdf2word_stage_seconds_total counter']
+        lines += [f'pdf2word_stage_seconds_total{{stage="{stage}"}} {seconds:.4f}'
+                  for stage, seconds in sorted(self.totals['stage_seconds'].items())]
+
+        for name, value in sorted(self.totals['counters'].items()):
+            lines += [f'# TYPE pdf2word_{name}_total counter', f'pdf2word_{name}_total {value}']
+
+        lines += ['# HELP pdf2word_last_job_stage_seconds Stage timings of the most recently recorded job.',
+                  '# TYPE pdf2word_last_job_stage_seconds gauge']
+        lines += [f'pdf2word_last_job_stage_seconds{{stage="{stage}",kind="{last_record["kind"]}"}} {seconds}'
+                  for stage, seconds in sorted(last_record['stages'].items())]
+        lines += ['# TYPE pdf2word_last_job_wall_seconds gauge',
+                  f'pdf2word_last_job_wall_seconds{{kind="{last_record["kind"]}"}} {last_record["wall_seconds"]}']
+        return '\n'.join(lines) + '\n'
+
+metrics_recorder = MetricsRecorder()
+
+def split_pdf_pages(file_path, pages_per_chunk, skip_pages=()):
+    """Split a PDF into in-memory page ranges: [(first_page, last_page, pdf_bytes), ...]
+
+    Pages numbered in skip_pages are left out; a range never spans a skipped page.
+    """
+    from pypdf import PdfReader, PdfWriter
+
+    reader = PdfReader(file_path)
+    wanted = [index for index in range(len(reader.pages)) if index + 1 not in skip_pages]
+    chunks = []
+    start = 0
+    while start < len(wanted):
+        end = start + 1
+        while end < len(wanted) and end - start < pages_per_chunk and wanted[end] == wanted[end - 1] + 1:
+            end += 1
+        writer = PdfWriter()
+        for page_index in wanted[start:end]:
+            writer.add_page(reader.pages[page_index])
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        # Page numbers are 1-based and inclusive
+        chunks.append((wanted[start] + 1, wanted[end - 1] + 1, buffer.getvalue()))
+        start = end
+    return chunks
+
+def page_runs(pages):
+    """Consecutive runs in a collection of page numbers: [(first_page, last_page), ...]"""
+    runs = []
+    for page in sorted(pages):
+        if runs and runs[-1][1] == page - 1:
+            runs[-1][1] = page
+        else:
+            runs.append([page, page])
+    return [tuple(run) for run in runs]
+
+def text_layer_requests(page_count, local_pages, pages_per_chunk=None):
+    """Requests a PDF takes with its text-layer pages left out, and without: (with, without)
+
+    Without pages_per_chunk the document is one request; left-out pages only keep it at
+    one if the model pages form a single run. With it, each run splits into its own ranges.
+    """
+    model_runs = page_runs(page for page in range(1, page_count + 1) if page not in local_pages)
+    if pages_per_chunk:
+        return (sum(-(-(last - first + 1) // pages_per_chunk) for first, last in model_runs),
+                -(-page_count // pages_per_chunk))
+    return len(model_runs), 1
+
+def plan_text_layer(file_path, page_count, pages_per_chunk=None, on_notice=None, pages=None):
+    """Text-layer pages worth converting locally: all of extract_text_layer_pages, or none
+    when leaving them out would take more requests than sending every page"""
+    local_pages = extract_text_layer_pages(file_path, pages)
+    if not local_pages:
+        return {}
+    requests, baseline = text_layer_requests(page_count, local_pages, pages_per_chunk)
+    if requests > baseline:
+        if on_notice:
+            on_notice(f"{len(local_pages)} pages have a clean text layer, but leaving them out would take "
+                      f"{requests} requests instead of {baseline}; sending every page to the model.")
+        return {}
+    return local_pages
+
+def record_text_layer(local_pages, model_pages, on_notice=None, metrics=None):
+    if on_notice:
+        on_notice(f"{len(local_pages)} pages taken from the PDF's text layer, "
+                  f"{model_pages} pages sent to the model.")
+    if metrics:
+        metrics.add('local_pages', len(local_pages))
+        for first, last in page_runs(local_pages):
+            metrics.add_section(f"pages {first}-{last}", TEXT_LAYER_SECTION)
+
+def merge_page_texts(pieces):
+    """Join [(first page, text), ...] in page order"""
+    return "\n\n".join(text.strip() for _, text in sorted(pieces))
+
+JOURNAL_DIR = os.path.join(APP_DATA_DIR, 'journal')
+# Journals of conversions nobody resumed are removed after this long
+JOURNAL_MAX_AGE_DAYS = 14
+# PDFs with at least this many pages are always converted as checkpointed page ranges
+LONG_DOCUMENT_PAGES = 40
+DEFAULT_CHUNK_SETTINGS = {'pages_per_chunk': 10, 'max_workers': 4}
+
+class ConversionJournal:
+    """On-disk checkpoint of a page-range conversion
+
+    Keyed by the result cache key, so the same file, prompt and model find the same
+    journal. The manifest lists the page ranges; every finished range's raw model output
+    is written to its own file as soon as it arrives. A rerun skips the ranges already
+    on disk, and the journal is discarded once the whole text has been assembled.
+    """
+
+    cleaned_up = False
+
+    def __init__(self, key, journal_dir=None):
+        self.root_dir = journal_dir or JOURNAL_DIR
+        self.dir = os.path.join(self.root_dir, key)
+        self.manifest_path = os.path.join(self.dir, 'manifest.json')
+        self.lock = threading.Lock()
+        if not ConversionJournal.cleaned_up:
+            ConversionJournal.cleaned_up = True
+            self.remove_stale()
+
+    def unit_path(self, first_page, last_page):
+        return os.path.join(self.dir, f"{first_page}-{last_page}.json")
+
+    def open(self, units, source=""):
+        """Start or resume a journal for units [(first_page, last_page), ...]; returns
+        {(first_page, last_page): {'text', 'model'}} for the units already converted"""
+        units = [list(unit) for unit in units]
+        manifest = None
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            pass
+        if manifest is None or manifest.get('units') != units:
+            # Different page ranges (or no journal yet): start over
+            self.discard()
+            write_json_atomic(self.manifest_path, {'units': units, 'source': source, 'created': time.time()})
+            return {}
+
+        completed = {}
+        for first_page, last_page in units:
+            try:
+                with open(self.unit_path(first_page, last_page), 'r', encoding='utf-8') as f:
+                    completed[(first_page, last_page)] = json.load(f)
+            except (OSError, ValueError):
+                pass
+        return completed
+
+    def record(self, first_page, last_page, text, model=None):
+        path = self.unit_path(first_page, last_page)
+        with self.lock:
+            with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+                json.dump({'text': text, 'model': model}, f, ensure_ascii=False)
+            os.replace(f"{path}.tmp", path)
+            # The manifest's mtime marks the journal as recently used
+            os.utime(self.manifest_path)
+
+    def discard(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def remove_stale(self):
+        cutoff = time.time() - JOURNAL_MAX_AGE_DAYS * 86400
+        try:
+            names = os.listdir(self.root_dir)
+        except OSError:
+            return
+        for name in names:
+            manifest_path = os.path.join(self.root_dir, name, 'manifest.json')
+            try:
+                stale = os.path.getmtime(manifest_path) < cutoff
+            except OSError:
+                stale = True
+            if stale:
+                shutil.rmtree(os.path.join(self.root_dir, name), ignore_errors=True)
+
+# Characters that only show up in text when a page has formulas
+MATH_TEXT_PATTERN = re.compile(r'[=+−×÷±∑∏∫√∞≤≥≠≈∂∇∈∉⊂⊆∪∩→⇒⇔∀∃°^_αβγδεζηθλμνξπρστφχψωΔΘΛΞΠΣΦΨΩ]')
+# Faces that only typeset formulas; Cambria and Symbol are left out, Word uses them for body text and bullets
+MATH_FONT_PATTERN = re.compile(r'CMMI|CMSY|CMEX|MSAM|MSBM|STIX\w*Math|Cambria[ -]?Math|LatinModernMath|XITSMath',
+                               re.IGNORECASE)
+# Pages with less extractable text than this are scans or figures and cannot be judged locally
+MIN_TEXT_LAYER_CHARS = 40
+ROUTER_THRESHOLD = 0.5
+
+def read_pdf_pages(file_path):
+    """Text layer, math fonts, images and area of every page of a PDF
+
+    Text extraction is the slow part of judging a page locally, so the router and the
+    text-layer pre-pass share one read: [{'text', 'math_fonts', 'images', 'area'}, ...]
+    """
+    from pypdf import PdfReader
+
+    pages = []
+    for page in PdfReader(file_path).pages:
+        try:
+            text = page.extract_text() or ""
+        except Exception:
+            text = ""
+        pages.append({'text': text, 'math_fonts': uses_math_fonts(page), 'images': page_has_images(page),
+                      'area': float(page.mediabox.width) * float(page.mediabox.height) or 1.0})
+    return pages
+
+def score_pdf_pages(file_path, pages=None):
+    """Complexity score in [0, 1] for every page of a PDF, from its text layer
+
+    Formula symbols, math fonts and dense text raise the score; pages without a text
+    layer score 1.0 because nothing can be told about them without the model. pages is
+    the result of read_pdf_pages when the caller already has it.
+    """
+    scores = []
+    for page in read_pdf_pages(file_path) if pages is None else pages:
+        text = page['text']
+        chars = len(''.join(text.split()))
+        if chars < MIN_TEXT_LAYER_CHARS:
+            scores.append(1.0)
+            continue
+
+        math_ratio = len(MATH_TEXT_PATTERN.findall(text)) / chars
+        score = min(1.0, math_ratio * 10)
+        if page['math_fonts']:
+            score = max(score, 0.8)
+        # Very dense pages (small print, tables) gain a little: more room for mistakes
+        density = chars / (page['area'] / 10000)
+        score = min(1.0, score + min(0.2, density / 200))
+        scores.append(score)
+    return scores
+
+def uses_math_fonts(page):
+    try:
+        fonts = page['/Resources'].get_object().get('/Font', {}).get_object()
+        font_names = [str(font.get_object().get('/BaseFont', '')) for font in fonts.values()]
+    except Exception:
+        font_names = []
+    return any(MATH_FONT_PATTERN.search(name) for name in font_names)
+
+def page_has_images(page):
+    try:
+        xobjects = page['/Resources'].get_object().get('/XObject', {}).get_object()
+        return any(xobject.get_object().get('/Subtype') == '/Image' for xobject in xobjects.values())
+    except Exception:
+        return False
+
+# A page is taken from its text layer only with fewer formula symbols than this per character
+TEXT_LAYER_MAX_MATH_RATIO = 0.005
+# Garbled encodings (custom font maps, lost spacing) show up as few letters or very long "words"
+TEXT_LAYER_MIN_LETTER_RATIO = 0.6
+TEXT_LAYER_MAX_WORD_LENGTH = 15
+TEXT_LAYER_MAX_BAD_RATIO = 0.01
+# Shown as the model of text-layer pages in job sections
+TEXT_LAYER_SECTION = "text layer"
+TEXT_LAYER_BULLET = re.compile(r'[•●▪◦‣∙·*-]\s+')
+TEXT_LAYER_ORDERED = re.compile(r'(?:\d{1,3}|[a-z])[.)]\s')
+
+def text_layer_is_clean(text):
+    """Whether extracted page text can stand in for the model's transcription"""
+    chars = ''.join(text.split())
+    if len(chars) < MIN_TEXT_LAYER_CHARS or '$' in chars:
+        # Too little to judge, or a '$' that would be read as a formula delimiter
+        return False
+    if len(MATH_TEXT_PATTERN.findall(chars)) / len(chars) > TEXT_LAYER_MAX_MATH_RATIO:
+        return False
+    if sum(char.isalpha() for char in chars) / len(chars) < TEXT_LAYER_MIN_LETTER_RATIO:
+        return False
+    if len(chars) / len(text.split()) > TEXT_LAYER_MAX_WORD_LENGTH:
+        return False
+    bad = sum(1 for char in chars if char == '\ufffd' or unicodedata.category(char) in ('Co', 'Cn', 'Cc'))
+    return bad / len(chars) <= TEXT_LAYER_MAX_BAD_RATIO
+
+def text_layer_markdown(text):
+    """Rebuild paragraphs from a page's extracted lines
+
+    Lines of one paragraph are joined, words hyphenated across a line break are
+    rejoined, and a line noticeably shorter than a full line ends its paragraph.
+    Bullet glyphs become Markdown bullets.
+    """
+    lines = [line.strip() for line in text.splitlines()]
+    widths = sorted(len(line) for line in lines if line)
+    full_width = widths[len(widths) * 3 // 4] if widths else 0
+    paragraphs = []
+    current = ""
+    for line in lines:
+        if not line:
+            if current:
+                paragraphs.append(current)
+                current = ""
+            continue
+        bullet = TEXT_LAYER_BULLET.match(line)
+        if bullet or TEXT_LAYER_ORDERED.match(line):
+            if current:
+                paragraphs.append(current)
+            current = f"- {line[bullet.end():]}" if bullet else line
+        elif not current:
+            current = line
+        elif current.endswith('-') and current[-2:-1].isalpha() and line[0].islower():
+            current = current[:-1] + line
+        else:
+            current = f"{current} {line}"
+        if len(line) < full_width * 0.75:
+            paragraphs.append(current)
+            current = ""
+    if current:
+        paragraphs.append(current)
+    return "\n\n".join(paragraphs)
+
+def extract_text_layer_pages(file_path, pages=None):
+    """Pages of a PDF that can be converted from their embedded text: {page number: Markdown}
+
+    A page qualifies when its text layer is substantial and decodes to real words, it has
+    next to no formula symbols and no math fonts, and it holds no images (a scan with an
+    OCR layer, or figures whose text the layer misses). Every other page needs the model.
+    pages is the result of read_pdf_pages when the caller already has it.
+    """
+    if pages is None:
+        try:
+            pages = read_pdf_pages(file_path)
+        except Exception as e:
+            print(f"Could not read the text layer of {file_path}: {e}", file=sys.stderr)
+            return {}
+    return {number: text_layer_markdown(page['text']) for number, page in enumerate(pages, 1)
+            if text_layer_is_clean(page['text']) and not page['math_fonts'] and not page['images']}
+
+def score_image(image_path):
+    """Complexity score in [0, 1] for an image from grey-level entropy and edge density
+
+    Clean printed text is mostly paper with thin strokes, so it scores low; photos,
+    handwriting and dense notation have more grey levels and fine structure.
+    """
+    import math
+    from PIL import Image, ImageFilter, ImageStat
+
+    with Image.open(image_path) as image:
+        gray = image.convert('L')
+        gray.thumbnail((512, 512))
+        histogram = gray.histogram()
+        total = sum(histogram) or 1
+        entropy = -sum(count / total * math.log2(count / total) for count in histogram if count)
+        edges = ImageStat.Stat(gray.filter(ImageFilter.FIND_EDGES)).mean[0] / 255
+    entropy_score = min(1.0, max(0.0, (entropy - 2.0) / 4.0))
+    edge_score = min(1.0, edges / 0.15)
+    return 0.6 * entropy_score + 0.4 * edge_score
+
+def route_model(model, scores):
+    """Model for a section: the configured one, or under 'auto' the tier its hardest page needs.
+    Returns (model, score or None)"""
+    if model != AUTO_MODEL:
+        return model, None
+    score = max(scores) if scores else 1.0
+    return (ROUTER_STRONG_MODEL if score >= ROUTER_THRESHOLD else ROUTER_FAST_MODEL), score
+
+def route_pdf(model, file_path, scores=None, first_page=1, last_page=None):
+    """route_model for a PDF or a range of its pages; scores the pages only when routing is automatic"""
+    if model != AUTO_MODEL:
+        return model, None
+    if scores is None:
+        try:
+            scores = score_pdf_pages(file_path)
+        except Exception as e:
+            logger.debug("Could not score %s, using the strong model: %s", file_path, e)
+            scores = []
+    return route_model(model, scores[first_page - 1:last_page])
+
+def route_images(model, image_paths):
+    if model != AUTO_MODEL:
+        return model, None
+    scores = []
+    for path in image_paths:
+        try:
+            scores.append(score_image(path))
+        except Exception as e:
+            logger.debug("Could not score %s, using the strong model: %s", path, e)
+            scores.append(1.0)
+    return route_model(model, scores)
+
+def pdf_page_count(file_path):
+    """Number of pages in a PDF, or 0 if it cannot be read"""
+    try:
+        from pypdf import PdfReader
+        return len(PdfReader(file_path).pages)
+    except Exception as e:
+        print(f"Could not read page count: {e}", file=sys.stderr)
+        return 0
+
+PDF_PROMPT = """
+        Hãy nhận diện và gõ lại [CHÍNH XÁC] toàn bộ nội dung PDF thành văn bản, bao gồm tất cả công thức Toán học được bọc trong dấu $.
+
+        [YÊU CẦU NGHIÊM NGẶT]:
+        - CHỈ gõ lại nội dung có trong PDF
+        - KHÔNG thêm bất kỳ nội dung nào khác
+        - Giữ nguyên cấu trúc và định dạng của văn bản gốc, bỏ qua phần hình vẽ trong PDF
+        - [Bắt buộc] tất cả công thức toán học viết dưới dạng LaTeX được bọc trong dấu $
+        """
+
+def build_image_prompt(image_count):
+    return f"""
+            Hãy nhận diện và gõ lại [CHÍNH XÁC] toàn bộ nội dung trong {image_count} hình ảnh thành văn bản, bao gồm tất cả công thức Toán học được bọc trong dấu $.
+
+            [QUY TẮC NGHIÊM NGẶT]:
+            - CHỈ gõ lại nội dung có trong hình ảnh
+            - KHÔNG thêm bất kỳ nội dung nào khác
+            - Giữ nguyên cấu trúc và định dạng của văn bản gốc, bỏ qua phần hình vẽ trong PDF
+            - [Bắt buộc] tất cả công thức toán học viết dưới dạng LaTeX được bọc trong dấu $
+
+            """
+
+def retry_notice(error, delay, throttled, where=""):
+    reason = "Rate limit exceeded" if throttled else f"Request failed ({error})"
+    location = f" on {where}" if where else ""
+    return f"{reason}{location}. Retrying in {delay:.0f} seconds..."
+
+def upload_file(client, file, upload_cache=None, mime_type=None, display_name=None, digest=None,
+                on_notice=None, should_stop=None, max_retries=None, metrics=None):
+    """Upload a path or bytes through the scheduler, reusing cached handles when a cache is given"""
+    def on_retry(error, delay, throttled):
+        if on_notice:
+            on_notice(retry_notice(error, delay, throttled, display_name or ""))
+
+    def do_upload():
+        if upload_cache:
+            return upload_cache.upload(client, file, mime_type=mime_type, display_name=display_name,
+                                       digest=digest, metrics=metrics)
+        config = {}
+        if mime_type:
+            config['mime_type'] = mime_type
+        if display_name:
+            config['display_name'] = display_name
+        source = io.BytesIO(file) if isinstance(file, (bytes, bytearray)) else file
+        uploaded_file = client.files.upload(file=source, config=config or None)
+        if metrics:
+            metrics.add('uploads')
+            metrics.add('uploaded_bytes', len(file) if isinstance(file, (bytes, bytearray)) else os.path.getsize(file))
+        return uploaded_file
+
+    with metrics_stage(metrics, 'upload'):
+        return api_scheduler.call(do_upload, on_retry=on_retry, should_stop=should_stop,
+                                  max_retries=max_retries, rate_limited=False, metrics=metrics)
+
+def convert_pdf_chunks(client, file_path, prompt, pages_per_chunk=10, max_workers=4, upload_cache=None,
+                       on_progress=None, on_notice=None, should_stop=None, metrics=None, journal_key=None,
+                       model=DEFAULT_MODEL, local_pages=None, page_scores=None, context_cache=None):
+    """Convert a PDF as page ranges through a bounded worker pool; returns the text in page order
+
+    With a journal_key every finished range is checkpointed, and a rerun after a crash,
+    failure or cancel only converts the ranges that are missing. With model 'auto' each
+    range goes to the model its most complex page needs (page_scores, when already known).
+    local_pages maps page numbers already converted from the text layer to their text;
+    only the other pages are sent. With a context_cache, each range runs against a cached
+    context of its upload, which a repeat pass over the same ranges reuses.
+    """
+    local_pages = local_pages or {}
+    try:
+        chunks = split_pdf_pages(file_path, pages_per_chunk, skip_pages=local_pages)
+    except Exception as e:
+        raise RuntimeError(f"Failed to split PDF: {str(e)}")
+
+    if not chunks and not local_pages:
+        raise RuntimeError("The PDF has no pages.")
+
+    if local_pages:
+        record_text_layer(local_pages, sum(last - first + 1 for first, last, _ in chunks), on_notice, metrics)
+
+    journal = ConversionJournal(journal_key) if journal_key and chunks else None
+    completed_units = journal.open([(first, last) for first, last, _ in chunks], file_path) if journal else {}
+    if completed_units and on_notice:
+        on_notice(f"Resuming from checkpoint: {len(completed_units)} of {len(chunks)} page ranges "
+                  f"already converted")
+
+    if model == AUTO_MODEL and page_scores is None:
+        try:
+            page_scores = score_pdf_pages(file_path)
+        except Exception as e:
+            logger.debug("Could not score %s, using the strong model: %s", file_path, e)
+
+    # Cancelled with the job, or when one chunk fails so the other chunks bail out early
+    stopped = CancelToken(parent=should_stop)
+
+    def convert_chunk(first_page, last_page, pdf_bytes):
+        where = f"pages {first_page}-{last_page}"
+        chunk_model, score = route_model(model, page_scores[first_page - 1:last_page] if page_scores else [])
+        try:
+            uploaded_file = upload_file(client, pdf_bytes, upload_cache, mime_type='application/pdf',
+                                        display_name=f"pages_{first_page}-{last_page}.pdf",
+                                        on_notice=on_notice, should_stop=stopped, metrics=metrics)
+            contents, config = [uploaded_file, prompt], None
+            if context_cache:
+                contents, config = context_cache.request(client, uploaded_file, prompt, chunk_model,
+                                                         on_notice=on_notice, should_stop=stopped, metrics=metrics)
+            text = generate_text(client, contents, model=chunk_model, stream=False, on_notice=on_notice,
+                                 should_stop=stopped, metrics=metrics, where=where, config=config)
+            if journal:
+                journal.record(first_page, last_page, text, chunk_model)
+            if metrics:
+                metrics.add_section(where, chunk_model, score)
+            return text
+
+        except ConversionCancelled:
+            raise
+        except Exception as e:
+            raise RuntimeError(f"Pages {first_page}-{last_page}: {str(e)}")
+
+    results = [completed_units[(first, last)]['text'] if (first, last) in completed_units else None
+               for first, last, _ in chunks]
+    if metrics:
+        for (first, last), unit in sorted(completed_units.items()):
+            metrics.add_section(f"pages {first}-{last}", unit.get('model') or model)
+    # Progress counts pages, so text-layer pages and resumed ranges start out done
+    total_pages = len(local_pages) + sum(last - first + 1 for first, last, _ in chunks)
+    completed = len(local_pages) + sum(last - first + 1 for first, last in completed_units)
+    if on_progress:
+        on_progress(int(completed * 100 / total_pages))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(convert_chunk, first, last, data): index
+                   for index, (first, last, data) in enumerate(chunks) if results[index] is None}
+        try:
+            for future in as_completed(futures):
+                index = futures[future]
+                results[index] = future.result()
+                completed += chunks[index][1] - chunks[index][0] + 1
+                if on_progress:
+                    on_progress(int(completed * 100 / total_pages))
+        except Exception:
+            stopped.cancel()
+            for pending in futures:
+                pending.cancel()
+            raise
+
+    text = merge_page_texts([(first, text) for (first, _, _), text in zip(chunks, results)]
+                            + list(local_pages.items()))
+    if journal:
+        journal.discard()
+    return text
+
+def convert_pdf(client, file_path, prompt, upload_cache=None, chunk_settings=None,
+                on_chunk=None, on_progress=None, on_notice=None, should_stop=None, metrics=None,
+                journal_key=None, model=DEFAULT_MODEL, uploaded_file=None, context_cache=None, text_layer=False,
+                on_reset=None):
+    """Convert a PDF to raw model text, either in one streamed request or as parallel page chunks
+
+    A single request that the token preflight says will not fit is converted as page
+    ranges instead. uploaded_file skips the upload when the caller already has a handle.
+    With a context_cache, requests run against cached contexts of what they upload.
+    With text_layer, pages with a clean embedded text layer are converted locally as long
+    as that does not take more requests than sending every page (see plan_text_layer).
+    """
+    pages = pdf_page_count(file_path) if file_path else 0
+    page_info = None
+    if pages and (text_layer or model == AUTO_MODEL):
+        # One text extraction serves both the text-layer plan and the router
+        try:
+            page_info = read_pdf_pages(file_path)
+        except Exception as e:
+            logger.debug("Could not read the pages of %s: %s", file_path, e)
+    page_scores = score_pdf_pages(file_path, page_info) if page_info and model == AUTO_MODEL else None
+    local_pages = {}
+    if text_layer and page_info:
+        local_pages = plan_text_layer(file_path, pages, chunk_settings and chunk_settings['pages_per_chunk'],
+                                      on_notice=on_notice, pages=page_info)
+    if chunk_settings or (local_pages and len(local_pages) == pages):
+        return convert_pdf_chunks(client, file_path, prompt, upload_cache=upload_cache,
+                                  on_progress=on_progress, on_notice=on_notice, should_stop=should_stop,
+                                  metrics=metrics, journal_key=journal_key, model=model, local_pages=local_pages,
+                                  page_scores=page_scores, context_cache=context_cache,
+                                  **(chunk_settings or DEFAULT_CHUNK_SETTINGS))
+
+    # One streamed request: the whole document, or the single run of pages the text layer leaves
+    first_page, last_page = 1, pages
+    where = "all pages"
+    if local_pages:
+        (first_page, last_page), = page_runs(page for page in range(1, pages + 1) if page not in local_pages)
+        where = f"pages {first_page}-{last_page}"
+        _, _, pdf_bytes = split_pdf_pages(file_path, pages, skip_pages=local_pages)[0]
+        uploaded_file = upload_file(client, pdf_bytes, upload_cache, mime_type='application/pdf',
+                                    display_name=f"pages_{first_page}-{last_page}.pdf", on_notice=on_notice,
+                                    should_stop=should_stop, metrics=metrics)
+    elif uploaded_file is None:
+        uploaded_file = upload_file(client, file_path, upload_cache, on_notice=on_notice, should_stop=should_stop,
+                                    metrics=metrics)
+    routed_model, score = route_pdf(model, file_path, scores=page_scores, first_page=first_page,
+                                    last_page=last_page)
+
+    if pages:
+        request_pages = last_page - first_page + 1
+        fit = preflight(client, [uploaded_file, prompt], routed_model, request_pages, should_stop)
+        if fit < request_pages:
+            pages_per_chunk = min(fit, DEFAULT_CHUNK_SETTINGS['pages_per_chunk'])
+            if on_notice:
+                on_notice(f"{request_pages} pages will not fit in one response of {routed_model}; "
+                          f"converting in ranges of {pages_per_chunk} pages.")
+            return convert_pdf_chunks(client, file_path, prompt, pages_per_chunk=pages_per_chunk,
+                                      max_workers=DEFAULT_CHUNK_SETTINGS['max_workers'], upload_cache=upload_cache,
+                                      on_progress=on_progress, on_notice=on_notice, should_stop=should_stop,
+                                      metrics=metrics, journal_key=journal_key, model=model,
+                                      local_pages=local_pages, page_scores=page_scores, context_cache=context_cache)
+
+    if local_pages:
+        record_text_layer(local_pages, last_page - first_page + 1, on_notice, metrics)
+    if metrics:
+        metrics.add_section(where, routed_model, score)
+    contents, config = [uploaded_file, prompt], None
+    if context_cache:
+        contents, config = context_cache.request(client, uploaded_file, prompt, routed_model, on_notice=on_notice,
+                                                 should_stop=should_stop, metrics=metrics)
+    text = generate_text(client, contents, model=routed_model, on_chunk=on_chunk, on_notice=on_notice,
+                         should_stop=should_stop, metrics=metrics, config=config, on_reset=on_reset)
+    return merge_page_texts([(first_page, text)] + list(local_pages.items())) if local_pages else text
+
+# Images up to this size travel inside the generation request instead of the Files API
+INLINE_IMAGE_MAX_BYTES = 1024 * 1024
+# Gemini rejects requests above 20 MB; inline data is base64 encoded inside it
+INLINE_REQUEST_LIMIT = 20 * 1024 * 1024
+INLINE_MIME_TYPES = ('image/png', 'image/jpeg', 'image/webp', 'image/heic', 'image/heif')
+
+class InlineBudget:
+    """Greedy per-request allocator deciding which images are sent inline as bytes parts"""
+
+    def __init__(self, reserved_bytes=0, max_image_bytes=INLINE_IMAGE_MAX_BYTES,
+                 request_limit=INLINE_REQUEST_LIMIT):
+        self.max_image_bytes = max_image_bytes
+        # Keep headroom for the prompt and the JSON envelope
+        self.remaining = request_limit - reserved_bytes - 64 * 1024
+
+    def reserve(self, size):
+        self.remaining -= (size + 2) // 3 * 4
+
+    def try_inline(self, path):
+        """Return an inline Part for path if it fits the policy, otherwise None"""
+        mime_type = mimetypes.guess_type(path)[0]
+        if mime_type not in INLINE_MIME_TYPES:
+            return None
+        size = os.path.getsize(path)
+        encoded_size = (size + 2) // 3 * 4
+        if size > self.max_image_bytes or encoded_size > self.remaining:
+            return None
+
+        from google.genai import types
+        with open(path, 'rb') as f:
+            part = types.Part.from_bytes(data=f.read(), mime_type=mime_type)
+        self.remaining -= encoded_size
+        return part
+
+PREPROCESS_DIR = os.path.join(tempfile.gettempdir(), 'pdf2word_preprocessed')
+PREPROCESS_EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp', 'PNG': '.png'}
+
+def preprocess_image(source_path, output_dir, max_edge=2048, grayscale=False, image_format='JPEG', quality=85):
+    """Downscale, optionally grayscale, strip metadata and re-encode one image
+
+    Runs in a worker process. Returns the path to upload plus the byte counts; the
+    original is kept when re-encoding would not make it smaller.
+    """
+    from PIL import Image, ImageOps
+
+    original_bytes = os.path.getsize(source_path)
+    variant = f"{max_edge}_{'gray' if grayscale else 'color'}_{quality}"
+    output_path = os.path.join(output_dir, f"{file_sha256(source_path)[:24]}_{variant}"
+                                           f"{PREPROCESS_EXTENSIONS[image_format]}")
+
+    if not os.path.exists(output_path):
+        with Image.open(source_path) as source:
+            # Apply EXIF orientation before the metadata is dropped
+            img = ImageOps.exif_transpose(source)
+            if grayscale:
+                img = img.convert('L')
+            elif img.mode in ('RGBA', 'LA', 'P') and image_format == 'JPEG':
+                background = Image.new('RGB', img.size, (255, 255, 255))
+                rgba = img.convert('RGBA')
+                background.paste(rgba, mask=rgba.getchannel('A'))
+                img = background
+            elif img.mode not in ('RGB', 'L', 'RGBA'):
+                img = img.convert('RGB')
+            img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+            # No EXIF, ICC profile or text chunks in the output
+            img.info = {}
+
+            temp_path = f"{output_path}.{os.getpid()}.tmp"
+            img.save(temp_path, format=image_format, quality=quality, optimize=True)
+            os.replace(temp_path, output_path)
+
+    processed_bytes = os.path.getsize(output_path)
+    if processed_bytes >= original_bytes:
+        return {'source': source_path, 'path': source_path,
+                'original_bytes': original_bytes, 'processed_bytes': original_bytes}
+    return {'source': source_path, 'path': output_path,
+            'original_bytes': original_bytes, 'processed_bytes': processed_bytes}
+
+def preprocess_images(image_paths, settings, max_workers=None):
+    """Preprocess images in a process pool, yielding (index, result, error) as each one finishes"""
+    os.makedirs(PREPROCESS_DIR, exist_ok=True)
+    # spawn keeps worker start-up identical on Windows and inside the Qt process
+    context = multiprocessing.get_context('spawn')
+    workers = max_workers or min(len(image_paths), os.cpu_count() or 1) or 1
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+    try:
+        futures = {pool.submit(preprocess_image, path, PREPROCESS_DIR, **settings): index
+                   for index, path in enumerate(image_paths)}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
+    finally:
+        # A cancelled job closes the generator early; drop queued images instead of waiting
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def describe_preprocess(result):
+    saved = result['original_bytes'] - result['processed_bytes']
+    percent = saved * 100 / result['original_bytes'] if result['original_bytes'] else 0
+    return (f"optimized {result['original_bytes'] / 1024:.0f} KB -> {result['processed_bytes'] / 1024:.0f} KB "
+            f"(saved {saved / 1024:.0f} KB, {percent:.0f}%)")
+
+def preprocess_variant(settings):
+    """Result-cache variant for images sent preprocessed with settings; "" for the originals"""
+    if not settings:
+        return ""
+    # Spelled out with preprocess_image's defaults so omitted and explicit settings share a key
+    settings = dict({'max_edge': 2048, 'grayscale': False, 'image_format': 'JPEG', 'quality': 85}, **settings)
+    return "preprocess " + " ".join(f"{name}={settings[name]}" for name in sorted(settings))
+
+def convert_images(client, image_paths, prompt, upload_cache=None, max_workers=4, preprocess_settings=None,
+                   inline_small_images=True, on_chunk=None, on_notice=None, should_stop=None, metrics=None,
+                   model=DEFAULT_MODEL):
+    """Upload images concurrently and convert them to raw model text in one request"""
+    # Routed on the originals: preprocessing changes exactly what the score looks at
+    model, score = route_images(model, image_paths)
+    if metrics:
+        metrics.add_section("all images", model, score)
+    if preprocess_settings:
+        image_paths = list(image_paths)
+        with metrics_stage(metrics, 'preprocess'), \
+                contextlib.closing(preprocess_images(image_paths, preprocess_settings)) as results:
+            for index, result, error in results:
+                if should_stop and should_stop():
+                    raise ConversionCancelled()
+                if error is not None:
+                    if on_notice:
+                        on_notice(f"Preprocessing {os.path.basename(image_paths[index])} failed, "
+                                  f"uploading original: {error}")
+                    continue
+                if on_notice:
+                    on_notice(f"{os.path.basename(image_paths[index])}: {describe_preprocess(result)}")
+                image_paths[index] = result['path']
+
+    budget = InlineBudget(reserved_bytes=len(prompt.encode('utf-8'))) if inline_small_images else None
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        parts = []
+        for path in image_paths:
+            part = budget.try_inline(path) if budget else None
+            if part is None:
+                part = executor.submit(upload_file, client, path, upload_cache,
+                                       on_notice=on_notice, should_stop=should_stop, metrics=metrics)
+            parts.append(part)
+        uploaded_files = [part.result() if hasattr(part, 'result') else part for part in parts]
+    return generate_image_text(client, uploaded_files, prompt, model=model, on_chunk=on_chunk,
+                               on_notice=on_notice, should_stop=should_stop, metrics=metrics)
+
+def generate_image_text(client, image_parts, prompt, model=DEFAULT_MODEL, on_chunk=None, on_notice=None,
+                        should_stop=None, metrics=None, on_reset=None):
+    """Convert uploaded or inline image parts in one request, or in consecutive batches
+    when the token preflight says the output will not fit in one response"""
+    fit = preflight(client, image_parts + [prompt], model, len(image_parts), should_stop)
+    if fit >= len(image_parts):
+        return generate_text(client, image_parts + [prompt], model=model, on_chunk=on_chunk,
+                             on_notice=on_notice, should_stop=should_stop, metrics=metrics, on_reset=on_reset)
+
+    if on_notice:
+        on_notice(f"{len(image_parts)} images will not fit in one response of {model}; "
+                  f"converting in batches of {fit}.")
+    texts = []
+    received_offset = 0
+    for start in range(0, len(image_parts), fit):
+        batch = image_parts[start:start + fit]
+
+        def on_batch_chunk(piece, received_bytes):
+            on_chunk(piece, received_offset + received_bytes)
+
+        text = generate_text(client, batch + [build_image_prompt(len(batch))], model=model,
+                             on_chunk=on_batch_chunk if on_chunk else None, on_notice=on_notice,
+                             should_stop=should_stop, metrics=metrics, on_reset=on_reset,
+                             where=f"images {start + 1}-{start + len(batch)}")
+        received_offset += len(text.encode('utf-8'))
+        texts.append(text.strip())
+    return "\n\n".join(texts)
+
+# Unicode characters the model emits inside $...$, mapped to LaTeX
+MATH_SYMBOLS = {
+    # Greek letters
+    'α': r'\alpha', 'β': r'\beta', 'γ': r'\gamma', 'δ': r'\delta', 'ε': r'\varepsilon', 'ϵ': r'\epsilon',
+    'ζ': r'\zeta', 'η': r'\eta', 'θ': r'\theta', 'ϑ': r'\vartheta', 'ι': r'\iota', 'κ': r'\kappa',
+    'λ': r'\lambda', 'μ': r'\mu', 'ν': r'\nu', 'ξ': r'\xi', 'π': r'\pi', 'ϖ': r'\varpi', 'ρ': r'\rho',
+    'ϱ': r'\varrho', 'σ': r'\sigma', 'ς': r'\varsigma', 'τ': r'\tau', 'υ': r'\upsilon', 'φ': r'\varphi',
+    'ϕ': r'\phi', 'χ': r'\chi', 'ψ': r'\psi', 'ω': r'\omega',
+    'Γ': r'\Gamma', 'Δ': r'\Delta', 'Θ': r'\Theta', 'Λ': r'\Lambda', 'Ξ': r'\Xi', 'Π': r'\Pi',
+    'Σ': r'\Sigma', 'Υ': r'\Upsilon', 'Φ': r'\Phi', 'Ψ': r'\Psi', 'Ω': r'\Omega',
+    # Relations and operators
+    '≠': r'\neq', '≤': r'\leq', '≥': r'\geq', '⩽': r'\leqslant', '⩾': r'\geqslant', '≪': r'\ll', '≫': r'\gg',
+    '±': r'\pm', '∓': r'\mp', '×': r'\times', '÷': r'\div', '·': r'\cdot', '⋅': r'\cdot', '∘': r'\circ',
+    '≈': r'\approx', '≃': r'\simeq', '≅': r'\cong', '≡': r'\equiv', '∼': r'\sim', '∝': r'\propto',
+    '∈': r'\in', '∉': r'\notin', '∋': r'\ni', '⊂': r'\subset', '⊃': r'\supset', '⊆': r'\subseteq',
+    '⊇': r'\supseteq', '⊄': r'\not\subset', '∪': r'\cup', '∩': r'\cap', '∖': r'\setminus', '∅': r'\emptyset',
+    '∀': r'\forall', '∃': r'\exists', '∄': r'\nexists', '¬': r'\neg', '∧': r'\wedge', '∨': r'\vee',
+    '∂': r'\partial', '∇': r'\nabla', '∞': r'\infty', '∑': r'\sum', '∏': r'\prod', '∫': r'\int',
+    '∬': r'\iint', '∭': r'\iiint', '∮': r'\oint', '∠': r'\angle', '⊥': r'\perp', '∥': r'\parallel',
+    '△': r'\triangle', '°': r'^{\circ}', '…': r'\ldots', '⋯': r'\cdots', '⋮': r'\vdots', '⋱': r'\ddots',
+    '′': "'", '″': "''", '−': '-', '–': '-', '∣': r'\mid', '⌊': r'\lfloor', '⌋': r'\rfloor',
+    '⌈': r'\lceil', '⌉': r'\rceil', '⟨': r'\langle', '⟩': r'\rangle',
+    'ℝ': r'\mathbb{R}', 'ℕ': r'\mathbb{N}', 'ℤ': r'\mathbb{Z}', 'ℚ': r'\mathbb{Q}', 'ℂ': r'\mathbb{C}',
+    # Arrows
+    '→': r'\to', '←': r'\leftarrow', '↔': r'\leftrightarrow', '⇒': r'\Rightarrow', '⇐': r'\Leftarrow',
+    '⇔': r'\Leftrightarrow', '⟹': r'\Longrightarrow', '⟸': r'\Longleftarrow', '⟺': r'\Longleftrightarrow',
+    '↦': r'\mapsto', '↑': r'\uparrow', '↓': r'\downarrow', '↗': r'\nearrow', '↘': r'\searrow',
+    '⇀': r'\rightharpoonup', '⃗': r'\vec{}',
+}
+SUPERSCRIPT_CHARS = str.maketrans('⁰¹²³⁴⁵⁶⁷⁸⁹⁺⁻⁼⁽⁾ⁿⁱ', '0123456789+-=()ni')
+SUBSCRIPT_CHARS = str.maketrans('₀₁₂₃₄₅₆₇₈₉₊₋₌₍₎ₐₑₒₓₕₖₗₘₙₚₛₜᵢⱼᵣᵤᵥ', '0123456789+-=()aeoxhklmnpstijruv')
+ROOT_INDEX = {'√': '', '∛': '[3]', '∜': '[4]'}
+
+# Commands ending in a letter get a \x00 marker that becomes a space only when a letter
+# follows ("\pi r", not "\pir")
+MATH_TRANSLATION = {ord(symbol): latex + ('\x00' if latex[-1].isalpha() else '')
+                    for symbol, latex in MATH_SYMBOLS.items()}
+MATH_TRANSLATION[ord('*')] = None
+COMMAND_GAP_PATTERN = re.compile('\x00(?=[A-Za-z])')
+# Roots and runs of super/subscript characters depend on what follows them
+MATH_TOKEN_PATTERN = re.compile(
+    r'(?P<root>[√∛∜])(?:(?P<root_digits>\d+(?:[.,]\d+)?)|\{(?P<root_group>[^{}]*)\}'
+    r'|\((?P<root_paren>[^()]*)\)|(?P<root_letter>[A-Za-z]))?'
+    r'|(?P<sup>[⁰¹²³⁴⁵⁶⁷⁸⁹⁺⁻⁼⁽⁾ⁿⁱ]+)'
+    r'|(?P<sub>[₀₁₂₃₄₅₆₇₈₉₊₋₌₍₎ₐₑₒₓₕₖₗₘₙₚₛₜᵢⱼᵣᵤᵥ]+)'
+)
+# Escaped \$, $$display$$ and $inline$ spans; a span never crosses an unescaped $
+# (except a lone $ inside display math)
+MATH_SPAN_PATTERN = re.compile(
+    r'(?P<escaped>\\\$)'
+    r'|\$\$(?P<display>(?:[^$\\]|\\.|\$(?!\$))+?)\$\$'
+    r'|\$(?P<inline>(?:[^$\\]|\\.)+)\$',
+    re.DOTALL
+)
+
+def replace_math_token(match):
+    kind = match.lastgroup
+    if kind == 'sup':
+        return '^{' + match.group('sup').translate(SUPERSCRIPT_CHARS) + '}'
+    if kind == 'sub':
+        return '_{' + match.group('sub').translate(SUBSCRIPT_CHARS) + '}'
+
+    index = ROOT_INDEX[match.group('root')]
+    for name in ('root_digits', 'root_group', 'root_paren', 'root_letter'):
+        radicand = match.group(name)
+        if radicand is not None:
+            return rf'\sqrt{index}{{{radicand}}}'
+    return rf'\sqrt{index}' + ('' if index else '\x00')
+
+def normalize_math(content):
+    """Rewrite Unicode math inside one $...$ span to LaTeX"""
+    content = content.translate(MATH_TRANSLATION)
+    content = MATH_TOKEN_PATTERN.sub(replace_math_token, content)
+    return COMMAND_GAP_PATTERN.sub(' ', content).replace('\x00', '')
+
+def replace_math_span(match):
+    if match.group('escaped'):
+        return match.group('escaped')
+    if match.group('display') is not None:
+        return '$$' + normalize_math(match.group('display')) + '$$'
+    return '$' + normalize_math(match.group('inline')) + '$'
+
+def process_formulas(text):
+    """Rewrite Unicode math inside every $...$ and $$...$$ span to LaTeX
+
+    Escaped \\$ never opens or closes a span, and an unmatched $ is left as text.
+    """
+    return MATH_SPAN_PATTERN.sub(replace_math_span, text)
+
+# LaTeX commands for single characters; the reverse of MATH_SYMBOLS plus common aliases
+LATEX_SYMBOLS = {latex: symbol for symbol, latex in reversed(list(MATH_SYMBOLS.items()))
+                 if re.fullmatch(r'\\[A-Za-z]+', latex)}
+LATEX_SYMBOLS.update({
+    r'\le': '≤', r'\ge': '≥', r'\ne': '≠', r'\gets': '←', r'\cdot': '⋅', r'\dots': '…', r'\ldots': '…',
+    r'\lbrace': '{', r'\rbrace': '}', r'\{': '{', r'\}': '}', r'\%': '%', r'\$': '$', r'\&': '&', r'\#': '#',
+    r'\_': '_', r'\|': '‖', r'\prime': '′', r'\degree': '°', r'\land': '∧', r'\lor': '∨', r'\iff': '⟺',
+    r'\implies': '⟹', r'\varnothing': '∅', r'\ell': 'ℓ', r'\hbar': 'ℏ', r'\backslash': '\\', r'\lt': '<',
+    r'\gt': '>', r'\vert': '|', r'\Vert': '‖', r'\colon': ':', r'\epsilon': 'ϵ', r'\phi': 'ϕ',
+    r'\,': '\u2009', r'\:': '\u205f', r'\;': '\u2004', r'\ ': ' ', r'\quad': '\u2003', r'\qquad': '\u2003\u2003',
+    r'\!': '', '~': '\u00a0',
+})
+BLACKBOARD_LETTERS = {latex[len(r'\mathbb{'):-1]: symbol for symbol, latex in MATH_SYMBOLS.items()
+                      if latex.startswith(r'\mathbb{')}
+NARY_OPERATORS = {r'\sum': '∑', r'\prod': '∏', r'\coprod': '∐', r'\int': '∫', r'\iint': '∬', r'\iiint': '∭',
+                  r'\oint': '∮', r'\bigcup': '⋃', r'\bigcap': '⋂'}
+MATH_FUNCTIONS = {'sin', 'cos', 'tan', 'cot', 'sec', 'csc', 'arcsin', 'arccos', 'arctan', 'sinh', 'cosh',
+                  'tanh', 'coth', 'log', 'ln', 'lg', 'exp', 'lim', 'max', 'min', 'sup', 'inf', 'det', 'gcd',
+                  'lcm', 'deg', 'dim', 'ker', 'arg', 'mod'}
+# Written as limits below the name when followed by a subscript
+LIMIT_FUNCTIONS = {'lim', 'max', 'min', 'sup', 'inf'}
+MATH_ACCENTS = {r'\vec': '\u20d7', r'\overrightarrow': '\u20d7', r'\hat': '\u0302', r'\widehat': '\u0302',
+                r'\tilde': '\u0303', r'\widetilde': '\u0303', r'\dot': '\u0307', r'\ddot': '\u0308',
+                r'\bar': '\u0305', r'\check': '\u030c', r'\breve': '\u0306'}
+# Commands whose argument is taken as text rather than parsed, with the OMML style to apply
+MATH_TEXT_COMMANDS = {r'\text': 'p', r'\textrm': 'p', r'\mathrm': 'p', r'\operatorname': 'p', r'\textit': 'i',
+                      r'\mathit': 'i', r'\mathbf': 'b', r'\textbf': 'b', r'\boldsymbol': 'bi', r'\bm': 'bi',
+                      r'\mathbb': 'p', r'\mathcal': None, r'\mathsf': 'p'}
+MATRIX_DELIMITERS = {'matrix': ('', ''), 'pmatrix': ('(', ')'), 'bmatrix': ('[', ']'), 'Bmatrix': ('{', '}'),
+                     'vmatrix': ('|', '|'), 'Vmatrix': ('‖', '‖'), 'smallmatrix': ('', ''), 'array': ('', '')}
+# Stacked one per line: cases gets a left brace, the others no delimiters
+EQUATION_ARRAYS = {'cases': ('{', ''), 'aligned': ('', ''), 'align': ('', ''), 'align*': ('', ''),
+                   'gathered': ('', ''), 'split': ('', ''), 'eqnarray': ('', '')}
+# An n-ary operator's body stops at the next relation, so \sum_i a_i = S sums only a_i
+MATH_RELATIONS = {'=', '<', '>', ',', ';', r'\le', r'\leq', r'\ge', r'\geq', r'\ne', r'\neq', r'\approx',
+                  r'\equiv', r'\sim', r'\to', r'\Rightarrow', r'\Leftrightarrow', r'\in'}
+LATEX_TOKEN = re.compile(r'\\(?:[A-Za-z]+\*?|.)|\d+(?:\.\d+)?|\s+|.', re.DOTALL)
+
+class OmmlBuilder:
+    """Recursive-descent translation of one LaTeX formula into Office Math (OMML) markup
+
+    Covers what the model writes in practice: fractions, roots, scripts, n-ary operators,
+    \\left...\\right, matrices and cases, accents, function names, text and font commands,
+    and the symbol commands in LATEX_SYMBOLS. Unknown commands are kept as literal text.
+    Parsed content is a list of items: ('t', text, style) for text that may be merged into
+    one run, or ('x', markup) for a finished structure.
+    """
+
+    def __init__(self, latex):
+        self.tokens = LATEX_TOKEN.findall(latex)
+        self.pos = 0
+
+    def convert(self):
+        items = self.parse_sequence(())
+        return self.render(items)
+
+    def peek(self):
+        # Next token that is not whitespace, without consuming it
+        while self.pos < len(self.tokens) and self.tokens[self.pos].isspace():
+            self.pos += 1
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        token = self.peek()
+        if token is not None:
+            self.pos += 1
+        return token
+
+    def parse_sequence(self, stop):
+        items = []
+        while True:
+            token = self.peek()
+            if token is None or token in stop:
+                return items
+            self.pos += 1
+            if token in ('^', '_'):
+                self.attach_scripts(items, token)
+            else:
+                self.parse_token(token, items, stop)
+
+    def parse_argument(self):
+        """The markup of one argument: a {group} or a single token"""
+        token = self.take()
+        if token is None:
+            return ''
+        if token == '{':
+            items = self.parse_sequence(('}',))
+            self.take()
+            return self.render(items)
+        items = []
+        self.parse_token(token, items, ())
+        return self.render(items)
+
+    def read_raw_group(self):
+        """Source text of a {group}, for commands whose argument is text"""
+        if self.peek() != '{':
+            return self.take() or ''
+        self.pos += 1
+        depth = 0
+        parts = []
+        while self.pos < len(self.tokens):
+            token = self.tokens[self.pos]
+            self.pos += 1
+            if token == '{':
+                depth += 1
+            elif token == '}':
+                if depth == 0:
+                    break
+                depth -= 1
+            parts.append(token)
+        return ''.join(parts)
+
+    def read_scripts(self):
+        """Consume any _ and ^ that follow, in either order; returns (sub, sup) markup or None"""
+        sub = sup = None
+        while self.peek() in ('_', '^'):
+            if self.take() == '_':
+                sub = self.parse_argument()
+            else:
+                sup = self.parse_argument()
+        return sub, sup
+
+    def attach_scripts(self, items, token):
+        base = self.render([items.pop()]) if items else ''
+        self.pos -= 1
+        sub, sup = self.read_scripts()
+        if sub is not None and sup is not None:
+            items.append(('x', f'<m:sSubSup><m:e>{base}</m:e><m:sub>{sub}</m:sub><m:sup>{sup}</m:sup></m:sSubSup>'))
+        elif sub is not None:
+            items.append(('x', f'<m:sSub><m:e>{base}</m:e><m:sub>{sub}</m:sub></m:sSub>'))
+        else:
+            items.append(('x', f'<m:sSup><m:e>{base}</m:e><m:sup>{sup}</m:sup></m:sSup>'))
+
+    def parse_token(self, token, items, stop):
+        if token == '{':
+            group = self.parse_sequence(('}',))
+            self.take()
+            items.append(('x', self.render(group)))
+        elif token in ('}', '&', '\\\\'):
+            # Stray structure outside a group or matrix
+            return
+        elif token[0] != '\\' or len(token) == 1:
+            items.append(('t', LATEX_SYMBOLS.get(token, token), None))
+        elif token in (r'\frac', r'\dfrac', r'\tfrac', r'\cfrac'):
+            numerator = self.parse_argument()
+            denominator = self.parse_argument()
+            items.append(('x', f'<m:f><m:num>{numerator}</m:num><m:den>{denominator}</m:den></m:f>'))
+        elif token == r'\binom':
+            top = self.parse_argument()
+            bottom = self.parse_argument()
+            items.append(('x', self.delimited('(', ')', f'<m:f><m:fPr><m:type m:val="noBar"/></m:fPr>'
+                                                         f'<m:num>{top}</m:num><m:den>{bottom}</m:den></m:f>')))
+        elif token == r'\sqrt':
+            degree = None
+            if self.peek() == '[':
+                self.pos += 1
+                degree = self.render(self.parse_sequence((']',)))
+                self.take()
+            radicand = self.parse_argument()
+            if degree:
+                items.append(('x', f'<m:rad><m:deg>{degree}</m:deg><m:e>{radicand}</m:e></m:rad>'))
+            else:
+                items.append(('x', f'<m:rad><m:radPr><m:degHide m:val="1"/></m:radPr><m:deg/>'
+                                   f'<m:e>{radicand}</m:e></m:rad>'))
+        elif token in NARY_OPERATORS:
+            sub, sup = self.read_scripts()
+            body = self.render(self.parse_sequence(set(stop) | MATH_RELATIONS))
+            location = 'subSup' if 'int' in token else 'undOvr'
+            properties = f'<m:chr m:val="{NARY_OPERATORS[token]}"/><m:limLoc m:val="{location}"/>'
+            if sub is None:
+                properties += '<m:subHide m:val="1"/>'
+            if sup is None:
+                properties += '<m:supHide m:val="1"/>'
+            items.append(('x', f'<m:nary><m:naryPr>{properties}</m:naryPr><m:sub>{sub or ""}</m:sub>'
+                               f'<m:sup>{sup or ""}</m:sup><m:e>{body}</m:e></m:nary>'))
+        elif token[1:] in MATH_FUNCTIONS:
+            name = self.render([('t', token[1:], 'p')])
+            if token[1:] in LIMIT_FUNCTIONS and self.peek() == '_':
+                self.pos += 1
+                limit = self.parse_argument()
+                items.append(('x', f'<m:limLow><m:e>{name}</m:e><m:lim>{limit}</m:lim></m:limLow>'))
+            else:
+                items.append(('t', token[1:], 'p'))
+        elif token == r'\left':
+            opening = self.delimiter_char(self.take())
+            content = self.render(self.parse_sequence((r'\right',)))
+            closing = ''
+            if self.take() == r'\right':
+                closing = self.delimiter_char(self.take())
+            items.append(('x', self.delimited(opening, closing, content)))
+        elif token in (r'\right', r'\middle', r'\big', r'\Big', r'\bigg', r'\Bigg', r'\displaystyle',
+                       r'\limits', r'\nolimits'):
+            return
+        elif token == r'\begin':
+            items.append(('x', self.parse_environment(self.read_raw_group().strip())))
+        elif token in MATH_ACCENTS:
+            base = self.parse_argument()
+            items.append(('x', f'<m:acc><m:accPr><m:chr m:val="{MATH_ACCENTS[token]}"/></m:accPr>'
+                               f'<m:e>{base}</m:e></m:acc>'))
+        elif token in (r'\overline', r'\underline'):
+            position = 'top' if token == r'\overline' else 'bot'
+            base = self.parse_argument()
+            items.append(('x', f'<m:bar><m:barPr><m:pos m:val="{position}"/></m:barPr><m:e>{base}</m:e></m:bar>'))
+        elif token in MATH_TEXT_COMMANDS:
+            text = self.read_raw_group()
+            if token == r'\mathbb':
+                text = ''.join(BLACKBOARD_LETTERS.get(letter, letter) for letter in text)
+            items.append(('t', text, MATH_TEXT_COMMANDS[token]))
+        elif token in LATEX_SYMBOLS:
+            items.append(('t', LATEX_SYMBOLS[token], None))
+        else:
+            items.append(('t', token, 'p'))
+
+    def parse_environment(self, name):
+        if name == 'array' and self.peek() == '{':
+            self.read_raw_group()  # column specification
+        rows = [[]]
+        while True:
+            cell = self.render(self.parse_sequence(('&', '\\\\', r'\end')))
+            rows[-1].append(cell)
+            token = self.take()
+            if token == '&':
+                continue
+            if token == '\\\\':
+                rows.append([])
+                continue
+            if token == r'\end':
+                self.read_raw_group()
+            break
+        if rows[-1] == [''] and len(rows) > 1:
+            rows.pop()  # trailing \\
+
+        if name in EQUATION_ARRAYS:
+            space = self.render([('t', '\u2003', None)])
+            lines = ''.join(f'<m:e>{space.join(row)}</m:e>' for row in rows)
+            opening, closing = EQUATION_ARRAYS[name]
+            array = f'<m:eqArr>{lines}</m:eqArr>'
+            return self.delimited(opening, closing, array) if opening or closing else array
+
+        columns = max(len(row) for row in rows)
+        body = ''.join('<m:mr>%s</m:mr>' % ''.join(f'<m:e>{cell}</m:e>' for cell in row + [''] * (columns - len(row)))
+                       for row in rows)
+        matrix = (f'<m:m><m:mPr><m:mcs><m:mc><m:mcPr><m:count m:val="{columns}"/><m:mcJc m:val="center"/>'
+                  f'</m:mcPr></m:mc></m:mcs></m:mPr>{body}</m:m>')
+        opening, closing = MATRIX_DELIMITERS.get(name, ('', ''))
+        return self.delimited(opening, closing, matrix) if opening or closing else matrix
+
+    def delimiter_char(self, token):
+        if token in (None, '.'):
+            return ''
+        return LATEX_SYMBOLS.get(token, token.lstrip('\\') if len(token) == 2 else token)
+
+    def delimited(self, opening, closing, content):
+        return (f'<m:d><m:dPr><m:begChr m:val="{xml_text(opening)}"/><m:endChr m:val="{xml_text(closing)}"/>'
+                f'</m:dPr><m:e>{content}</m:e></m:d>')
+
+    def render(self, items):
+        """Markup for a list of items, merging neighbouring text of the same style into one run"""
+        parts = []
+        text = []
+        style = None
+        for item in items + [('x', '')]:
+            if item[0] == 't' and (not text or item[2] == style):
+                text.append(item[1])
+                style = item[2]
+                continue
+            if text:
+                parts.append(self.run(''.join(text), style))
+                text = []
+            if item[0] == 't':
+                text.append(item[1])
+                style = item[2]
+            else:
+                parts.append(item[1])
+        return ''.join(parts)
+
+    def run(self, text, style):
+        properties = f'<m:rPr><m:sty m:val="{style}"/></m:rPr>' if style else ''
+        space = ' xml:space="preserve"' if text.strip() != text else ''
+        return f'<m:r>{properties}<m:t{space}>{xml_text(text)}</m:t></m:r>'
+
+@functools.lru_cache(maxsize=4096)
+def latex_to_omml(latex, display=False):
+    """OMML for a LaTeX formula (without $ delimiters), or None if it cannot be converted
+
+    Display formulas are wrapped in m:oMathPara so they sit centred on their own line.
+    """
+    try:
+        math = '<m:oMath>%s</m:oMath>' % OmmlBuilder(latex).convert()
+    except Exception as e:
+        logger.debug("Could not convert formula %r: %s", latex, e)
+        return None
+    return f'<m:oMathPara>{math}</m:oMathPara>' if display else math
+
+# Separator rows such as |---|:---:| (only pipes, dashes, colons and spaces)
+TABLE_SEPARATOR_PATTERN = re.compile(r'^[\s|:-]*-[\s|:-]*$')
+MARKDOWN_HEADING = re.compile(r'(#{1,6})\s+(.*?)(?:\s+#+)?\s*$')
+MARKDOWN_BULLET = re.compile(r'([ \t]*)[-*+]\s+(.*\S)')
+MARKDOWN_ORDERED = re.compile(r'([ \t]*)(\d{1,9}[.)])\s+(.*\S)')
+MARKDOWN_FENCE = re.compile(r'[ \t]*(`{3,}|~{3,})')
+MARKDOWN_RULE = re.compile(r'([-*_])(?:\s*\1){2,}$')
+# python-docx style names; ordered items keep the model's own numbers, so they use the
+# unnumbered hanging-indent "List" styles instead of "List Number" (which never restarts)
+BULLET_STYLES = ('List Bullet', 'List Bullet 2', 'List Bullet 3')
+ORDERED_STYLES = ('List', 'List 2', 'List 3')
+QUOTE_STYLE = 'Quote'
+CODE_STYLE = 'macro'
+
+def is_table_line(line):
+    return '|' in line and len(line.split('|')) > 2
+
+def list_level(indent):
+    return min(len(indent.expandtabs(4)) // 2, 2)
+
+def iter_markdown_blocks(text):
+    """Single pass over the lines of Markdown text, yielding docx-ready blocks
+
+    Yields ('table', table_lines) for pipe tables and ('paragraph', style, text) for
+    everything else, where style is a python-docx style name or None. Code block lines
+    are yielded verbatim with CODE_STYLE; other text may still hold inline emphasis.
+    """
+    table_lines = []
+    separators = []
+    fence = None
+    # Lines of a $$ display formula spread over several lines, joined into one paragraph
+    math_lines = None
+    for raw_line in io.StringIO(text):
+        if fence is not None:
+            line = raw_line.rstrip('\r\n')
+            if line.strip().startswith(fence):
+                fence = None
+            else:
+                yield 'paragraph', CODE_STYLE, line
+            continue
+        if math_lines is not None:
+            line = raw_line.strip()
+            math_lines.append(line)
+            if line.endswith('$$'):
+                yield 'paragraph', None, ' '.join(math_lines)
+                math_lines = None
+            continue
+
+        line = raw_line.strip()
+        if line and '|' in line and is_table_line(line):
+            # Skip separator lines like |---|---|
+            if TABLE_SEPARATOR_PATTERN.match(line):
+                separators.append(line)
+            else:
+                table_lines.append(line)
+            continue
+
+        if table_lines:
+            yield 'table', table_lines
+        else:
+            # A run made only of separators is kept as text
+            for separator in separators:
+                yield 'paragraph', None, separator
+        table_lines = []
+        separators = []
+        if not line:
+            continue
+
+        first = line[0]
+        if first == '#':
+            match = MARKDOWN_HEADING.match(line)
+            if match:
+                yield 'paragraph', f"Heading {len(match.group(1))}", match.group(2)
+                continue
+        elif first in '-*+_':
+            if MARKDOWN_RULE.match(line):
+                yield 'paragraph', None, ''
+                continue
+            match = MARKDOWN_BULLET.match(raw_line)
+            if match:
+                yield 'paragraph', BULLET_STYLES[list_level(match.group(1))], match.group(2)
+                continue
+        elif first.isdigit():
+            match = MARKDOWN_ORDERED.match(raw_line)
+            if match:
+                yield 'paragraph', ORDERED_STYLES[list_level(match.group(1))], \
+                    f"{match.group(2)}\t{match.group(3)}"
+                continue
+        elif first == '>':
+            yield 'paragraph', QUOTE_STYLE, line.lstrip('> ')
+            continue
+        elif first in '`~':
+            match = MARKDOWN_FENCE.match(line)
+            if match:
+                fence = match.group(1)
+                continue
+        elif first == '$':
+            if line.startswith('$$') and (len(line) < 4 or not line.endswith('$$')):
+                math_lines = [line]
+                continue
+        yield 'paragraph', None, line
+
+    if math_lines:
+        yield 'paragraph', None, ' '.join(math_lines)
+    if table_lines:
+        yield 'table', table_lines
+    else:
+        for separator in separators:
+            yield 'paragraph', None, separator
+
+# **bold**, __bold__, *italic* and `code`; $...$ spans are matched first so that '*' and
+# '_' inside formulas are never taken as emphasis
+INLINE_MARKUP = re.compile(
+    r'(?P<math>\$\$.+?\$\$|\$(?:[^$\\]|\\.)+\$)'
+    r'|\*\*(?P<bold>[^*]+)\*\*'
+    r'|__(?P<bold_underscore>[^_]+)__'
+    r'|(?<![\w*])\*(?P<italic>[^*\s](?:[^*]*[^*\s])?)\*(?![\w*])'
+    r'|`(?P<code>[^`]+)`'
+)
+
+def parse_inline(text):
+    """Split text into (text, kind) runs
+
+    kind is None, 'bold', 'italic', 'code', 'math' or 'display_math'; math runs hold the
+    LaTeX without its $ delimiters.
+    """
+    if '*' not in text and '_' not in text and '`' not in text and '$' not in text:
+        return [(text, None)]
+
+    runs = []
+    position = 0
+    for match in INLINE_MARKUP.finditer(text):
+        if match.start() > position:
+            runs.append((text[position:match.start()], None))
+        math = match.group('math')
+        bold = match.group('bold') or match.group('bold_underscore')
+        if math:
+            if math.startswith('$$'):
+                runs.append((math[2:-2], 'display_math'))
+            else:
+                runs.append((math[1:-1], 'math'))
+        elif bold:
+            runs.append((bold, 'bold'))
+        elif match.group('italic'):
+            runs.append((match.group('italic'), 'italic'))
+        else:
+            runs.append((match.group('code'), 'code'))
+        position = match.end()
+    if position < len(text):
+        runs.append((text[position:], None))
+    return runs
+
+def add_markdown_paragraph(doc, style, text):
+    """Add one iter_markdown_blocks paragraph to a python-docx Document"""
+    if style == CODE_STYLE:
+        return doc.add_paragraph(text, style)
+    runs = parse_inline(text)
+    if len(runs) == 1 and runs[0][1] is None:
+        return doc.add_paragraph(text, style)
+    if any(kind in ('math', 'display_math') for _, kind in runs):
+        # Equations have no python-docx API; the paragraph is built as XML like the streaming writer does
+        append_body_xml(doc, paragraph_xml(style, text))
+        return None
+
+    paragraph = doc.add_paragraph(style=style)
+    for run_text, kind in runs:
+        run = paragraph.add_run(run_text)
+        if kind == 'bold':
+            run.bold = True
+        elif kind == 'italic':
+            run.italic = True
+        elif kind == 'code':
+            run.font.name = 'Courier New'
+    return paragraph
+
+def append_body_xml(doc, xml):
+    """Parse a w:p or w:tbl fragment and add it at the end of a python-docx Document's body"""
+    from docx.oxml import parse_xml
+    from docx.oxml.ns import nsdecls
+
+    tag_end = xml.index('>')
+    element = parse_xml(f"{xml[:tag_end]} {nsdecls('w', 'm')}{xml[tag_end:]}")
+    body = doc.element.body
+    if body.sectPr is not None:
+        body.sectPr.addprevious(element)
+    else:
+        body.append(element)
+    return element
+
+def parse_table_lines(table_lines):
+    """Split Markdown table lines into rows of cell strings"""
+    table_data = []
+    for line_num, line in enumerate(table_lines):
+        if not line.strip():
+            continue
+
+        # Split by | and clean up cells
+        raw_cells = line.split('|')
+        cells = []
+
+        for cell in raw_cells:
+            cleaned_cell = cell.strip()
+            if cleaned_cell or (cells and line_num < len(table_lines) - 1):
+                cells.append(cleaned_cell)
+
+        # Remove leading/trailing empty cells only
+        while cells and not cells[0]:
+            cells.pop(0)
+        while cells and not cells[-1]:
+            cells.pop()
+
+        if cells:
+            table_data.append(cells)
+    return table_data
+
+# Characters python-docx refuses in text; the streaming writer drops them instead of failing
+XML_INVALID_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+def xml_text(text):
+    text = XML_INVALID_CHARS.sub('', text)
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+def text_xml(text):
+    # python-docx only marks text with leading or trailing whitespace as preserved
+    if text.strip() != text:
+        return '<w:t xml:space="preserve">%s</w:t>' % xml_text(text)
+    return '<w:t>%s</w:t>' % xml_text(text)
+
+def run_xml(text, properties=''):
+    """A w:r run for text, with tabs as w:tab like python-docx writes them"""
+    if not text:
+        return ''
+    if '\t' in text:
+        return '<w:r>%s%s</w:r>' % (properties, '<w:tab/>'.join(text_xml(piece) if piece else ''
+                                                               for piece in text.split('\t')))
+    return '<w:r>%s%s</w:r>' % (properties, text_xml(text))
+
+# Python-docx style names whose id is not simply the name without spaces
+STYLE_IDS = {CODE_STYLE: 'MacroText'}
+
+def paragraph_properties_xml(style):
+    if not style:
+        return ''
+    return '<w:pPr><w:pStyle w:val="%s"/></w:pPr>' % STYLE_IDS.get(style, style.replace(' ', ''))
+
+def inline_runs_xml(text):
+    """Runs for text with its Markdown emphasis applied and its formulas as OMML equations"""
+    runs = parse_inline(text)
+    parts = []
+    for run_text, kind in runs:
+        if kind in ('math', 'display_math'):
+            # Only a formula standing alone in its paragraph is laid out as display math
+            omml = latex_to_omml(run_text, display=kind == 'display_math' and len(runs) == 1)
+            if omml:
+                parts.append(omml)
+            else:
+                delimiter = '$$' if kind == 'display_math' else '$'
+                parts.append(run_xml(f"{delimiter}{run_text}{delimiter}"))
+        elif kind == 'bold':
+            parts.append(run_xml(run_text, '<w:rPr><w:b/></w:rPr>'))
+        elif kind == 'italic':
+            parts.append(run_xml(run_text, '<w:rPr><w:i/></w:rPr>'))
+        elif kind == 'code':
+            parts.append(run_xml(run_text, '<w:rPr><w:rFonts w:ascii="Courier New" w:hAnsi="Courier New"/></w:rPr>'))
+        else:
+            parts.append(run_xml(run_text))
+    return ''.join(parts)
+
+def paragraph_xml(style, text):
+    runs = run_xml(text) if style == CODE_STYLE else inline_runs_xml(text)
+    return '<w:p>%s%s</w:p>' % (paragraph_properties_xml(style), runs)
+
+def table_xml(table_data, width_twips):
+    """Markup of a "Table Grid" table in one pass, matching what python-docx's add_table produces
+
+    Short rows are padded with empty cells. Markdown emphasis and formulas in a cell become
+    formatted runs and equations.
+    """
+    cols = max(len(row) for row in table_data)
+    width = width_twips // cols
+    cell_properties = '<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="%d"/></w:tcPr>' % width
+    empty_cell = cell_properties + '<w:p/></w:tc>'
+
+    parts = ['<w:tbl><w:tblPr><w:tblStyle w:val="TableGrid"/><w:tblW w:type="auto" w:w="0"/>'
+             '<w:tblLook w:firstColumn="1" w:firstRow="1" w:lastColumn="0" w:lastRow="0" '
+             'w:noHBand="0" w:noVBand="1" w:val="04A0"/></w:tblPr><w:tblGrid>',
+             '<w:gridCol w:w="%d"/>' % width * cols, '</w:tblGrid>']
+    for row_data in table_data:
+        parts.append('<w:tr>')
+        for cell_data in row_data:
+            clean_data = str(cell_data).replace('\n', ' ').replace('\r', '')
+            parts.append('%s<w:p>%s</w:p></w:tc>' % (cell_properties, inline_runs_xml(clean_data)))
+        parts.append(empty_cell * (cols - len(row_data)))
+        parts.append('</w:tr>')
+    parts.append('</w:tbl>')
+    return ''.join(parts)
+
+# Above this size the GUI exports through StreamingDocxWriter (about 300 pages at EXPECTED_BYTES_PER_PAGE)
+STREAMING_EXPORT_MIN_CHARS = 1_000_000
+
+class StreamingDocxWriter:
+    """Writes a .docx by streaming word/document.xml straight into the zip
+
+    Supports the subset export_docx needs (headings, paragraphs, "Table Grid" tables and
+    pictures) with the same markup python-docx produces. Styles, theme and settings are
+    copied from python-docx's default template. Only a small XML buffer and the list of
+    pictures are held in memory, so memory stays flat however long the document is.
+    """
+    DOCUMENT_PART = 'word/document.xml'
+    RELS_PART = 'word/_rels/document.xml.rels'
+    CONTENT_TYPES_PART = '[Content_Types].xml'
+    # Text width of the template's letter page with 1.25" margins, in twentieths of a point
+    TEXT_WIDTH_TWIPS = 8640
+
+    def __init__(self, output_path, flush_bytes=256 * 1024):
+        import zipfile
+        import docx
+
+        self.output_path = output_path
+        self.flush_bytes = flush_bytes
+        self.template = zipfile.ZipFile(os.path.join(os.path.dirname(docx.__file__), 'templates', 'default.docx'))
+        self.zip = zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED)
+        self.pictures = []
+        self.buffer = []
+        self.buffered = 0
+
+        template_xml = self.template.read(self.DOCUMENT_PART).decode('utf-8')
+        body_start = template_xml.index('<w:body>') + len('<w:body>')
+        body_end = template_xml.index('</w:body>')
+        self.document_tail = template_xml[body_end:]
+        self.section_xml = template_xml[body_start:body_end].strip()
+
+        self.stream = self.zip.open(self.DOCUMENT_PART, 'w', force_zip64=True)
+        self.write(template_xml[:body_start])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def write(self, xml):
+        self.buffer.append(xml)
+        self.buffered += len(xml)
+        if self.buffered >= self.flush_bytes:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.stream.write(''.join(self.buffer).encode('utf-8'))
+            self.buffer = []
+            self.buffered = 0
+
+    def add_paragraph(self, text='', style=None):
+        """Add a paragraph; style is a python-docx style name such as 'List Bullet'"""
+        self.write('<w:p>%s%s</w:p>' % (paragraph_properties_xml(style), run_xml(text)))
+
+    def add_markdown_paragraph(self, style, text):
+        """Counterpart of add_markdown_paragraph for this writer"""
+        self.write(paragraph_xml(style, text))
+
+    def add_heading(self, text='', level=1):
+        self.add_paragraph(text, 'Title' if level == 0 else f'Heading {level}')
+
+    def add_table(self, table_data):
+        """Add a "Table Grid" table; short rows are padded with empty cells"""
+        self.write(table_xml(table_data, self.TEXT_WIDTH_TWIPS))
+
+    def add_markdown_table(self, table_lines):
+        """Counterpart of create_word_table for this writer"""
+        table_data = parse_table_lines(table_lines)
+        if not table_data:
+            for line in table_lines:
+                self.add_paragraph(line)
+            return
+        self.add_table(table_data)
+        self.add_paragraph("")  # spacing after table
+
+    def add_picture(self, image_path, width):
+        """Add a picture scaled to width (EMU, e.g. Inches(5)); the file is copied in on close()"""
+        from docx.image.image import Image
+
+        image = Image.from_file(image_path)
+        cx, cy = image.scaled_dimensions(width, None)
+        number = len(self.pictures) + 1
+        rel_id = f'rIdImage{number}'
+        self.pictures.append((rel_id, f'media/image{number}.{image.ext}', image_path, image.ext, image.content_type))
+        self.write(
+            '<w:p><w:r><w:drawing><wp:inline distT="0" distB="0" distL="0" distR="0">'
+            f'<wp:extent cx="{cx}" cy="{cy}"/><wp:docPr id="{number}" name="Picture {number}"/>'
+            '<wp:cNvGraphicFramePr><a:graphicFrameLocks xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" '
+            'noChangeAspect="1"/></wp:cNvGraphicFramePr>'
+            '<a:graphic xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main">'
+            '<a:graphicData uri="http://schemas.openxmlformats.org/drawingml/2006/picture">'
+            '<pic:pic xmlns:pic="http://schemas.openxmlformats.org/drawingml/2006/picture">'
+            f'<pic:nvPicPr><pic:cNvPr id="0" name="{xml_text(os.path.basename(image_path))}"/><pic:cNvPicPr/></pic:nvPicPr>'
+            f'<pic:blipFill><a:blip r:embed="{rel_id}"/><a:stretch><a:fillRect/></a:stretch></pic:blipFill>'
+            f'<pic:spPr><a:xfrm><a:off x="0" y="0"/><a:ext cx="{cx}" cy="{cy}"/></a:xfrm>'
+            '<a:prstGeom prst="rect"/></pic:spPr></pic:pic></a:graphicData></a:graphic></wp:inline></w:drawing></w:r></w:p>'
+        )
+
+    def close(self):
+        """Finish document.xml, then add the pictures and the remaining package parts"""
+        self.write(self.section_xml + self.document_tail)
+        self.flush()
+        self.stream.close()
+
+        for rel_id, target, image_path, ext, content_type in self.pictures:
+            self.zip.write(image_path, 'word/' + target)
+
+        for item in self.template.infolist():
+            if item.filename == self.DOCUMENT_PART:
+                continue
+            data = self.template.read(item.filename)
+            if item.filename == self.RELS_PART and self.pictures:
+                relationships = ''.join(
+                    f'<Relationship Id="{rel_id}" Target="{target}" Type='
+                    '"http://schemas.openxmlformats.org/officeDocument/2006/relationships/image"/>'
+                    for rel_id, target, _, _, _ in self.pictures)
+                data = data.replace(b'</Relationships>', relationships.encode('utf-8') + b'</Relationships>')
+            elif item.filename == self.CONTENT_TYPES_PART and self.pictures:
+                known = set(re.findall(rb'Extension="([^"]+)"', data))
+                defaults = {ext: content_type for _, _, _, ext, content_type in self.pictures
+                            if ext.encode('utf-8') not in known}
+                extra = ''.join(f'<Default Extension="{ext}" ContentType="{content_type}"/>'
+                                for ext, content_type in defaults.items())
+                data = data.replace(b'</Types>', extra.encode('utf-8') + b'</Types>')
+            self.zip.writestr(item, data)
+
+        self.zip.close()
+        self.template.close()
+
+    def abort(self):
+        """Close everything and remove the partial file"""
+        try:
+            self.stream.close()
+            self.zip.close()
+        except Exception:
+            pass
+        self.template.close()
+        if os.path.exists(self.output_path):
+            os.unlink(self.output_path)
+
+def export_docx(text, output_path, images=None, engine='python-docx'):
+    """Export Markdown text to a .docx, optionally preceded by the original images
+
+    Headings, lists, block quotes, code blocks, tables and inline emphasis are mapped to
+    the template's Word styles. engine is 'python-docx' (builds the document in memory) or 'streaming' (StreamingDocxWriter).
+    """
+    from docx.shared import Inches
+
+    if engine == 'streaming':
+        doc = StreamingDocxWriter(output_path)
+        add_table = doc.add_markdown_table
+        add_paragraph = doc.add_markdown_paragraph
+    else:
+        from docx import Document
+        doc = Document()
+
+        def add_table(table_lines):
+            create_word_table(doc, table_lines)
+
+        def add_paragraph(style, text):
+            add_markdown_paragraph(doc, style, text)
+
+    try:
+        doc.add_heading('Converted Document', 0)
+
+        # If this is from image tab and we want to include original images
+        if images is not None:
+            doc.add_heading('Original Images', level=1)
+            for img_info in images:
+                try:
+                    if os.path.exists(img_info['path']):
+                        doc.add_paragraph(f"Image {img_info['index']}: {img_info['filename']}")
+                        doc.add_picture(img_info['path'], width=Inches(5))
+                        doc.add_paragraph("")  # spacing
+                except Exception as e:
+                    print(f"Error adding original image {img_info['index']}: {e}", file=sys.stderr)
+                    doc.add_paragraph(f"[Error: Could not insert image {img_info['index']}]")
+
+            doc.add_heading('Extracted Text', level=1)
+
+        for block in iter_markdown_blocks(text):
+            if block[0] == 'table':
+                logger.debug("Creating table with %d rows", len(block[1]))
+                add_table(block[1])
+            else:
+                add_paragraph(block[1], block[2])
+    except Exception:
+        if engine == 'streaming':
+            doc.abort()
+        raise
+
+    if engine == 'streaming':
+        doc.close()
+    else:
+        doc.save(output_path)
+
+    return {'lines': text.count('\n') + 1, 'images': len(images) if images is not None else 0, 'engine': engine}
+
+def create_word_table(doc, table_lines):
+    """Create a Word table from Markdown table lines
+
+    The whole table is built as one XML fragment and appended to the body, instead of
+    filling table.rows[i].cells[j] one by one through python-docx.
+    """
+    if not table_lines:
+        return
+
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        logger.debug("Creating table from %d lines:", len(table_lines))
+        for i, line in enumerate(table_lines):
+            logger.debug("  Line %d: %r", i, line)
+
+    table_data = parse_table_lines(table_lines)
+    if debug:
+        for row_num, cells in enumerate(table_data, 1):
+            logger.debug("  Parsed row %d: %s", row_num, cells)
+
+    if not table_data:
+        logger.debug("No valid table data found, adding as regular text")
+        for line in table_lines:
+            doc.add_paragraph(line)
+        return
+
+    try:
+        section = doc.sections[-1]
+        width_twips = (section.page_width - section.left_margin - section.right_margin) // 635  # EMU per twip
+        append_body_xml(doc, table_xml(table_data, width_twips))
+
+        doc.add_paragraph("")  # spacing after table
+        logger.debug("Created %dx%d table", len(table_data), max(len(row) for row in table_data))
+
+    except Exception as e:
+        logger.warning("Error creating table: %s", e)
+        logger.debug("Table data that caused error: %s", table_data)
+        doc.add_paragraph("Table conversion failed, showing as text:")
+        for line in table_lines:
+            doc.add_paragraph(f"  {line}")
+
+PANDOC_ARGS = ['--from=markdown', '--to=docx', '--standalone']
+
+class PandocBackend:
+    """Shared pandoc exporter for the tabs and the CLI
+
+    Markdown goes to pandoc through stdin or HTTP, never through a temp file. The first
+    export tries to start `pandoc server` (pandoc 3+, sandboxed, no file access) on a free
+    local port and later exports reuse it, so batch runs stop paying a cold process start
+    per document. Older pandoc builds fall back to one piped process per export.
+    At most `max_workers` conversions run at once.
+    """
+
+    SERVER_START_TIMEOUT = 10
+    REQUEST_TIMEOUT = 300
+
+    def __init__(self, executable='pandoc', max_workers=4, use_server=True):
+        self.executable = executable
+        self.use_server = use_server
+        self.slots = threading.BoundedSemaphore(max(1, max_workers))
+        self.max_workers = max(1, max_workers)
+        self.lock = threading.Lock()
+        self.server = None
+        self.server_url = None
+        self.server_failed = False
+
+    def set_max_workers(self, max_workers):
+        self.max_workers = max(1, max_workers)
+        self.slots = threading.BoundedSemaphore(self.max_workers)
+
+    def ensure_server(self):
+        """URL of a running pandoc server, starting one if needed; None if it cannot run"""
+        import socket
+        import subprocess
+
+        with self.lock:
+            if self.server is not None and self.server.poll() is None:
+                return self.server_url
+            if not self.use_server or self.server_failed:
+                return None
+
+            with socket.socket() as probe:
+                probe.bind(('127.0.0.1', 0))
+                port = probe.getsockname()[1]
+            try:
+                server = subprocess.Popen([self.executable, 'server', '--port', str(port),
+                                           '--timeout', str(self.REQUEST_TIMEOUT)],
+                                          stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                          stderr=subprocess.DEVNULL)
+            except OSError:
+                self.server_failed = True
+                return None
+
+            deadline = time.monotonic() + self.SERVER_START_TIMEOUT
+            while time.monotonic() < deadline and server.poll() is None:
+                try:
+                    socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+                    break
+                except OSError:
+                    time.sleep(0.05)
+            else:
+                # Exited (no server subcommand in this pandoc) or never started listening
+                if server.poll() is None:
+                    server.kill()
+                    server.wait()
+                logger.debug("pandoc server unavailable, using one process per export")
+                self.server_failed = True
+                return None
+
+            self.server = server
+            self.server_url = f"http://127.0.0.1:{port}/"
+            logger.debug("pandoc server listening on %s", self.server_url)
+            return self.server_url
+
+    def convert_with_server(self, url, text):
+        """POST one document to the pandoc server; returns the .docx bytes"""
+        import base64
+        import urllib.error
+        import urllib.request
+
+        body = json.dumps({'text': text, 'from': 'markdown', 'to': 'docx', 'standalone': True}).encode('utf-8')
+        request = urllib.request.Request(url, data=body, method='POST',
+                                         headers={'Content-Type': 'application/json',
+                                                  'Accept': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.REQUEST_TIMEOUT) as response:
+                result = json.loads(response.read().decode('utf-8'))
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(e.read().decode('utf-8', errors='replace') or str(e))
+        if 'error' in result:
+            raise RuntimeError(result['error'])
+        output = result['output']
+        return base64.b64decode(output) if result.get('base64') else output.encode('utf-8')
+
+    def convert_with_process(self, text, output_path):
+        import subprocess
+
+        result = subprocess.run([self.executable, '-o', output_path] + PANDOC_ARGS,
+                                input=text.encode('utf-8'), capture_output=True)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.decode('utf-8', errors='replace'))
+
+    def export(self, text, output_path):
+        """Convert Markdown text to .docx; raises FileNotFoundError without pandoc and
+        RuntimeError if pandoc reports an error"""
+        import urllib.error
+
+        if shutil.which(self.executable) is None:
+            raise FileNotFoundError(f"{self.executable} not found in PATH")
+
+        with self.slots:
+            url = self.ensure_server()
+            if url:
+                try:
+                    data = self.convert_with_server(url, text)
+                except (urllib.error.URLError, ConnectionError, TimeoutError) as e:
+                    # The server went away; finish this and later exports with plain processes
+                    logger.debug("pandoc server failed (%s), using one process per export", e)
+                    self.close(failed=True)
+                else:
+                    with open(output_path, 'wb') as f:
+                        f.write(data)
+                    return
+            self.convert_with_process(text, output_path)
+
+    def export_many(self, documents, max_workers=None):
+        """Export (text, output_path) pairs, at most max_workers at once; returns one error
+        (None on success) per document, in order"""
+        def export_one(document):
+            try:
+                self.export(*document)
+                return None
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=max_workers or self.max_workers) as executor:
+            return list(executor.map(export_one, documents))
+
+    def close(self, failed=False):
+        """Stop the pandoc server, if one was started"""
+        with self.lock:
+            server, self.server, self.server_url = self.server, None, None
+            if failed:
+                self.server_failed = True
+        if server is not None and server.poll() is None:
+            server.terminate()
+            try:
+                server.wait(timeout=5)
+            except Exception:
+                server.kill()
+
+pandoc_backend = PandocBackend()
+atexit.register(pandoc_backend.close)
+
+def pandoc_export(text, output_path):
+    """Convert Markdown text to .docx with pandoc; raises RuntimeError if pandoc reports an error"""
+    pandoc_backend.export(text, output_path)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff')
+
+def load_saved_api_key():
+    try:
+        if os.path.exists('api_key.txt'):
+            with open('api_key.txt', 'r') as f:
+                return f.read().strip()
+    except Exception as e:
+        print(f"Error loading API key: {str(e)}", file=sys.stderr)
+    return ""
+
+def convert_document(client, input_paths, upload_cache=None, result_cache=None, use_cache=True,
+                     chunk_settings=None, preprocess_settings=None, inline_small_images=True,
+                     on_chunk=None, on_progress=None, on_notice=None, should_stop=None, metrics=None,
+                     model=DEFAULT_MODEL, text_layer=True):
+    """Convert one PDF, or a set of images read as one document, to Markdown text
+
+    Raw model output goes through the result cache under the same keys the PDF and image
+    tabs use. model is a model name or 'auto'. With text_layer, PDF pages with a clean
+    embedded text layer are converted locally. Returns (text with formulas processed,
+    whether it came from the cache).
+    """
+    is_pdf = input_paths[0].lower().endswith('.pdf')
+    if is_pdf:
+        prompt = PDF_PROMPT
+        content_hash = file_sha256(input_paths[0])
+    else:
+        prompt = build_image_prompt(len(input_paths))
+        content_hash = hashlib.sha256("".join(file_sha256(path) for path in input_paths).encode('utf-8')).hexdigest()
+
+    text_layer = text_layer and is_pdf
+    if is_pdf:
+        variant = TEXT_LAYER_SECTION if text_layer else ""
+    else:
+        # Resized or grayscale images can read differently, so they are cached apart from the originals
+        variant = preprocess_variant(preprocess_settings)
+    cache_key = ResultCache.make_key(content_hash, prompt, model, variant)
+    raw_text = result_cache.get(cache_key) if result_cache and use_cache else None
+    from_cache = raw_text is not None
+    if raw_text is None:
+        if is_pdf:
+            if not use_cache:
+                # A forced re-conversion does not resume an old checkpoint either
+                ConversionJournal(cache_key).discard()
+            if chunk_settings is None and pdf_page_count(input_paths[0]) >= LONG_DOCUMENT_PAGES:
+                chunk_settings = DEFAULT_CHUNK_SETTINGS
+            raw_text = convert_pdf(client, input_paths[0], prompt, upload_cache=upload_cache,
+                                   chunk_settings=chunk_settings, on_chunk=on_chunk, on_progress=on_progress,
+                                   on_notice=on_notice, should_stop=should_stop, metrics=metrics,
+                                   journal_key=cache_key, model=model, text_layer=text_layer)
+        else:
+            raw_text = convert_images(client, input_paths, prompt, upload_cache=upload_cache,
+                                      preprocess_settings=preprocess_settings,
+                                      inline_small_images=inline_small_images, on_chunk=on_chunk,
+                                      on_notice=on_notice, should_stop=should_stop, metrics=metrics,
+                                      model=model)
+        if result_cache:
+            result_cache.put(cache_key, raw_text)
+    elif metrics:
+        metrics.from_cache = True
+
+    with metrics_stage(metrics, 'postprocess'):
+        text = process_formulas(raw_text)
+    if metrics:
+        metrics.add('text_bytes', len(text.encode('utf-8')))
+    return text, from_cache
+
+QUEUE_DIR = os.path.join(APP_DATA_DIR, 'queue')
+# Lower rank runs first
+QUEUE_PRIORITIES = {'High': 0, 'Normal': 1, 'Low': 2}
+
+class JobQueue:
+    """Persistent list of conversion jobs, run highest priority first and FIFO within a priority
+
+    A job is a dict with id, kind ('pdf' or 'images'), inputs, name, priority, status
+    ('queued', 'running', 'done', 'failed' or 'cancelled'), error, timestamps and, once
+    done, the path of its Markdown result. Jobs still running when the app closed are
+    queued again on the next start.
+    """
+
+    def __init__(self, queue_dir=None):
+        self.queue_dir = queue_dir or QUEUE_DIR
+        self.index_path = os.path.join(self.queue_dir, 'queue.json')
+        self.lock = threading.Lock()
+        self.jobs = []
+        try:
+            if os.path.exists(self.index_path):
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    self.jobs = json.load(f)
+        except Exception as e:
+            print(f"Error loading job queue: {e}", file=sys.stderr)
+            self.jobs = []
+        for job in self.jobs:
+            if job['status'] == 'running':
+                job['status'] = 'queued'
+
+    def add(self, kind, inputs, priority='Normal', model=DEFAULT_MODEL):
+        name = os.path.basename(inputs[0])
+        if len(inputs) > 1:
+            name += f" (+{len(inputs) - 1} images)"
+        job = {'id': uuid.uuid4().hex, 'kind': kind, 'inputs': list(inputs), 'name': name,
+               'priority': priority, 'model': model, 'status': 'queued', 'error': None, 'from_cache': False,
+               'created': time.time(), 'finished': None, 'result_path': None}
+        with self.lock:
+            self.jobs.append(job)
+            self.save()
+        return dict(job)
+
+    def take_next(self):
+        """Mark the best queued job as running and return a copy of it, or None"""
+        with self.lock:
+            queued = [job for job in self.jobs if job['status'] == 'queued']
+            if not queued:
+                return None
+            # sorted() is stable, so jobs of equal priority keep their queue order
+            job = sorted(queued, key=lambda job: QUEUE_PRIORITIES.get(job['priority'], 1))[0]
+            job['status'] = 'running'
+            job['error'] = None
+            self.save()
+            return dict(job)
+
+    def update(self, job_id, **fields):
+        with self.lock:
+            for job in self.jobs:
+                if job['id'] == job_id:
+                    job.update(fields)
+                    self.save()
+                    return dict(job)
+        return None
+
+    def get(self, job_id):
+        with self.lock:
+            for job in self.jobs:
+                if job['id'] == job_id:
+                    return dict(job)
+        return None
+
+    def remove(self, job_id):
+        with self.lock:
+            for job in self.jobs:
+                if job['id'] == job_id:
+                    self.jobs.remove(job)
+                    self.save()
+                    if job['result_path']:
+                        try:
+                            os.unlink(job['result_path'])
+                        except OSError:
+                            pass
+                    return
+
+    def snapshot(self):
+        with self.lock:
+            return [dict(job) for job in self.jobs]
+
+    def result_path(self, job_id):
+        return os.path.join(self.queue_dir, f"{job_id}.md")
+
+    def save(self):
+        try:
+            write_json_atomic(self.index_path, self.jobs)
+        except Exception as e:
+            print(f"Error saving job queue: {e}", file=sys.stderr)
+
+def unique_output_stems(paths):
+    """Output file names without extension for paths, suffixing -2, -3, ... where names repeat
+
+    a/x.pdf and b/x.pdf would otherwise overwrite each other's exports in one output directory.
+    Names are compared case-insensitively so the result is also safe on Windows and macOS.
+    """
+    stems = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    taken = {stem.casefold() for stem in stems}
+    seen = set()
+    unique = []
+    for stem in stems:
+        name = stem
+        if stem.casefold() in seen:
+            suffix = 2
+            while f"{stem}-{suffix}".casefold() in taken:
+                suffix += 1
+            name = f"{stem}-{suffix}"
+            taken.add(name.casefold())
+        seen.add(stem.casefold())
+        unique.append(name)
+    return unique
+
+def convert_file_job(client, input_path, args, upload_cache, result_cache, output_stem=None):
+    """Convert and export one input file for the CLI; returns a summary record"""
+    started = time.monotonic()
+    record = {'input': input_path, 'status': 'ok', 'from_cache': False, 'outputs': []}
+    metrics = JobMetrics('pdf' if input_path.lower().endswith('.pdf') else 'image', input_path, model=args.model)
+
+    def on_notice(message):
+        print(f"[{os.path.basename(input_path)}] {message}", file=sys.stderr)
+
+    try:
+        is_pdf = input_path.lower().endswith('.pdf')
+        chunk_settings = None
+        if args.chunk_pages > 0:
+            chunk_settings = {'pages_per_chunk': args.chunk_pages, 'max_workers': args.chunk_workers}
+        preprocess_settings = None
+        if args.optimize_images:
+            preprocess_settings = {'max_edge': args.max_edge, 'grayscale': args.grayscale,
+                                   'image_format': args.image_format}
+        text, record['from_cache'] = convert_document(
+            client, [input_path], upload_cache, result_cache, use_cache=not args.no_cache,
+            chunk_settings=chunk_settings, preprocess_settings=preprocess_settings,
+            inline_small_images=not args.no_inline, on_notice=on_notice, metrics=metrics, model=args.model,
+            text_layer=not args.no_text_layer)
+        default_stem = os.path.splitext(os.path.basename(input_path))[0]
+        if output_stem and output_stem != default_stem:
+            on_notice(f"another input has the same name, writing {output_stem}.* instead")
+        base_path = os.path.join(args.output_dir, output_stem or default_stem)
+
+        with open(base_path + '.md', 'w', encoding='utf-8') as f:
+            f.write(text)
+        record['outputs'].append(base_path + '.md')
+
+        with metrics.stage('export'):
+            images = None
+            if not is_pdf:
+                images = [{'path': input_path, 'filename': os.path.basename(input_path), 'index': 1}]
+            if args.export in ('docx', 'both'):
+                export_docx(text, base_path + '.docx', images=images, engine=args.docx_engine)
+                record['outputs'].append(base_path + '.docx')
+            if args.export in ('pandoc', 'both'):
+                pandoc_path = base_path + ('.pandoc.docx' if args.export == 'both' else '.docx')
+                try:
+                    pandoc_export(text, pandoc_path)
+                except FileNotFoundError:
+                    # The built-in exporter writes formulas as native Word equations too
+                    on_notice("pandoc not found, using the built-in docx export")
+                    export_docx(text, pandoc_path, images=images, engine=args.docx_engine)
+                record['outputs'].append(pandoc_path)
+        metrics.add('output_bytes', sum(os.path.getsize(path) for path in record['outputs']))
+
+    except Exception as e:
+        record['status'] = 'failed'
+        record['error'] = str(e)
+
+    record['seconds'] = round(time.monotonic() - started, 3)
+    metrics.status = record['status']
+    metrics_recorder.record(metrics)
+    job_record = metrics.to_record()
+    record['metrics'] = {'stages': job_record['stages'], 'counters': job_record['counters'],
+                         'sections': job_record['sections']}
+    return record
+
+def run_cli(argv):
+    """Headless batch conversion: python main.py convert INPUT [INPUT ...] -o OUTPUT_DIR [--jobs N]"""
+    parser = argparse.ArgumentParser(prog='pdf2word convert',
+                                     description='Convert PDFs and images to Word documents without the GUI.')
+    parser.add_argument('inputs', nargs='+', help='input files or glob patterns (PDF or image files)')
+    parser.add_argument('-o', '--output-dir', required=True, help='directory for .md and .docx outputs')
+    parser.add_argument('-j', '--jobs', type=int, default=2,
+                        help='documents converted concurrently; their API calls share the --max-concurrent slots')
+    parser.add_argument('--export', choices=['docx', 'pandoc', 'both', 'none'], default='docx',
+                        help='Word export engine (default: docx via python-docx)')
+    parser.add_argument('--pandoc-workers', type=int, default=4,
+                        help='pandoc conversions run at once; one pandoc server is shared when available')
+    parser.add_argument('--docx-engine', choices=['python-docx', 'streaming'], default='python-docx',
+                        help='how the docx export is written; streaming keeps memory flat for very long documents')
+    parser.add_argument('--model', default=DEFAULT_MODEL,
+                        help=f"Gemini model, or '{AUTO_MODEL}' to route simple pages to {ROUTER_FAST_MODEL} "
+                             f"and complex ones to {ROUTER_STRONG_MODEL} (default: {DEFAULT_MODEL})")
+    parser.add_argument('--chunk-pages', type=int, default=0,
+                        help='split PDFs into chunks of this many pages (0 = one request per PDF)')
+    parser.add_argument('--chunk-workers', type=int, default=4,
+                        help='parallel chunks per PDF, at most --max-concurrent')
+    parser.add_argument('--optimize-images', action='store_true',
+                        help='downscale and re-encode images before upload')
+    parser.add_argument('--max-edge', type=int, default=2048, help='longest image edge when optimizing')
+    parser.add_argument('--grayscale', action='store_true', help='convert optimized images to grayscale')
+    parser.add_argument('--image-format', choices=sorted(PREPROCESS_EXTENSIONS), default='JPEG',
+                        help='format for optimized images')
+    parser.add_argument('--no-inline', action='store_true',
+                        help='upload every image through the Files API, even small ones')
+    parser.add_argument('--api-key', help='Gemini API key (default: $GEMINI_API_KEY or api_key.txt)')
+    parser.add_argument('--no-cache', action='store_true', help='ignore cached results and convert again')
+    parser.add_argument('--no-text-layer', action='store_true',
+                        help='send every PDF page to the model, even pages with a clean embedded text layer')
+    parser.add_argument('--request-timeout', type=float, default=REQUEST_TIMEOUT_SECONDS,
+                        help='seconds a Gemini request may stall on the network before it is retried')
+    parser.add_argument('--max-concurrent', type=int,
+                        help='Gemini calls in flight at once across all jobs (default: saved setting or 4)')
+    parser.add_argument('--requests-per-minute', type=int,
+                        help='generation requests started per minute (default: saved setting or 60)')
+    parser.add_argument('--burst', type=int,
+                        help='requests that may start back to back before the rate applies (default: saved setting or 5)')
+    args = parser.parse_args(argv)
+
+    # Saved limits first, then the flags of this run; the flags are not saved
+    load_api_limits()
+    api_scheduler.configure(rate_per_minute=max(0, args.requests_per_minute or 0),
+                            burst=max(0, args.burst or 0), max_concurrent=max(0, args.max_concurrent or 0))
+    max_concurrent = api_scheduler.limits()['max_concurrent']
+    if args.chunk_workers > max_concurrent:
+        # More workers than slots would only queue inside the scheduler
+        print(f"--chunk-workers {args.chunk_workers} is above --max-concurrent {max_concurrent}; "
+              f"using {max_concurrent}", file=sys.stderr)
+        args.chunk_workers = max_concurrent
+
+    input_paths = []
+    for pattern in args.inputs:
+        matches = glob.glob(pattern, recursive=True) if glob.has_magic(pattern) else [pattern]
+        for path in sorted(matches):
+            if path.lower().endswith(('.pdf',) + IMAGE_EXTENSIONS) and os.path.isfile(path) \
+                    and path not in input_paths:
+                input_paths.append(path)
+
+    if not input_paths:
+        print(json.dumps({'error': 'No PDF or image files matched the inputs'}))
+        return 2
+
+    api_key = args.api_key or os.environ.get('GEMINI_API_KEY') or load_saved_api_key()
+    if not api_key:
+        print(json.dumps({'error': 'No API key: pass --api-key, set GEMINI_API_KEY or create api_key.txt'}))
+        return 2
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    client = make_client(api_key, timeout=args.request_timeout)
+    upload_cache = UploadCache(account=api_key)
+    result_cache = ResultCache()
+    pandoc_backend.set_max_workers(args.pandoc_workers)
+
+    # Settled before any job starts so parallel jobs never write the same output files
+    output_stems = unique_output_stems(input_paths)
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        records = list(executor.map(
+            lambda path, stem: convert_file_job(client, path, args, upload_cache, result_cache, output_stem=stem),
+            input_paths, output_stems
+        ))
+    upload_cache.flush()
+
+    failed = sum(1 for record in records if record['status'] != 'ok')
+    summary = {
+        'total': len(records),
+        'succeeded': len(records) - failed,
+        'failed': failed,
+        'seconds': round(time.monotonic() - started, 3),
+        'api': api_scheduler.stats(),
+        'jobs': records
+    }
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    return 0 if failed == 0 else 1
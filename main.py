@@ -1,19 +1,165 @@
+import time
+# Reference point for the startup probe, taken before any other import
+STARTUP_TIME = time.perf_counter()
+
 import sys
+import multiprocessing
+
+if __name__ == '__main__':
+    # Required for the preprocessing process pool in the frozen Windows build
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1 and sys.argv[1] == 'convert':
+        # Headless batch conversion runs on the conversion core alone, without loading Qt
+        import converter
+        converter.setup_logging()
+        sys.exit(converter.run_cli(sys.argv[2:]))
+
 import os
-import re
 import tempfile
-import subprocess
 import shutil
-from docx import Document
-from docx.shared import Inches
+import json
+import hashlib
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from PyQt6.QtWidgets import (QApplication, QWidget, QVBoxLayout, QPushButton, QTextEdit, QFileDialog,
                              QLabel, QHBoxLayout, QLineEdit, QMessageBox, QProgressBar,
-                             QScrollArea, QDialog, QGridLayout, QTabWidget)
-from PyQt6.QtCore import Qt, QThread, pyqtSignal
-from PyQt6.QtGui import QPixmap, QClipboard
-from google import genai
-from PIL import Image
-import io
+                             QDialog, QTabWidget, QCheckBox, QSpinBox,
+                             QComboBox, QListView, QTableWidget, QTableWidgetItem, QHeaderView,
+                             QAbstractItemView)
+from PyQt6.QtCore import Qt, QThread, QTimer, QSize, QAbstractListModel, QModelIndex, pyqtSignal
+from PyQt6.QtGui import QPixmap, QClipboard, QTextCursor, QImage, QImageReader
+from converter import (AUTO_MODEL, APP_DATA_DIR, CONTEXT_CACHE_CLEAR_SECONDS, CONTEXT_CACHE_TTL_SECONDS,
+                       DEFAULT_CHUNK_SETTINGS, DEFAULT_MODEL, EXPECTED_BYTES_PER_PAGE, IMAGE_EXTENSIONS,
+                       LONG_DOCUMENT_PAGES, MODEL_CHOICES, PDF_PROMPT, PREPROCESS_EXTENSIONS,
+                       QUEUE_PRIORITIES, ROUTER_FAST_MODEL, ROUTER_STRONG_MODEL, STREAMING_EXPORT_MIN_CHARS,
+                       TEXT_LAYER_SECTION, CancelToken, ContextCache, ConversionCancelled, ConversionJournal,
+                       InlineBudget, JobMetrics, JobQueue, ResultCache, UploadCache, api_scheduler,
+                       build_image_prompt, convert_document, convert_pdf, describe_preprocess, export_docx,
+                       file_sha256, generate_image_text, load_api_limits, make_client, metrics_recorder,
+                       metrics_stage, pandoc_backend, pandoc_export, pdf_page_count, preprocess_images,
+                       preprocess_variant, process_formulas, route_images, save_api_limits, setup_logging,
+                       unique_output_stems, upload_file)
+
+THUMBNAIL_DIR = os.path.join(APP_DATA_DIR, 'thumbnails')
+THUMBNAIL_SIZE = 300
+
+def thumbnail_cache_path(image_path):
+    """Cache file for an image's thumbnail; any change to path, mtime or size gives a new key"""
+    stat = os.stat(image_path)
+    key = f"{os.path.abspath(image_path)}|{stat.st_mtime_ns}|{stat.st_size}|{THUMBNAIL_SIZE}"
+    return os.path.join(THUMBNAIL_DIR, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.png')
+
+class ThumbnailLoader(QThread):
+    """Generate thumbnails off the GUI thread, newest request first, through the on-disk cache"""
+    thumbnail_ready = pyqtSignal(int, QImage)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.requests = []
+        self.condition = threading.Condition()
+        self.is_running = True
+
+    def request(self, row, path):
+        with self.condition:
+            self.requests.append((row, path))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.is_running and not self.requests:
+                    self.condition.wait()
+                if not self.is_running:
+                    return
+                # Most recent requests are the cells the user is looking at now
+                row, path = self.requests.pop()
+            image = self.load_thumbnail(path)
+            if self.is_running:
+                self.thumbnail_ready.emit(row, image)
+
+    def load_thumbnail(self, path):
+        try:
+            cache_path = thumbnail_cache_path(path)
+        except OSError:
+            return QImage()
+        if os.path.exists(cache_path):
+            image = QImage(cache_path)
+            if not image.isNull():
+                return image
+
+        reader = QImageReader(path)
+        reader.setAutoTransform(True)
+        size = reader.size()
+        if size.isValid():
+            # Let the decoder downscale (cheap for JPEG) instead of decoding full resolution
+            reader.setScaledSize(size.scaled(THUMBNAIL_SIZE, THUMBNAIL_SIZE, Qt.AspectRatioMode.KeepAspectRatio))
+        image = reader.read()
+        if image.isNull():
+            print(f"Error loading image {path}: {reader.errorString()}")
+            return image
+
+        image = image.scaled(THUMBNAIL_SIZE, THUMBNAIL_SIZE, Qt.AspectRatioMode.KeepAspectRatio,
+                             Qt.TransformationMode.SmoothTransformation)
+        try:
+            os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+            image.save(cache_path, 'PNG')
+        except OSError as e:
+            print(f"Error caching thumbnail for {path}: {e}")
+        return image
+
+    def stop(self):
+        with self.condition:
+            self.is_running = False
+            self.condition.notify()
+
+class ThumbnailModel(QAbstractListModel):
+    """List model that asks for thumbnails only when a view paints the row"""
+
+    def __init__(self, images, loader, max_cached=48, parent=None):
+        super().__init__(parent)
+        self.images = images
+        self.loader = loader
+        self.max_cached = max_cached
+        # Small LRU of pixmaps so memory follows what is on screen, not the batch size
+        self.pixmaps = {}
+        self.requested = set()
+        placeholder = QPixmap(THUMBNAIL_SIZE, THUMBNAIL_SIZE)
+        placeholder.fill(Qt.GlobalColor.lightGray)
+        self.placeholder = placeholder
+        loader.thumbnail_ready.connect(self.on_thumbnail_ready)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.images)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        row = index.row()
+        img_info = self.images[row]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return (f"HÌNH ẢNH {row+1}\nKích thước: {img_info.get('size_info', 'N/A')}\n"
+                    f"Nguồn: {img_info.get('source', 'N/A')}")
+        if role == Qt.ItemDataRole.DecorationRole:
+            pixmap = self.pixmaps.pop(row, None)
+            if pixmap is not None:
+                self.pixmaps[row] = pixmap
+                return pixmap
+            if row not in self.requested:
+                self.requested.add(row)
+                self.loader.request(row, img_info['path'])
+            return self.placeholder
+        return None
+
+    def on_thumbnail_ready(self, row, image):
+        self.requested.discard(row)
+        if image.isNull():
+            return
+        self.pixmaps[row] = QPixmap.fromImage(image)
+        while len(self.pixmaps) > self.max_cached:
+            del self.pixmaps[next(iter(self.pixmaps))]
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.ItemDataRole.DecorationRole])
 
 class ImagePreviewDialog(QDialog):
     def __init__(self, images, parent=None):
@@ -27,56 +173,21 @@ class ImagePreviewDialog(QDialog):
 
         layout = QVBoxLayout()
 
-        # Create scroll area
-        scroll = QScrollArea()
-        scroll.setWidgetResizable(True)
-
-        # Create widget to hold images
-        content_widget = QWidget()
-        grid_layout = QGridLayout(content_widget)
-
-        # Add images to grid (2 columns)
-        row = 0
-        col = 0
-        for i, img_info in enumerate(self.images):
-            try:
-                # Create label for image
-                img_label = QLabel()
-                pixmap = QPixmap(img_info['path'])
-
-                # Scale image to fit
-                scaled_pixmap = pixmap.scaled(300, 300, Qt.AspectRatioMode.KeepAspectRatio,
-                                            Qt.TransformationMode.SmoothTransformation)
-                img_label.setPixmap(scaled_pixmap)
-                img_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-
-                # Create info label
-                info_text = f"HÌNH ẢNH {i+1}\nKích thước: {img_info.get('size_info', 'N/A')}\nNguồn: {img_info.get('source', 'N/A')}"
-                info_label = QLabel(info_text)
-                info_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-                info_label.setStyleSheet("font-weight: bold; margin: 5px; padding: 5px; border: 1px solid #ccc; border-radius: 3px;")
-
-                # Add to grid
-                img_container = QVBoxLayout()
-                img_container.addWidget(info_label)
-                img_container.addWidget(img_label)
-
-                container_widget = QWidget()
-                container_widget.setLayout(img_container)
-
-                grid_layout.addWidget(container_widget, row, col)
-
-                # Move to next position
-                col += 1
-                if col >= 2:  # 2 columns
-                    col = 0
-                    row += 1
-
-            except Exception as e:
-                print(f"Error loading image {i+1}: {e}")
-
-        scroll.setWidget(content_widget)
-        layout.addWidget(scroll)
+        # Thumbnails load in the background as cells scroll into view
+        self.loader = ThumbnailLoader(self)
+        self.model = ThumbnailModel(self.images, self.loader, parent=self)
+
+        # Icon-mode list view: only visible cells are painted, no widget per image
+        view = QListView()
+        view.setViewMode(QListView.ViewMode.IconMode)
+        view.setResizeMode(QListView.ResizeMode.Adjust)
+        view.setMovement(QListView.Movement.Static)
+        view.setUniformItemSizes(True)
+        view.setIconSize(QSize(THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        view.setGridSize(QSize(THUMBNAIL_SIZE + 40, THUMBNAIL_SIZE + 80))
+        view.setWordWrap(True)
+        view.setModel(self.model)
+        layout.addWidget(view)
 
         # Close button
         close_button = QPushButton('Đóng')
@@ -84,59 +195,311 @@ class ImagePreviewDialog(QDialog):
         layout.addWidget(close_button)
 
         self.setLayout(layout)
+        self.loader.start()
+
+    def done(self, result):
+        self.loader.stop()
+        self.loader.wait()
+        super().done(result)
 
 class ConversionThread(QThread):
     progress = pyqtSignal(int)
+    chunk_received = pyqtSignal(str)
+    # Partial text of a streamed attempt that is about to be retried
+    stream_reset = pyqtSignal(str)
+    notice = pyqtSignal(str)
     finished = pyqtSignal(str)
     error = pyqtSignal(str)
 
-    def __init__(self, client, uploaded_file, prompt):
+    def __init__(self, client, uploaded_file, prompt, expected_bytes=EXPECTED_BYTES_PER_PAGE, metrics=None,
+                 model=DEFAULT_MODEL, file_path=None, upload_cache=None, journal_key=None, context_cache=None,
+                 text_layer=False):
         super().__init__()
         self.client = client
         self.uploaded_file = uploaded_file
         self.prompt = prompt
-        self.max_retries = 3
-        self.retry_delay = 60
+        self.expected_bytes = max(1, expected_bytes)
+        self.metrics = metrics
+        self.model = model
+        # Local copy of the uploaded PDF: scored for 'auto', split if it will not fit one response
+        self.file_path = file_path
+        self.upload_cache = upload_cache
+        self.journal_key = journal_key
+        self.context_cache = context_cache
+        self.text_layer = text_layer
         self.is_running = True
+        self.cancel_token = CancelToken()
 
     def run(self):
-        for attempt in range(self.max_retries):
+        try:
+            self.progress.emit(0)
+            text = convert_pdf(self.client, self.file_path, self.prompt, upload_cache=self.upload_cache,
+                               on_chunk=self.on_chunk, on_progress=self.progress.emit, on_notice=self.notice.emit,
+                               should_stop=self.cancel_token, metrics=self.metrics, journal_key=self.journal_key,
+                               model=self.model, uploaded_file=self.uploaded_file,
+                               context_cache=self.context_cache, text_layer=self.text_layer,
+                               on_reset=self.stream_reset.emit)
             if not self.is_running:
                 return
-            try:
-                # Simulate progress
-                for i in range(0, 51):
-                    if not self.is_running:
-                        return
-                    self.progress.emit(i)
-                    self.msleep(50)
-
-                # Progress simulation during generation
-                for i in range(51, 101):
-                    if not self.is_running:
-                        return
-                    self.progress.emit(i)
-                    self.msleep(30)
-
-                # Generate content using new simplified API
-                response = self.client.models.generate_content(
-                    model="gemini-2.5-flash",
-                    contents=[self.uploaded_file, self.prompt],
-                )
 
-                self.finished.emit(response.text)
-                return
+            self.progress.emit(100)
+            self.finished.emit(text)
 
-            except Exception as e:
-                if "429" in str(e) and attempt < self.max_retries - 1:
-                    self.error.emit(f"Rate limit exceeded. Retrying in {self.retry_delay} seconds...")
-                    self.msleep(self.retry_delay * 1000)
-                else:
-                    self.error.emit(str(e))
-                    return
+        except ConversionCancelled:
+            return
+        except Exception as e:
+            self.error.emit(str(e))
+
+    def on_chunk(self, text, received_bytes):
+        self.chunk_received.emit(text)
+        # Streamed output never reaches 100% until the response is complete
+        self.progress.emit(min(99, received_bytes * 100 // self.expected_bytes))
+
+    def stop(self):
+        self.is_running = False
+        self.cancel_token.cancel()
+
+class ChunkedConversionThread(QThread):
+    """Convert a PDF as page ranges in parallel and reassemble the text in page order"""
+    progress = pyqtSignal(int)
+    notice = pyqtSignal(str)
+    finished = pyqtSignal(str)
+    error = pyqtSignal(str)
+
+    def __init__(self, client, file_path, prompt, pages_per_chunk=10, max_workers=4, upload_cache=None,
+                 metrics=None, journal_key=None, model=DEFAULT_MODEL, text_layer=False, context_cache=None):
+        super().__init__()
+        self.client = client
+        self.upload_cache = upload_cache
+        self.journal_key = journal_key
+        self.model = model
+        self.text_layer = text_layer
+        self.context_cache = context_cache
+        self.file_path = file_path
+        self.prompt = prompt
+        self.pages_per_chunk = pages_per_chunk
+        self.max_workers = max_workers
+        self.metrics = metrics
+        self.is_running = True
+        self.cancel_token = CancelToken()
+
+    def run(self):
+        try:
+            text = convert_pdf(self.client, self.file_path, self.prompt,
+                               chunk_settings={'pages_per_chunk': self.pages_per_chunk,
+                                               'max_workers': self.max_workers},
+                               upload_cache=self.upload_cache,
+                               on_progress=self.progress.emit,
+                               on_notice=self.notice.emit,
+                               should_stop=self.cancel_token,
+                               metrics=self.metrics,
+                               journal_key=self.journal_key,
+                               model=self.model,
+                               context_cache=self.context_cache,
+                               text_layer=self.text_layer)
+        except ConversionCancelled:
+            return
+        except Exception as e:
+            self.error.emit(str(e))
+            return
+
+        if not self.is_running:
+            return
+
+        self.finished.emit(text)
+
+    def stop(self):
+        self.is_running = False
+        self.cancel_token.cancel()
+
+class PdfUploadThread(QThread):
+    """Hash a newly chosen PDF, count its pages and, unless the text layer is used, upload it
+
+    Reports (uploaded file or None, SHA-256 digest, page count) through finished.
+    """
+    finished = pyqtSignal(object, str, int)
+    error = pyqtSignal(str)
+
+    def __init__(self, client, upload_cache, file_path, upload=True, metrics=None):
+        super().__init__()
+        self.client = client
+        self.upload_cache = upload_cache
+        self.file_path = file_path
+        self.upload = upload
+        self.metrics = metrics
+        self.is_running = True
+        self.cancel_token = CancelToken()
+
+    def run(self):
+        try:
+            file_hash = file_sha256(self.file_path)
+            uploaded_file = None
+            if self.upload:
+                # Reuses a live handle for identical bytes
+                uploaded_file = upload_file(self.client, self.file_path, self.upload_cache, digest=file_hash,
+                                            max_retries=0, should_stop=self.cancel_token, metrics=self.metrics)
+                print(f"File uploaded successfully: {uploaded_file.uri}")
+            # Page count scales the streaming progress bar
+            page_count = pdf_page_count(self.file_path)
+        except ConversionCancelled:
+            return
+        except Exception as e:
+            print(f"Error processing PDF: {e}", file=sys.stderr)
+            if self.is_running:
+                self.error.emit(str(e))
+            return
+
+        if self.is_running:
+            self.finished.emit(uploaded_file, file_hash, page_count)
+
+    def stop(self):
+        self.is_running = False
+        self.cancel_token.cancel()
+
+class ImageUploadThread(QThread):
+    """Hash, optionally preprocess, then upload a batch of images concurrently, reporting per image
+
+    With cache_key_parts (prompt, model, variant) the result-cache key of the batch is
+    emitted through hashed once the images are hashed; a hit in result_cache is emitted
+    through cached and nothing is uploaded.
+    """
+    progress = pyqtSignal(int)
+    image_status = pyqtSignal(int, str)
+    notice = pyqtSignal(str)
+    hashed = pyqtSignal(list, str)
+    cached = pyqtSignal(str)
+    error = pyqtSignal(str)
+    finished = pyqtSignal(list, list)
+
+    def __init__(self, client, upload_cache, images, max_workers=4, uploaded_files=None,
+                 preprocess_settings=None, inline_budget=None, metrics=None, cache_key_parts=None,
+                 result_cache=None):
+        super().__init__()
+        self.client = client
+        self.upload_cache = upload_cache
+        # images: [(path, sha256 digest or None), ...]
+        self.images = images
+        self.cache_key_parts = cache_key_parts
+        self.result_cache = result_cache
+        self.max_workers = max_workers
+        self.preprocess_settings = preprocess_settings
+        # Small images skip the Files API and go inline while the budget lasts
+        self.inline_budget = inline_budget
+        # Handles from an earlier attempt; only the missing ones are uploaded again
+        self.uploaded_files = list(uploaded_files) if uploaded_files else [None] * len(images)
+        # Individual images give up sooner than whole conversions
+        self.max_retries = 2
+        self.metrics = metrics
+        self.is_running = True
+        self.cancel_token = CancelToken()
+
+    def run(self):
+        if any(digest is None for _, digest in self.images) and not self.hash_images():
+            return
+        pending = [index for index, handle in enumerate(self.uploaded_files) if handle is None]
+        failed = []
+        self.completed = len(self.images) - len(pending)
+        self.progress.emit(int(self.completed * 100 / max(1, len(self.images))))
+
+        if self.inline_budget:
+            # Parts kept from an earlier attempt still take up room in the request
+            for handle in self.uploaded_files:
+                if handle is not None and getattr(handle, 'inline_data', None):
+                    self.inline_budget.reserve(len(handle.inline_data.data))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {}
+            if self.preprocess_settings and pending:
+                # Each image is uploaded as soon as its preprocessing finishes
+                saved_bytes = 0
+                paths = [self.images[index][0] for index in pending]
+                with metrics_stage(self.metrics, 'preprocess'), \
+                        contextlib.closing(preprocess_images(paths, self.preprocess_settings)) as results:
+                    for position, result, error in results:
+                        if not self.is_running:
+                            break
+                        index = pending[position]
+                        if error is not None:
+                            self.image_status.emit(index, f"preprocessing failed, uploading original: {error}")
+                            self.dispatch(executor, futures, index, self.images[index][0])
+                            continue
+                        saved_bytes += result['original_bytes'] - result['processed_bytes']
+                        self.image_status.emit(index, describe_preprocess(result))
+                        self.dispatch(executor, futures, index, result['path'])
+                self.notice.emit(f"Preprocessing saved {saved_bytes / 1024:.0f} KB in total")
+            else:
+                for index in pending:
+                    self.dispatch(executor, futures, index, self.images[index][0])
+
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    self.uploaded_files[index] = future.result()
+                    self.image_status.emit(index, "uploaded")
+                except ConversionCancelled:
+                    failed.append(index)
+                    self.image_status.emit(index, "cancelled")
+                except Exception as e:
+                    failed.append(index)
+                    self.image_status.emit(index, f"failed: {str(e)}")
+                self.completed += 1
+                self.progress.emit(int(self.completed * 100 / max(1, len(self.images))))
+
+        if not self.is_running:
+            return
+        self.finished.emit(self.uploaded_files, sorted(failed))
+
+    def hash_images(self):
+        """Fill in the missing digests and check the result cache; False when nothing is left to upload"""
+        try:
+            digests = [digest or file_sha256(path) for path, digest in self.images]
+        except OSError as e:
+            self.error.emit(f"Failed to read images: {str(e)}")
+            return False
+        self.images = [(path, digest) for (path, _), digest in zip(self.images, digests)]
+
+        cache_key = ""
+        if self.cache_key_parts:
+            content_hash = hashlib.sha256("".join(digests).encode('utf-8')).hexdigest()
+            cache_key = ResultCache.make_key(content_hash, *self.cache_key_parts)
+        if not self.is_running:
+            return False
+        self.hashed.emit(digests, cache_key)
+
+        text = self.result_cache.get(cache_key) if cache_key and self.result_cache else None
+        if text is not None:
+            self.cached.emit(text)
+            return False
+        return True
+
+    def dispatch(self, executor, futures, index, path):
+        # Inline small images right away; everything else goes to the upload pool
+        part = None
+        if self.inline_budget:
+            try:
+                part = self.inline_budget.try_inline(path)
+            except OSError as e:
+                self.image_status.emit(index, f"could not read for inline send, uploading: {e}")
+        if part is not None:
+            self.uploaded_files[index] = part
+            self.image_status.emit(index, f"sent inline ({len(part.inline_data.data) / 1024:.0f} KB)")
+            self.completed += 1
+            self.progress.emit(int(self.completed * 100 / max(1, len(self.images))))
+            return
+        futures[executor.submit(self.upload_image, index, path)] = index
+
+    def upload_image(self, index, upload_path=None):
+        path, digest = self.images[index]
+        if upload_path and upload_path != path:
+            # A preprocessed copy has its own content hash
+            path, digest = upload_path, None
+        return upload_file(self.client, path, self.upload_cache, digest=digest,
+                           should_stop=self.cancel_token, max_retries=self.max_retries,
+                           metrics=self.metrics)
 
     def stop(self):
         self.is_running = False
+        self.cancel_token.cancel()
 
 class WordTab(QWidget):
     def __init__(self, parent=None):
@@ -158,6 +521,40 @@ class WordTab(QWidget):
         self.convert_button.setEnabled(False)
         layout.addWidget(self.convert_button)
 
+        # Page-chunked parallel conversion for long PDFs
+        chunk_layout = QHBoxLayout()
+        self.chunked_checkbox = QCheckBox('Split into page chunks (parallel)')
+        self.pages_per_chunk_spin = QSpinBox()
+        self.pages_per_chunk_spin.setRange(1, 100)
+        self.pages_per_chunk_spin.setValue(10)
+        self.workers_spin = QSpinBox()
+        self.workers_spin.setRange(1, 16)
+        self.workers_spin.setValue(4)
+        self.workers_spin.setToolTip("At most the 'Concurrent requests' limit")
+        chunk_layout.addWidget(self.chunked_checkbox)
+        chunk_layout.addWidget(QLabel('Pages per chunk:'))
+        chunk_layout.addWidget(self.pages_per_chunk_spin)
+        chunk_layout.addWidget(QLabel('Workers:'))
+        chunk_layout.addWidget(self.workers_spin)
+        chunk_layout.addStretch()
+        layout.addLayout(chunk_layout)
+
+        # Server-side context cache so repeat passes over the document are cheaper
+        self.context_cache_checkbox = QCheckBox('Cache document context for repeat passes')
+        self.context_cache_checkbox.setToolTip(
+            f"Keeps the uploaded PDF in a Gemini context cache for {CONTEXT_CACHE_TTL_SECONDS // 60} minutes, "
+            f"so retries and re-conversions send only the prompt. The cache is deleted when another "
+            f"PDF is loaded or the app closes. Chunked conversions cache each page range; small "
+            f"documents and ranges may be below the model's minimum cache size.")
+        layout.addWidget(self.context_cache_checkbox)
+
+        self.text_layer_checkbox = QCheckBox('Use the embedded text of plain pages (no API call)')
+        self.text_layer_checkbox.setChecked(True)
+        self.text_layer_checkbox.setToolTip(
+            "Pages whose embedded text is clean and has no formulas or images are converted locally; "
+            "scanned, math-heavy and garbled pages still go to the model.")
+        layout.addWidget(self.text_layer_checkbox)
+
         # Export buttons
         export_layout = QHBoxLayout()
         self.export_word_button = QPushButton('Export to Word Document (python-docx)')
@@ -185,23 +582,25 @@ class WordTab(QWidget):
             QMessageBox.warning(self, "Error", "Please set the API Key first.")
             return
 
-        if not self.parent_converter.uploaded_file:
+        if not self.parent_converter.file_hash:
             self.result_text.setText("Please upload a PDF file first.")
             return
 
-        prompt = """
-        Hãy nhận diện và gõ lại [CHÍNH XÁC] toàn bộ nội dung PDF thành văn bản, bao gồm tất cả công thức Toán học được bọc trong dấu $.
+        prompt = PDF_PROMPT
 
-        [YÊU CẦU NGHIÊM NGẶT]:
-        - CHỈ gõ lại nội dung có trong PDF
-        - KHÔNG thêm bất kỳ nội dung nào khác
-        - Giữ nguyên cấu trúc và định dạng của văn bản gốc, bỏ qua phần hình vẽ trong PDF
-        - [Bắt buộc] tất cả công thức toán học viết dưới dạng LaTeX được bọc trong dấu $
-        """
+        chunk_settings = None
+        if self.chunked_checkbox.isChecked():
+            chunk_settings = {
+                'pages_per_chunk': self.pages_per_chunk_spin.value(),
+                'max_workers': self.workers_spin.value()
+            }
 
         self.parent_converter.start_conversion(prompt, result_widget=self.result_text,
                                              convert_button=self.convert_button,
-                                             export_buttons=[self.export_word_button, self.export_pandoc_button])
+                                             export_buttons=[self.export_word_button, self.export_pandoc_button],
+                                             chunk_settings=chunk_settings,
+                                             use_context_cache=self.context_cache_checkbox.isChecked(),
+                                             use_text_layer=self.text_layer_checkbox.isChecked())
 
     def export_to_word(self):
         if not hasattr(self.parent_converter, 'pdf_text') or not self.parent_converter.pdf_text:
@@ -229,56 +628,19 @@ class WordTab(QWidget):
 
         if output_path:
             try:
-                self.export_with_pandoc(output_path)
+                self.parent_converter.export_with_pandoc(output_path)
             except Exception as e:
                 QMessageBox.warning(self, "Error", f"An error occurred during pandoc export:\n{str(e)}")
 
-    def export_with_pandoc(self, output_path):
-        """Export using pandoc for better math formula handling"""
-        try:
-            # Create temporary markdown file
-            temp_md = tempfile.mktemp(suffix='.md')
-
-            # Write to temporary markdown file
-            with open(temp_md, 'w', encoding='utf-8') as f:
-                f.write(self.parent_converter.pdf_text)
-
-            # Run pandoc command
-            cmd = [
-                'pandoc',
-                temp_md,
-                '-o', output_path,
-                '--from=markdown',
-                '--to=docx',
-                '--standalone'
-            ]
-
-            result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8')
-
-            if result.returncode == 0:
-                QMessageBox.information(self, "Export Complete",
-                                      f"Document exported successfully with Pandoc to:\n{output_path}\n\n"
-                                      f"Math formulas should be properly rendered.")
-            else:
-                QMessageBox.warning(self, "Pandoc Error",
-                                  f"Pandoc failed with error:\n{result.stderr}")
-
-            # Clean up
-            if os.path.exists(temp_md):
-                os.unlink(temp_md)
-
-        except FileNotFoundError:
-            QMessageBox.warning(self, "Pandoc Not Found",
-                              "Pandoc is not installed or not found in PATH.\n"
-                              "Please install Pandoc from https://pandoc.org/")
-        except Exception as e:
-            QMessageBox.warning(self, "Error", f"An error occurred during pandoc export:\n{str(e)}")
-
 class ImageTab(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
         self.parent_converter = parent
         self.uploaded_images = []
+        self.cache_key = None
+        self.upload_thread = None
+        self.image_conversion_thread = None
+        self.pending_upload = None
         self.initUI()
 
     def initUI(self):
@@ -316,10 +678,48 @@ class ImageTab(QWidget):
         layout.addWidget(self.preview_images_button)
 
         # Convert button
+        convert_layout = QHBoxLayout()
         self.convert_button = QPushButton('Convert Images to Text')
         self.convert_button.clicked.connect(self.convert_images_to_text)
         self.convert_button.setEnabled(False)
-        layout.addWidget(self.convert_button)
+
+        self.retry_uploads_button = QPushButton('Retry Failed Uploads')
+        self.retry_uploads_button.clicked.connect(self.retry_failed_uploads)
+        self.retry_uploads_button.setEnabled(False)
+
+        self.upload_workers_spin = QSpinBox()
+        self.upload_workers_spin.setRange(1, 16)
+        self.upload_workers_spin.setValue(4)
+        self.upload_workers_spin.setToolTip("At most the 'Concurrent requests' limit")
+
+        convert_layout.addWidget(self.convert_button)
+        convert_layout.addWidget(self.retry_uploads_button)
+        self.inline_checkbox = QCheckBox('Send small images inline')
+        self.inline_checkbox.setChecked(True)
+
+        convert_layout.addWidget(QLabel('Parallel uploads:'))
+        convert_layout.addWidget(self.upload_workers_spin)
+        convert_layout.addWidget(self.inline_checkbox)
+        layout.addLayout(convert_layout)
+
+        # Optional preprocessing to shrink uploads
+        preprocess_layout = QHBoxLayout()
+        self.preprocess_checkbox = QCheckBox('Optimize images before upload')
+        self.max_edge_spin = QSpinBox()
+        self.max_edge_spin.setRange(256, 8192)
+        self.max_edge_spin.setSingleStep(256)
+        self.max_edge_spin.setValue(2048)
+        self.grayscale_checkbox = QCheckBox('Grayscale')
+        self.image_format_combo = QComboBox()
+        self.image_format_combo.addItems(list(PREPROCESS_EXTENSIONS))
+        preprocess_layout.addWidget(self.preprocess_checkbox)
+        preprocess_layout.addWidget(QLabel('Max edge (px):'))
+        preprocess_layout.addWidget(self.max_edge_spin)
+        preprocess_layout.addWidget(self.grayscale_checkbox)
+        preprocess_layout.addWidget(QLabel('Format:'))
+        preprocess_layout.addWidget(self.image_format_combo)
+        preprocess_layout.addStretch()
+        layout.addLayout(preprocess_layout)
 
         # Export buttons
         export_layout = QHBoxLayout()
@@ -375,6 +775,8 @@ class ImageTab(QWidget):
             QMessageBox.warning(self, "Error", "No image found in clipboard.")
 
     def add_images_from_files(self, file_paths, source='Upload'):
+        from PIL import Image
+
         for file_path in file_paths:
             try:
                 # Create a copy in the output directory if needed
@@ -426,6 +828,8 @@ class ImageTab(QWidget):
 
     def clear_images(self):
         self.uploaded_images = []
+        self.pending_upload = None
+        self.retry_uploads_button.setEnabled(False)
         self.update_image_status()
 
     def update_image_status(self):
@@ -457,32 +861,97 @@ class ImageTab(QWidget):
             self.result_text.setText("Please upload images first.")
             return
 
-        # Upload all images to Gemini
-        try:
-            uploaded_files = []
-            for img_info in self.uploaded_images:
-                uploaded_file = self.parent_converter.client.files.upload(file=img_info['path'])
-                uploaded_files.append(uploaded_file)
+        prompt = build_image_prompt(len(self.uploaded_images))
+        model = self.parent_converter.model_combo.currentText()
+        self.cache_key = None
+        first_path = self.uploaded_images[0]['path']
+        self.parent_converter.job_metrics = JobMetrics(
+            'image', first_path if len(self.uploaded_images) == 1 else os.path.dirname(first_path), model=model)
+
+        # Hash, check the result cache and upload in the background, then start generation;
+        # identical image sets are served from the cache once the upload thread has hashed them
+        self.pending_upload = {
+            'images': [(img_info['path'], None) for img_info in self.uploaded_images],
+            'prompt': prompt
+        }
+        self.start_image_upload(cache_key_parts=(prompt, model, preprocess_variant(self.preprocess_settings())))
+
+    def preprocess_settings(self):
+        if not self.preprocess_checkbox.isChecked():
+            return None
+        return {
+            'max_edge': self.max_edge_spin.value(),
+            'grayscale': self.grayscale_checkbox.isChecked(),
+            'image_format': self.image_format_combo.currentText()
+        }
+
+    def start_image_upload(self, uploaded_files=None, cache_key_parts=None):
+        self.convert_button.setEnabled(False)
+        self.retry_uploads_button.setEnabled(False)
+        self.export_word_button.setEnabled(False)
+        self.export_pandoc_button.setEnabled(False)
 
-            prompt = f"""
-            Hãy nhận diện và gõ lại [CHÍNH XÁC] toàn bộ nội dung trong {len(self.uploaded_images)} hình ảnh thành văn bản, bao gồm tất cả công thức Toán học được bọc trong dấu $.
+        self.parent_converter.progress_bar.setValue(0)
+        self.result_text.clear()
+        self.result_text.append(f"Uploading {len(self.pending_upload['images'])} images...")
+        self.parent_converter.status_label.setText("Status: Uploading images...")
 
-            [QUY TẮC NGHIÊM NGẶT]:
-            - CHỈ gõ lại nội dung có trong hình ảnh
-            - KHÔNG thêm bất kỳ nội dung nào khác
-            - Giữ nguyên cấu trúc và định dạng của văn bản gốc, bỏ qua phần hình vẽ trong PDF
-            - [Bắt buộc] tất cả công thức toán học viết dưới dạng LaTeX được bọc trong dấu $
+        inline_budget = None
+        if self.inline_checkbox.isChecked():
+            inline_budget = InlineBudget(reserved_bytes=len(self.pending_upload['prompt'].encode('utf-8')))
 
-            """
+        self.upload_thread = ImageUploadThread(
+            self.parent_converter.client,
+            self.parent_converter.upload_cache,
+            self.pending_upload['images'],
+            max_workers=self.upload_workers_spin.value(),
+            uploaded_files=uploaded_files,
+            preprocess_settings=self.preprocess_settings(),
+            inline_budget=inline_budget,
+            metrics=self.parent_converter.job_metrics,
+            cache_key_parts=cache_key_parts,
+            result_cache=None if self.parent_converter.bypass_cache_checkbox.isChecked()
+            else self.parent_converter.result_cache
+        )
+        self.upload_thread.progress.connect(self.parent_converter.update_progress)
+        self.upload_thread.notice.connect(self.result_text.append)
+        self.upload_thread.hashed.connect(self.on_images_hashed)
+        self.upload_thread.cached.connect(lambda text: self.on_conversion_finished(text, from_cache=True))
+        self.upload_thread.error.connect(self.on_conversion_error)
+        self.upload_thread.image_status.connect(self.on_image_upload_status)
+        self.upload_thread.finished.connect(self.on_images_uploaded)
+        self.upload_thread.start()
+
+    def on_images_hashed(self, digests, cache_key):
+        # Retries reuse the digests instead of hashing again
+        self.pending_upload['images'] = [(path, digest) for (path, _), digest
+                                         in zip(self.pending_upload['images'], digests)]
+        self.cache_key = cache_key or None
+
+    def on_image_upload_status(self, index, status):
+        path = self.pending_upload['images'][index][0]
+        self.result_text.append(f"Image {index + 1} ({os.path.basename(path)}): {status}")
+
+    def on_images_uploaded(self, uploaded_files, failed):
+        self.pending_upload['uploaded_files'] = uploaded_files
+        if failed:
+            self.result_text.append(f"{len(failed)} image(s) failed to upload. "
+                                    f"Use 'Retry Failed Uploads' to upload only those again.")
+            self.parent_converter.status_label.setText("Status: Some image uploads failed")
+            self.convert_button.setEnabled(True)
+            self.retry_uploads_button.setEnabled(True)
+            return
 
-            # Create content list with all uploaded files
-            content_list = uploaded_files + [prompt]
+        # Create content list with all uploaded files
+        content_list = uploaded_files + [self.pending_upload['prompt']]
 
-            # Start conversion with multiple images
-            self.start_image_conversion(content_list)
+        # Start conversion with multiple images
+        self.start_image_conversion(content_list)
 
-        except Exception as e:
-            QMessageBox.warning(self, "Error", f"Failed to upload images: {str(e)}")
+    def retry_failed_uploads(self):
+        if not self.pending_upload or 'uploaded_files' not in self.pending_upload:
+            return
+        self.start_image_upload(uploaded_files=self.pending_upload['uploaded_files'])
 
     def start_image_conversion(self, content_list):
         self.convert_button.setEnabled(False)
@@ -497,16 +966,31 @@ class ImageTab(QWidget):
         # Create a special thread for image conversion
         self.image_conversion_thread = ImageConversionThread(
             self.parent_converter.client,
-            content_list
+            content_list,
+            expected_bytes=len(self.uploaded_images) * EXPECTED_BYTES_PER_PAGE,
+            metrics=self.parent_converter.job_metrics,
+            model=self.parent_converter.job_metrics.model,
+            image_paths=[img_info['path'] for img_info in self.uploaded_images]
         )
         self.image_conversion_thread.progress.connect(self.parent_converter.update_progress)
+        self.image_conversion_thread.notice.connect(self.result_text.append)
+        self.image_conversion_thread.chunk_received.connect(
+            lambda text: self.parent_converter.append_streamed_text(self.result_text, text)
+        )
+        self.image_conversion_thread.stream_reset.connect(
+            lambda text: self.parent_converter.remove_streamed_text(self.result_text, text)
+        )
         self.image_conversion_thread.finished.connect(self.on_conversion_finished)
         self.image_conversion_thread.error.connect(self.on_conversion_error)
+        self.result_text.append("")
         self.image_conversion_thread.start()
 
-    def on_conversion_finished(self, text):
+    def on_conversion_finished(self, text, from_cache=False):
+        if not from_cache and self.cache_key:
+            self.parent_converter.result_cache.put(self.cache_key, text)
+
         # Save processed text
-        self.parent_converter.pdf_text = self.parent_converter.process_formulas(text)
+        self.parent_converter.pdf_text = self.parent_converter.finish_job(text, from_cache)
 
         self.result_text.clear()
         self.result_text.append("Images converted successfully. Here's the content:\n\n")
@@ -516,11 +1000,18 @@ class ImageTab(QWidget):
         self.export_word_button.setEnabled(True)
         self.export_pandoc_button.setEnabled(True)
 
-        self.parent_converter.status_label.setText("Status: Image conversion completed")
+        summary = self.parent_converter.job_metrics.summary()
+        if from_cache:
+            self.parent_converter.progress_bar.setValue(100)
+            self.parent_converter.status_label.setText(f"Status: Image conversion loaded from cache | {summary}")
+        else:
+            self.parent_converter.status_label.setText(
+                f"Status: Image conversion completed {self.parent_converter.api_stats_text()} | {summary}")
 
     def on_conversion_error(self, error_message):
         self.result_text.append(f"An error occurred during conversion: {error_message}")
         self.convert_button.setEnabled(True)
+        self.parent_converter.fail_job()
         self.parent_converter.status_label.setText("Status: Error occurred")
 
     def export_to_word(self):
@@ -549,102 +1040,400 @@ class ImageTab(QWidget):
 
         if output_path:
             try:
-                self.export_with_pandoc(output_path)
+                self.parent_converter.export_with_pandoc(output_path)
             except Exception as e:
                 QMessageBox.warning(self, "Error", f"An error occurred during pandoc export:\n{str(e)}")
 
-    def export_with_pandoc(self, output_path):
-        """Export using pandoc for better math formula handling"""
-        try:
-            # Create temporary markdown file
-            temp_md = tempfile.mktemp(suffix='.md')
-
-            # Write to temporary markdown file
-            with open(temp_md, 'w', encoding='utf-8') as f:
-                f.write(self.parent_converter.pdf_text)
-
-            # Run pandoc command
-            cmd = [
-                'pandoc',
-                temp_md,
-                '-o', output_path,
-                '--from=markdown',
-                '--to=docx',
-                '--standalone'
-            ]
-
-            result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8')
-
-            if result.returncode == 0:
-                QMessageBox.information(self, "Export Complete",
-                                      f"Document exported successfully with Pandoc to:\n{output_path}\n\n"
-                                      f"Math formulas should be properly rendered.")
-            else:
-                QMessageBox.warning(self, "Pandoc Error",
-                                  f"Pandoc failed with error:\n{result.stderr}")
-
-            # Clean up
-            if os.path.exists(temp_md):
-                os.unlink(temp_md)
-
-        except FileNotFoundError:
-            QMessageBox.warning(self, "Pandoc Not Found",
-                              "Pandoc is not installed or not found in PATH.\n"
-                              "Please install Pandoc from https://pandoc.org/")
-        except Exception as e:
-            QMessageBox.warning(self, "Error", f"An error occurred during pandoc export:\n{str(e)}")
-
 class ImageConversionThread(QThread):
     progress = pyqtSignal(int)
+    chunk_received = pyqtSignal(str)
+    # Partial text of a streamed attempt that is about to be retried
+    stream_reset = pyqtSignal(str)
+    notice = pyqtSignal(str)
     finished = pyqtSignal(str)
     error = pyqtSignal(str)
 
-    def __init__(self, client, content_list):
+    def __init__(self, client, content_list, expected_bytes=EXPECTED_BYTES_PER_PAGE, metrics=None,
+                 model=DEFAULT_MODEL, image_paths=None):
         super().__init__()
         self.client = client
         self.content_list = content_list
-        self.max_retries = 3
-        self.retry_delay = 60
+        self.expected_bytes = max(1, expected_bytes)
+        self.metrics = metrics
+        self.model = model
+        # Original image files, scored when the model is 'auto'
+        self.image_paths = image_paths or []
         self.is_running = True
+        self.cancel_token = CancelToken()
 
     def run(self):
-        for attempt in range(self.max_retries):
+        try:
+            self.progress.emit(0)
+            model, score = route_images(self.model, self.image_paths)
+            if self.metrics:
+                self.metrics.add_section("all images", model, score)
+            # content_list is the image parts followed by the prompt
+            text = generate_image_text(self.client, self.content_list[:-1], self.content_list[-1], model=model,
+                                       on_chunk=self.on_chunk, on_notice=self.notice.emit,
+                                       should_stop=self.cancel_token, metrics=self.metrics,
+                                       on_reset=self.stream_reset.emit)
             if not self.is_running:
                 return
-            try:
-                # Simulate progress
-                for i in range(0, 51):
-                    if not self.is_running:
-                        return
-                    self.progress.emit(i)
-                    self.msleep(50)
-
-                # Progress simulation during generation
-                for i in range(51, 101):
-                    if not self.is_running:
-                        return
-                    self.progress.emit(i)
-                    self.msleep(30)
-
-                # Generate content using new simplified API
-                response = self.client.models.generate_content(
-                    model="gemini-2.5-flash",
-                    contents=self.content_list,
-                )
 
-                self.finished.emit(response.text)
-                return
+            self.progress.emit(100)
+            self.finished.emit(text)
 
-            except Exception as e:
-                if "429" in str(e) and attempt < self.max_retries - 1:
-                    self.error.emit(f"Rate limit exceeded. Retrying in {self.retry_delay} seconds...")
-                    self.msleep(self.retry_delay * 1000)
-                else:
-                    self.error.emit(str(e))
-                    return
+        except ConversionCancelled:
+            return
+        except Exception as e:
+            self.error.emit(str(e))
+
+    def on_chunk(self, text, received_bytes):
+        self.chunk_received.emit(text)
+        # Streamed output never reaches 100% until the response is complete
+        self.progress.emit(min(99, received_bytes * 100 // self.expected_bytes))
+
+    def stop(self):
+        self.is_running = False
+        self.cancel_token.cancel()
+
+class QueueJobThread(QThread):
+    """Run one queued job through convert_document and record the outcome in the queue"""
+    progress = pyqtSignal(str, int)
+    notice = pyqtSignal(str, str)
+    finished = pyqtSignal(str)
+
+    def __init__(self, client, job_queue, job, upload_cache=None, result_cache=None, use_cache=True):
+        super().__init__()
+        self.client = client
+        self.job_queue = job_queue
+        self.job = job
+        self.upload_cache = upload_cache
+        self.result_cache = result_cache
+        self.use_cache = use_cache
+        self.expected_bytes = EXPECTED_BYTES_PER_PAGE
+        self.is_running = True
+        # Set when the app closes: the job goes back to the queue instead of being cancelled
+        self.requeue = False
+        self.cancel_token = CancelToken()
+
+    def run(self):
+        job_id = self.job['id']
+        model = self.job.get('model', DEFAULT_MODEL)
+        metrics = JobMetrics('pdf' if self.job['kind'] == 'pdf' else 'image', self.job['inputs'][0], model=model)
+        try:
+            if self.job['kind'] == 'pdf':
+                self.expected_bytes = max(1, pdf_page_count(self.job['inputs'][0])) * EXPECTED_BYTES_PER_PAGE
+            else:
+                self.expected_bytes = len(self.job['inputs']) * EXPECTED_BYTES_PER_PAGE
+            self.progress.emit(job_id, 0)
+            text, from_cache = convert_document(self.client, self.job['inputs'], self.upload_cache,
+                                                self.result_cache, use_cache=self.use_cache,
+                                                on_chunk=self.on_chunk,
+                                                on_notice=lambda message: self.notice.emit(job_id, message),
+                                                should_stop=self.cancel_token, metrics=metrics, model=model)
+            result_path = self.job_queue.result_path(job_id)
+            os.makedirs(os.path.dirname(result_path), exist_ok=True)
+            with open(result_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            metrics.status = 'ok'
+            self.job_queue.update(job_id, status='done', result_path=result_path, from_cache=from_cache,
+                                  finished=time.time(), summary=metrics.summary(),
+                                  sections=metrics.to_record()['sections'])
+            self.progress.emit(job_id, 100)
+        except ConversionCancelled:
+            metrics.status = 'cancelled'
+            self.job_queue.update(job_id, status='queued' if self.requeue else 'cancelled')
+        except Exception as e:
+            metrics.status = 'failed'
+            self.job_queue.update(job_id, status='failed', error=str(e), finished=time.time())
+        metrics_recorder.record(metrics)
+        self.finished.emit(job_id)
+
+    def on_chunk(self, text, received_bytes):
+        # Streamed output never reaches 100% until the response is complete
+        self.progress.emit(self.job['id'], min(99, received_bytes * 100 // self.expected_bytes))
 
     def stop(self):
         self.is_running = False
+        self.cancel_token.cancel()
+
+class QueueTab(QWidget):
+    """Queue of PDFs and image sets converted in the background by a bounded set of workers"""
+
+    COLUMNS = ['Document', 'Type', 'Model', 'Priority', 'Status', 'Progress']
+    STATUS_TEXT = {'queued': 'Queued', 'running': 'Running', 'done': 'Done', 'failed': 'Failed',
+                   'cancelled': 'Cancelled'}
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.parent_converter = parent
+        self.job_queue = JobQueue()
+        # job id -> QueueJobThread
+        self.threads = {}
+        self.progress = {}
+        self.initUI()
+        self.refresh_table()
+
+    def initUI(self):
+        layout = QVBoxLayout()
+
+        add_layout = QHBoxLayout()
+        self.add_pdfs_button = QPushButton('Add PDFs')
+        self.add_pdfs_button.clicked.connect(self.add_pdfs)
+        self.add_images_button = QPushButton('Add Image Set')
+        self.add_images_button.clicked.connect(self.add_image_set)
+        self.priority_combo = QComboBox()
+        self.priority_combo.addItems(list(QUEUE_PRIORITIES))
+        self.priority_combo.setCurrentText('Normal')
+        self.workers_spin = QSpinBox()
+        self.workers_spin.setRange(1, 8)
+        self.workers_spin.setValue(2)
+        self.workers_spin.setToolTip("At most the 'Concurrent requests' limit; each job makes its own API calls")
+        self.workers_spin.valueChanged.connect(self.dispatch)
+        add_layout.addWidget(self.add_pdfs_button)
+        add_layout.addWidget(self.add_images_button)
+        add_layout.addWidget(QLabel('Priority:'))
+        add_layout.addWidget(self.priority_combo)
+        add_layout.addStretch()
+        add_layout.addWidget(QLabel('Parallel jobs:'))
+        add_layout.addWidget(self.workers_spin)
+        layout.addLayout(add_layout)
+
+        self.table = QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.table.itemSelectionChanged.connect(self.show_selected_result)
+        layout.addWidget(self.table)
+
+        action_layout = QHBoxLayout()
+        self.set_priority_button = QPushButton('Set Priority')
+        self.set_priority_button.clicked.connect(self.set_selected_priority)
+        self.cancel_button = QPushButton('Cancel')
+        self.cancel_button.clicked.connect(self.cancel_selected)
+        self.retry_button = QPushButton('Retry')
+        self.retry_button.clicked.connect(self.retry_selected)
+        self.remove_button = QPushButton('Remove')
+        self.remove_button.clicked.connect(self.remove_selected)
+        self.export_button = QPushButton('Export Selected to Word')
+        self.export_button.clicked.connect(self.export_selected)
+        for button in (self.set_priority_button, self.cancel_button, self.retry_button, self.remove_button,
+                       self.export_button):
+            action_layout.addWidget(button)
+        layout.addLayout(action_layout)
+
+        self.queue_status_label = QLabel('')
+        layout.addWidget(self.queue_status_label)
+
+        self.result_text = QTextEdit()
+        self.result_text.setReadOnly(True)
+        self.result_text.setPlaceholderText('Select a finished job to preview its text')
+        layout.addWidget(self.result_text)
+
+        self.setLayout(layout)
+
+    def add_pdfs(self):
+        paths, _ = QFileDialog.getOpenFileNames(self, "Add PDFs to the queue", "", "PDF Files (*.pdf)")
+        for path in paths:
+            self.job_queue.add('pdf', [path], self.priority_combo.currentText(),
+                               self.parent_converter.model_combo.currentText())
+        if paths:
+            self.refresh_table()
+            self.dispatch()
+
+    def add_image_set(self):
+        patterns = ' '.join('*' + extension for extension in IMAGE_EXTENSIONS)
+        paths, _ = QFileDialog.getOpenFileNames(self, "Add an image set to the queue", "",
+                                                f"Image Files ({patterns})")
+        if paths:
+            # One job per set: the images are read together as one document, in name order
+            self.job_queue.add('images', sorted(paths), self.priority_combo.currentText(),
+                               self.parent_converter.model_combo.currentText())
+            self.refresh_table()
+            self.dispatch()
+
+    def dispatch(self):
+        """Start queued jobs until the worker limit is reached"""
+        client = self.parent_converter.client
+        if client is None:
+            if any(job['status'] == 'queued' for job in self.job_queue.snapshot()):
+                self.queue_status_label.setText('Set the API key to start the queue.')
+            return
+        while len(self.threads) < self.workers_spin.value():
+            job = self.job_queue.take_next()
+            if job is None:
+                break
+            thread = QueueJobThread(client, self.job_queue, job,
+                                    upload_cache=self.parent_converter.upload_cache,
+                                    result_cache=self.parent_converter.result_cache,
+                                    use_cache=not self.parent_converter.bypass_cache_checkbox.isChecked())
+            thread.progress.connect(self.on_job_progress)
+            thread.notice.connect(self.on_job_notice)
+            thread.finished.connect(self.on_job_finished)
+            self.threads[job['id']] = thread
+            self.progress[job['id']] = 0
+            thread.start()
+        self.refresh_table()
+
+    def on_job_progress(self, job_id, value):
+        self.progress[job_id] = value
+        row = self.row_of(job_id)
+        if row is not None:
+            self.table.setItem(row, 5, QTableWidgetItem(f"{value}%"))
+
+    def on_job_notice(self, job_id, message):
+        job = self.job_queue.get(job_id)
+        if job:
+            self.queue_status_label.setText(f"{job['name']}: {message}")
+
+    def on_job_finished(self, job_id):
+        thread = self.threads.pop(job_id, None)
+        if thread is not None:
+            thread.wait()
+        self.progress.pop(job_id, None)
+        self.dispatch()
+
+    def row_of(self, job_id):
+        for row in range(self.table.rowCount()):
+            item = self.table.item(row, 0)
+            if item is not None and item.data(Qt.ItemDataRole.UserRole) == job_id:
+                return row
+        return None
+
+    def refresh_table(self):
+        selected = set(self.selected_job_ids())
+        jobs = self.job_queue.snapshot()
+        self.table.setRowCount(len(jobs))
+        for row, job in enumerate(jobs):
+            name_item = QTableWidgetItem(job['name'])
+            name_item.setData(Qt.ItemDataRole.UserRole, job['id'])
+            name_item.setToolTip('\n'.join(job['inputs']))
+            self.table.setItem(row, 0, name_item)
+            self.table.setItem(row, 1, QTableWidgetItem('PDF' if job['kind'] == 'pdf' else 'Images'))
+            model_item = QTableWidgetItem(job.get('model', DEFAULT_MODEL))
+            if job.get('sections'):
+                # Which model each part of the result came from, for routed jobs
+                model_item.setToolTip('\n'.join(f"{section['section']}: {section['model']}"
+                                                 for section in job['sections']))
+            self.table.setItem(row, 2, model_item)
+            self.table.setItem(row, 3, QTableWidgetItem(job['priority']))
+            status = self.STATUS_TEXT.get(job['status'], job['status'])
+            if job['status'] == 'done' and job.get('from_cache'):
+                status += ' (cache)'
+            status_item = QTableWidgetItem(status)
+            status_item.setToolTip(job['error'] or job.get('summary') or '')
+            self.table.setItem(row, 4, status_item)
+            if job['status'] == 'running':
+                progress = f"{self.progress.get(job['id'], 0)}%"
+            else:
+                progress = '100%' if job['status'] == 'done' else ''
+            self.table.setItem(row, 5, QTableWidgetItem(progress))
+            if job['id'] in selected:
+                self.table.selectRow(row)
+
+        counts = {}
+        for job in jobs:
+            counts[job['status']] = counts.get(job['status'], 0) + 1
+        self.queue_status_label.setText(', '.join(f"{self.STATUS_TEXT[status]}: {count}"
+                                                  for status, count in counts.items()))
+
+    def selected_job_ids(self):
+        rows = sorted({index.row() for index in self.table.selectedIndexes()})
+        return [self.table.item(row, 0).data(Qt.ItemDataRole.UserRole) for row in rows
+                if self.table.item(row, 0) is not None]
+
+    def set_selected_priority(self):
+        priority = self.priority_combo.currentText()
+        for job_id in self.selected_job_ids():
+            self.job_queue.update(job_id, priority=priority)
+        self.refresh_table()
+
+    def cancel_selected(self):
+        for job_id in self.selected_job_ids():
+            if job_id in self.threads:
+                self.threads[job_id].stop()
+            else:
+                job = self.job_queue.get(job_id)
+                if job and job['status'] == 'queued':
+                    self.job_queue.update(job_id, status='cancelled')
+        self.refresh_table()
+
+    def retry_selected(self):
+        for job_id in self.selected_job_ids():
+            job = self.job_queue.get(job_id)
+            if job and job['status'] in ('failed', 'cancelled'):
+                self.job_queue.update(job_id, status='queued', error=None)
+        self.refresh_table()
+        self.dispatch()
+
+    def remove_selected(self):
+        for job_id in self.selected_job_ids():
+            if job_id in self.threads:
+                QMessageBox.warning(self, "Job Running", "Cancel running jobs before removing them.")
+                continue
+            self.job_queue.remove(job_id)
+        self.refresh_table()
+
+    def show_selected_result(self):
+        job_ids = self.selected_job_ids()
+        job = self.job_queue.get(job_ids[0]) if len(job_ids) == 1 else None
+        self.result_text.clear()
+        if job is None:
+            return
+        if job['status'] == 'failed':
+            self.result_text.setPlainText(f"Conversion failed:\n{job['error']}")
+        elif job['status'] == 'done' and job['result_path']:
+            try:
+                with open(job['result_path'], 'r', encoding='utf-8') as f:
+                    self.result_text.setPlainText(f.read())
+            except OSError as e:
+                self.result_text.setPlainText(f"Could not read the result: {e}")
+
+    def export_selected(self):
+        jobs = [job for job in (self.job_queue.get(job_id) for job_id in self.selected_job_ids())
+                if job and job['status'] == 'done']
+        if not jobs:
+            QMessageBox.warning(self, "Error", "Select one or more finished jobs to export.")
+            return
+        output_dir = QFileDialog.getExistingDirectory(self, "Export Word documents to")
+        if not output_dir:
+            return
+
+        exported = []
+        failed = []
+        # Jobs for a/x.pdf and b/x.pdf must not overwrite each other's document
+        output_stems = unique_output_stems([job['inputs'][0] for job in jobs])
+        for job, output_stem in zip(jobs, output_stems):
+            output_path = os.path.join(output_dir, output_stem + '.docx')
+            try:
+                with open(job['result_path'], 'r', encoding='utf-8') as f:
+                    text = f.read()
+                images = None
+                if job['kind'] == 'images':
+                    images = [{'path': path, 'filename': os.path.basename(path), 'index': index}
+                              for index, path in enumerate(job['inputs'], 1)]
+                engine = 'streaming' if len(text) >= STREAMING_EXPORT_MIN_CHARS else 'python-docx'
+                export_docx(text, output_path, images=images, engine=engine)
+                exported.append(output_path)
+            except Exception as e:
+                failed.append(f"{job['name']}: {e}")
+
+        message = f"Exported {len(exported)} document(s) to:\n{output_dir}"
+        if failed:
+            message += "\n\nFailed:\n" + "\n".join(failed)
+            QMessageBox.warning(self, "Export Finished With Errors", message)
+        else:
+            QMessageBox.information(self, "Export Complete", message)
+
+    def shutdown(self):
+        """Stop running jobs; they are queued again on the next start"""
+        threads = list(self.threads.values())
+        for thread in threads:
+            thread.requeue = True
+            thread.stop()
+        return threads
 
 class PDFToTextConverter(QWidget):
     def __init__(self):
@@ -653,11 +1442,24 @@ class PDFToTextConverter(QWidget):
         self.file_path = None
         self.uploaded_file = None
         self.client = None
+        self.upload_cache = None
+        # Cached contexts of the loaded PDF, deleted when another one is loaded
+        self.context_cache = ContextCache()
+        self.result_cache = ResultCache()
+        self.file_hash = None
         self.pdf_text = ""
+        self.page_count = 0
         self.output_dir = ""
-        self.initUI()
-        self.load_api_key()
         self.conversion_thread = None
+        self.pdf_upload_thread = None
+        self.stale_pdf_threads = []
+        load_api_limits()
+        # JobMetrics of the conversion whose text is in pdf_text
+        self.job_metrics = None
+        # Result widgets whose stream was reset for a retry
+        self.restarted_streams = set()
+        self.first_paint_done = False
+        self.initUI()
 
     def initUI(self):
         main_layout = QVBoxLayout()
@@ -694,8 +1496,40 @@ class PDFToTextConverter(QWidget):
         main_layout.addWidget(self.progress_bar)
 
         # Status label
+        status_layout = QHBoxLayout()
         self.status_label = QLabel("Status: Idle")
-        main_layout.addWidget(self.status_label)
+        self.bypass_cache_checkbox = QCheckBox('Force re-conversion (ignore cache)')
+        self.model_combo = QComboBox()
+        self.model_combo.addItems(MODEL_CHOICES)
+        self.model_combo.setCurrentText(DEFAULT_MODEL)
+        self.model_combo.setToolTip(f"'{AUTO_MODEL}' sends simple pages to {ROUTER_FAST_MODEL} "
+                                    f"and formula-heavy ones to {ROUTER_STRONG_MODEL}")
+        status_layout.addWidget(self.status_label)
+        status_layout.addStretch()
+        status_layout.addWidget(QLabel('Model:'))
+        status_layout.addWidget(self.model_combo)
+        status_layout.addWidget(self.bypass_cache_checkbox)
+        main_layout.addLayout(status_layout)
+
+        # API limits shared by every conversion; worker counts above them only wait for a slot
+        limits = api_scheduler.limits()
+        limits_layout = QHBoxLayout()
+        self.rate_spin = QSpinBox()
+        self.rate_spin.setRange(1, 2000)
+        self.rate_spin.setValue(limits['rate_per_minute'])
+        self.rate_spin.setToolTip("Generation requests started per minute, across all tabs. "
+                                  "Match your API tier's requests-per-minute quota.")
+        self.concurrent_spin = QSpinBox()
+        self.concurrent_spin.setRange(1, 32)
+        self.concurrent_spin.setValue(limits['max_concurrent'])
+        self.concurrent_spin.setToolTip("Gemini calls in flight at once, across all tabs. "
+                                        "Also the most chunk workers, upload workers and parallel jobs.")
+        limits_layout.addStretch()
+        limits_layout.addWidget(QLabel('Requests/min:'))
+        limits_layout.addWidget(self.rate_spin)
+        limits_layout.addWidget(QLabel('Concurrent requests:'))
+        limits_layout.addWidget(self.concurrent_spin)
+        main_layout.addLayout(limits_layout)
 
         # Create tab widget
         self.tab_widget = QTabWidget()
@@ -703,17 +1537,55 @@ class PDFToTextConverter(QWidget):
         # Create tabs
         self.word_tab = WordTab(self)
         self.image_tab = ImageTab(self)
+        self.queue_tab = QueueTab(self)
 
         # Add tabs
         self.tab_widget.addTab(self.word_tab, "PDF to Word")
         self.tab_widget.addTab(self.image_tab, "Image to Word")
+        self.tab_widget.addTab(self.queue_tab, "Queue")
 
         main_layout.addWidget(self.tab_widget)
 
+        self.apply_worker_limit()
+        self.rate_spin.valueChanged.connect(self.update_api_limits)
+        self.concurrent_spin.valueChanged.connect(self.update_api_limits)
+
         self.setLayout(main_layout)
         self.setWindowTitle('PDF & Image to Word Converter')
         self.setGeometry(300, 300, 1200, 900)
 
+    def update_api_limits(self):
+        api_scheduler.configure(rate_per_minute=self.rate_spin.value(),
+                                max_concurrent=self.concurrent_spin.value())
+        save_api_limits()
+        self.apply_worker_limit()
+
+    def apply_worker_limit(self):
+        """Cap the worker and parallel-job spin boxes at the concurrent request limit"""
+        limit = self.concurrent_spin.value()
+        for spin in (self.word_tab.workers_spin, self.image_tab.upload_workers_spin, self.queue_tab.workers_spin):
+            spin.setMaximum(limit)
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if not self.first_paint_done:
+            self.first_paint_done = True
+            # Build the Gemini client only once the window is on screen
+            QTimer.singleShot(0, self.on_first_paint)
+
+    def on_first_paint(self):
+        probe_path = os.environ.get('PDF2WORD_STARTUP_PROBE')
+        if probe_path:
+            # Startup benchmark run: report timings and quit before touching the API key
+            with open(probe_path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'import_seconds': round(IMPORT_SECONDS, 4),
+                    'first_window_seconds': round(time.perf_counter() - STARTUP_TIME, 4)
+                }, f)
+            QApplication.instance().quit()
+            return
+        self.load_api_key()
+
     def set_api_key(self):
         self.api_key = self.api_key_input.text()
         if self.api_key:
@@ -728,8 +1600,17 @@ class PDFToTextConverter(QWidget):
 
     def setup_client(self):
         try:
-            self.client = genai.Client(api_key=self.api_key)
+            self.client = make_client(self.api_key)
+            if self.upload_cache:
+                # The new cache reloads the index from disk
+                self.upload_cache.flush()
+            self.upload_cache = UploadCache(account=self.api_key)
             print("Gemini client initialized successfully")
+            # Jobs left in the queue by the last session resume now
+            self.queue_tab.dispatch()
+
+            # Remove stale remote uploads without holding up the window
+            threading.Thread(target=self.upload_cache.cleanup, args=(self.client,), daemon=True).start()
         except Exception as e:
             print(f"Error setting up client: {e}")
             self.client = None
@@ -768,6 +1649,9 @@ class PDFToTextConverter(QWidget):
             file_name = os.path.basename(self.file_path)
             self.file_label.setText(f"File: {file_name}")
 
+            # The previous document's cached contexts are no longer needed
+            threading.Thread(target=self.context_cache.clear, args=(self.client,), daemon=True).start()
+
             # Set output directory to the same directory as the PDF file
             self.output_dir = os.path.dirname(self.file_path)
 
@@ -775,26 +1659,63 @@ class PDFToTextConverter(QWidget):
 
     def process_pdf(self):
         self.status_label.setText("Status: Processing PDF...")
+        self.file_hash = None
+        self.uploaded_file = None
+        self.word_tab.convert_button.setEnabled(False)
+        # A PDF chosen before this one is no longer wanted; keep its thread referenced until it exits
+        self.stale_pdf_threads = [thread for thread in self.stale_pdf_threads if thread.isRunning()]
+        if self.pdf_upload_thread and self.pdf_upload_thread.isRunning():
+            self.pdf_upload_thread.stop()
+            self.stale_pdf_threads.append(self.pdf_upload_thread)
+        self.job_metrics = JobMetrics('pdf', self.file_path)
+
+        # Hashing and uploading a large PDF take a while, so they run off the GUI thread. With the
+        # text layer on, the conversion thread uploads only the pages that need the model.
+        self.pdf_upload_thread = PdfUploadThread(self.client, self.upload_cache, self.file_path.replace("\\", "/"),
+                                                 upload=not self.word_tab.text_layer_checkbox.isChecked(),
+                                                 metrics=self.job_metrics)
+        self.pdf_upload_thread.finished.connect(self.on_pdf_processed)
+        self.pdf_upload_thread.error.connect(self.on_pdf_error)
+        self.pdf_upload_thread.start()
+
+    def on_pdf_processed(self, uploaded_file, file_hash, page_count):
+        if self.sender() is not self.pdf_upload_thread:
+            return
+        self.uploaded_file = uploaded_file
+        self.file_hash = file_hash
+        self.page_count = page_count
 
-        try:
-            # Upload PDF using new API
-            safe_path = self.file_path.replace("\\", "/")
-
-            # Upload file using new API
-            self.uploaded_file = self.client.files.upload(file=safe_path)
-
-            print(f"File uploaded successfully: {self.uploaded_file.uri}")
-
-            # Enable convert button in PDF tab
-            self.word_tab.convert_button.setEnabled(True)
+        # Enable convert button in PDF tab
+        self.word_tab.convert_button.setEnabled(True)
+        self.status_label.setText("Status: PDF ready for conversion")
 
-            self.status_label.setText("Status: PDF ready for conversion")
+    def on_pdf_error(self, error_message):
+        if self.sender() is not self.pdf_upload_thread:
+            return
+        self.status_label.setText("Status: Error occurred")
+        QMessageBox.warning(self, "Error", f"Failed to upload PDF: {error_message}")
 
-        except Exception as e:
-            print(f"Error processing PDF: {e}")
-            QMessageBox.warning(self, "Error", f"Failed to upload PDF: {str(e)}")
+    def start_conversion(self, prompt, result_widget=None, convert_button=None, export_buttons=None,
+                         chunk_settings=None, use_context_cache=False, use_text_layer=False):
+        if self.conversion_thread and self.conversion_thread.isRunning():
+            QMessageBox.warning(self, "Conversion Running",
+                                "A conversion is already running. Use the Queue tab to run several at once.")
+            return
+        # The first conversion after an upload keeps the upload timing; later ones start fresh
+        model = self.model_combo.currentText()
+        if self.job_metrics is None or self.job_metrics.status is not None:
+            self.job_metrics = JobMetrics('pdf', self.file_path, model=model)
+        self.job_metrics.model = model
+
+        cache_key = ResultCache.make_key(self.file_hash, prompt, model,
+                                         TEXT_LAYER_SECTION if use_text_layer else "") if self.file_hash else None
+        if cache_key and not self.bypass_cache_checkbox.isChecked():
+            cached_text = self.result_cache.get(cache_key)
+            if cached_text is not None:
+                self.on_conversion_finished(cached_text, result_widget, convert_button, export_buttons,
+                                            from_cache=True)
+                return
 
-    def start_conversion(self, prompt, result_widget=None, convert_button=None, export_buttons=None):
         if convert_button:
             convert_button.setEnabled(False)
         if export_buttons:
@@ -807,11 +1728,46 @@ class PDFToTextConverter(QWidget):
             result_widget.append("Starting conversion process...")
         self.status_label.setText("Status: Converting...")
 
+        if cache_key and self.bypass_cache_checkbox.isChecked():
+            # A forced re-conversion does not resume an old checkpoint either
+            ConversionJournal(cache_key).discard()
+        if not chunk_settings and self.page_count >= LONG_DOCUMENT_PAGES:
+            chunk_settings = DEFAULT_CHUNK_SETTINGS
+            if result_widget:
+                result_widget.append(f"{self.page_count} pages: converting in ranges of "
+                                     f"{chunk_settings['pages_per_chunk']} pages with checkpoints, "
+                                     f"so an interrupted conversion resumes where it stopped.")
+
         # Start conversion thread
-        self.conversion_thread = ConversionThread(self.client, self.uploaded_file, prompt)
+        context_cache = self.context_cache if use_context_cache else None
+        if chunk_settings:
+            self.conversion_thread = ChunkedConversionThread(self.client, self.file_path, prompt,
+                                                             upload_cache=self.upload_cache,
+                                                             metrics=self.job_metrics, journal_key=cache_key,
+                                                             model=model, text_layer=use_text_layer,
+                                                             context_cache=context_cache, **chunk_settings)
+        else:
+            self.conversion_thread = ConversionThread(self.client, self.uploaded_file, prompt,
+                                                      expected_bytes=max(1, self.page_count) * EXPECTED_BYTES_PER_PAGE,
+                                                      metrics=self.job_metrics, model=model,
+                                                      file_path=self.file_path, upload_cache=self.upload_cache,
+                                                      journal_key=cache_key,
+                                                      context_cache=context_cache,
+                                                      text_layer=use_text_layer)
+            if result_widget:
+                result_widget.append("")
+                self.conversion_thread.chunk_received.connect(
+                    lambda text: self.append_streamed_text(result_widget, text)
+                )
+                self.conversion_thread.stream_reset.connect(
+                    lambda text: self.remove_streamed_text(result_widget, text)
+                )
         self.conversion_thread.progress.connect(self.update_progress)
+        if result_widget:
+            self.conversion_thread.notice.connect(result_widget.append)
         self.conversion_thread.finished.connect(
-            lambda text: self.on_conversion_finished(text, result_widget, convert_button, export_buttons)
+            lambda text: self.on_conversion_finished(text, result_widget, convert_button, export_buttons,
+                                                     cache_key=cache_key)
         )
         self.conversion_thread.error.connect(
             lambda error: self.on_conversion_error(error, result_widget, convert_button)
@@ -821,9 +1777,39 @@ class PDFToTextConverter(QWidget):
     def update_progress(self, value):
         self.progress_bar.setValue(value)
 
-    def on_conversion_finished(self, text, result_widget=None, convert_button=None, export_buttons=None):
+    def api_stats_text(self):
+        stats = api_scheduler.stats()
+        return (f"(API calls: {stats['succeeded']} ok, {stats['throttled']} throttled, "
+                f"{stats['retried']} retried)")
+
+    def append_streamed_text(self, result_widget, text):
+        if result_widget in self.restarted_streams:
+            # The retry notice went in after the reset; the new attempt starts below it
+            self.restarted_streams.discard(result_widget)
+            result_widget.append("")
+        # Insert at the end without adding a paragraph break per chunk
+        result_widget.moveCursor(QTextCursor.MoveOperation.End)
+        result_widget.insertPlainText(text)
+
+    def remove_streamed_text(self, result_widget, text):
+        # A retried stream starts over, so drop what the failed attempt showed
+        if not text or not result_widget.toPlainText().endswith(text):
+            return
+        cursor = result_widget.textCursor()
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        # Qt positions count UTF-16 code units, so math letters outside the BMP count twice
+        cursor.movePosition(QTextCursor.MoveOperation.Left, QTextCursor.MoveMode.KeepAnchor,
+                            len(text.encode('utf-16-le')) // 2)
+        cursor.removeSelectedText()
+        self.restarted_streams.add(result_widget)
+
+    def on_conversion_finished(self, text, result_widget=None, convert_button=None, export_buttons=None,
+                               cache_key=None, from_cache=False):
+        if cache_key and not from_cache:
+            self.result_cache.put(cache_key, text)
+
         # Save processed text
-        self.pdf_text = self.process_formulas(text)
+        self.pdf_text = self.finish_job(text, from_cache)
 
         if result_widget:
             result_widget.clear()
@@ -836,195 +1822,120 @@ class PDFToTextConverter(QWidget):
             for btn in export_buttons:
                 btn.setEnabled(True)
 
-        self.status_label.setText("Status: Conversion completed")
+        if from_cache:
+            self.progress_bar.setValue(100)
+            self.status_label.setText(f"Status: Conversion loaded from cache | {self.job_metrics.summary()}")
+        else:
+            self.status_label.setText(f"Status: Conversion completed {self.api_stats_text()} | "
+                                      f"{self.job_metrics.summary()}")
 
     def on_conversion_error(self, error_message, result_widget=None, convert_button=None):
         if result_widget:
             result_widget.append(f"An error occurred during conversion: {error_message}")
         if convert_button:
             convert_button.setEnabled(True)
+        self.fail_job()
         self.status_label.setText("Status: Error occurred")
 
     def process_formulas(self, text):
-        def process_math_content(match):
-            content = match.group(1)
-            content = content.replace('π', '\\pi')
-            content = re.sub(r'√(\d+)', r'\\sqrt{\1}', content)
-            content = re.sub(r'√\{([^}]+)\}', r'\\sqrt{\1}', content)
-            content = content.replace('≠', '\\neq')
-            content = content.replace('*', '')
-            return f'${content}$'
-
-        text = re.sub(r'\$(.+?)\$', process_math_content, text, flags=re.DOTALL)
-        return text
-
-    def export_with_python_docx(self, output_path, include_original_images=False):
-        """Export using python-docx with optional original images"""
-        doc = Document()
-        doc.add_heading('Converted Document', 0)
-
-        lines = self.pdf_text.split('\n')
-        i = 0
-
-        # If this is from image tab and we want to include original images
-        if include_original_images and hasattr(self.image_tab, 'uploaded_images'):
-            doc.add_heading('Original Images', level=1)
-            for img_info in self.image_tab.uploaded_images:
-                try:
-                    if os.path.exists(img_info['path']):
-                        doc.add_paragraph(f"Image {img_info['index']}: {img_info['filename']}")
-                        doc.add_picture(img_info['path'], width=Inches(5))
-                        doc.add_paragraph("")  # spacing
-                except Exception as e:
-                    print(f"Error adding original image {img_info['index']}: {e}")
-                    doc.add_paragraph(f"[Error: Could not insert image {img_info['index']}]")
-
-            doc.add_heading('Extracted Text', level=1)
-
-        while i < len(lines):
-            line = lines[i].strip()
-            if not line:
-                i += 1
-                continue
-
-            # Check for Markdown table
-            if '|' in line and len(line.split('|')) > 2:
-                table_lines = []
-                j = i
-
-                # Collect consecutive table lines
-                while j < len(lines):
-                    current_line = lines[j].strip()
-                    if '|' in current_line and len(current_line.split('|')) > 2:
-                        # Skip separator lines like |---|---|
-                        separator_pattern = r'^\s*\|[\s\-\:]*\|\s*$'
-                        if not re.match(separator_pattern, current_line):
-                            table_lines.append(current_line)
-                        j += 1
-                    else:
-                        break
-
-                if table_lines:
-                    print(f"Creating table with {len(table_lines)} rows")
-                    self.create_word_table(doc, table_lines)
-                    i = j
-                else:
-                    doc.add_paragraph(line)
-                    i += 1
-            else:
-                # Regular text
-                doc.add_paragraph(line)
-                i += 1
+        return process_formulas(text)
+
+    def finish_job(self, text, from_cache=False):
+        """Post-process converted text and record the current job's metrics; returns the processed text"""
+        job = self.job_metrics
+        with job.stage('postprocess'):
+            processed = self.process_formulas(text)
+        job.from_cache = from_cache
+        job.status = 'ok'
+        job.add('text_bytes', len(processed.encode('utf-8')))
+        metrics_recorder.record(job)
+        return processed
+
+    def fail_job(self):
+        if self.job_metrics and self.job_metrics.status is None:
+            self.job_metrics.status = 'failed'
+            metrics_recorder.record(self.job_metrics)
+
+    def record_export(self, output_path, seconds):
+        """Add an export to the metrics of the job that produced pdf_text and show its summary"""
+        if not self.job_metrics:
+            return
+        self.job_metrics.add_duration('export', seconds)
+        self.job_metrics.add('output_bytes', os.path.getsize(output_path))
+        metrics_recorder.record(self.job_metrics)
+        self.status_label.setText(f"Status: Export completed | {self.job_metrics.summary()}")
 
-        doc.save(output_path)
+    def export_with_python_docx(self, output_path, include_original_images=False, note=None):
+        """Export using python-docx with optional original images"""
+        images = self.image_tab.uploaded_images if include_original_images else None
+        engine = 'streaming' if len(self.pdf_text) >= STREAMING_EXPORT_MIN_CHARS else 'python-docx'
+        started = time.perf_counter()
+        stats = export_docx(self.pdf_text, output_path, images=images, engine=engine)
+        self.record_export(output_path, time.perf_counter() - started)
 
         success_msg = (f"Document exported successfully to:\n{output_path}\n\n"
                       f"Statistics:\n"
-                      f"- Processed {len(lines)} lines of text")
+                      f"- Processed {stats['lines']} lines of text")
 
-        if include_original_images and hasattr(self.image_tab, 'uploaded_images'):
-            success_msg += f"\n- Included {len(self.image_tab.uploaded_images)} original images"
+        if images is not None:
+            success_msg += f"\n- Included {stats['images']} original images"
+        if note:
+            success_msg += f"\n\n{note}"
 
         print(success_msg)
         QMessageBox.information(self, "Export Complete", success_msg)
 
-    def create_word_table(self, doc, table_lines):
-        """Create a Word table from Markdown table lines"""
-        if not table_lines:
-            return
-
-        print(f"Creating table from {len(table_lines)} lines:")
-        for i, line in enumerate(table_lines):
-            print(f"  Line {i}: {repr(line)}")
-
-        # Parse table data
-        table_data = []
-        for line_num, line in enumerate(table_lines):
-            if not line.strip():
-                continue
-
-            # Split by | and clean up cells
-            raw_cells = line.split('|')
-            cells = []
-
-            for cell in raw_cells:
-                cleaned_cell = cell.strip()
-                if cleaned_cell or (cells and line_num < len(table_lines) - 1):
-                    cells.append(cleaned_cell)
-
-            # Remove leading/trailing empty cells only
-            while cells and not cells[0]:
-                cells.pop(0)
-            while cells and not cells[-1]:
-                cells.pop()
-
-            if cells:
-                table_data.append(cells)
-                print(f"  Parsed row {len(table_data)}: {cells}")
-
-        if not table_data:
-            print("No valid table data found, adding as regular text")
-            for line in table_lines:
-                doc.add_paragraph(line)
-            return
-
+    def export_with_pandoc(self, output_path):
+        """Export using pandoc for better math formula handling"""
         try:
-            rows = len(table_data)
-            cols = max(len(row) for row in table_data) if table_data else 0
-
-            print(f"Creating {rows}x{cols} table")
-
-            if rows > 0 and cols > 0:
-                # Create table
-                table = doc.add_table(rows=rows, cols=cols)
-                table.style = 'Table Grid'
-
-                # Fill table with data
-                for i, row_data in enumerate(table_data):
-                    if i >= len(table.rows):
-                        print(f"Warning: Row {i} exceeds table rows")
-                        break
-
-                    row = table.rows[i]
-                    for j, cell_data in enumerate(row_data):
-                        if j >= len(row.cells):
-                            print(f"Warning: Column {j} exceeds table columns in row {i}")
-                            break
-
-                        try:
-                            clean_data = str(cell_data).replace('\n', ' ').replace('\r', '')
-                            row.cells[j].text = clean_data
-                            print(f"  Cell [{i}][{j}]: {repr(clean_data)}")
-                        except Exception as cell_error:
-                            print(f"Error setting cell [{i}][{j}]: {cell_error}")
-                            row.cells[j].text = str(cell_data)
-
-                doc.add_paragraph("")  # spacing after table
-                print("Table created successfully")
-
-            else:
-                print(f"Invalid table dimensions: {rows}x{cols}")
-                for line in table_lines:
-                    doc.add_paragraph(line)
+            started = time.perf_counter()
+            pandoc_export(self.pdf_text, output_path)
+            self.record_export(output_path, time.perf_counter() - started)
+            QMessageBox.information(self, "Export Complete",
+                                  f"Document exported successfully with Pandoc to:\n{output_path}\n\n"
+                                  f"Math formulas should be properly rendered.")
 
+        except FileNotFoundError:
+            # The built-in exporter writes formulas as native Word equations too
+            self.export_with_python_docx(
+                output_path, note="Pandoc was not found in PATH, so the built-in exporter was used.")
+        except RuntimeError as e:
+            QMessageBox.warning(self, "Pandoc Error",
+                              f"Pandoc failed with error:\n{str(e)}")
         except Exception as e:
-            print(f"Error creating table: {e}")
-            print(f"Table data that caused error: {table_data}")
-            doc.add_paragraph("Table conversion failed, showing as text:")
-            for line in table_lines:
-                doc.add_paragraph(f"  {line}")
+            QMessageBox.warning(self, "Error", f"An error occurred during pandoc export:\n{str(e)}")
 
     def closeEvent(self, event):
         self.cleanup_and_close()
         super().closeEvent(event)
 
     def cleanup_and_close(self):
-        # Stop conversion thread if running
-        if self.conversion_thread and self.conversion_thread.isRunning():
-            self.conversion_thread.stop()
-            self.conversion_thread.wait()
+        # Cancel every running worker first so they all wind down in parallel
+        threads = [thread for thread in (self.conversion_thread, self.pdf_upload_thread, *self.stale_pdf_threads,
+                                         self.image_tab.upload_thread, self.image_tab.image_conversion_thread)
+                   if thread is not None and thread.isRunning()]
+        for thread in threads:
+            thread.stop()
+        threads += self.queue_tab.shutdown()
+        for thread in threads:
+            # Cancelled requests are abandoned on helper threads, so this returns quickly
+            if not thread.wait(2000):
+                print(f"{type(thread).__name__} did not stop in time", file=sys.stderr)
+        # A pandoc server started by an export is no longer needed
+        pandoc_backend.close()
+        if self.upload_cache:
+            self.upload_cache.flush()
+        if self.client:
+            # Give the deletes a moment; whatever is left expires on the server after its TTL
+            clearing = threading.Thread(target=self.context_cache.clear, args=(self.client,), daemon=True)
+            clearing.start()
+            clearing.join(CONTEXT_CACHE_CLEAR_SECONDS)
+
+# Time spent importing this module, reported by the startup probe
+IMPORT_SECONDS = time.perf_counter() - STARTUP_TIME
 
 if __name__ == '__main__':
+    setup_logging()
     app = QApplication(sys.argv)
     ex = PDFToTextConverter()
     ex.show()